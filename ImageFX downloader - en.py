@@ -1,94 +1,2617 @@
 import requests
 from requests.adapters import Retry, HTTPAdapter
+import argparse
 import json
+import copy
 import base64
+import re
 import os
+import sys
 import time
 import threading
-from datetime import datetime
+import queue
+import asyncio
+import sqlite3
+import hashlib
+import heapq
+import itertools
+import bisect
+import io
+import tarfile
+import tempfile
+import pickle
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, CancelledError
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    import aiohttp # Optional, only needed by the asyncio download engine
+except ImportError:
+    aiohttp = None
+try:
+    import boto3 # Optional, only needed by the S3 output
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+try:
+    from PIL import Image # Optional, only needed to re-encode images and create thumbnails
+except ImportError:
+    Image = None
+
+
+FETCH_MEDIA_API_URL = "https://labs.google/fx/api/trpc/media.fetchMedia"
+FETCH_USER_HISTORY_API_URL = "https://labs.google/fx/api/trpc/media.fetchUserHistory"
+BATCH_UNSUPPORTED_STATUS_CODES = (400, 404, 405, 413, 414, 431) # Batch request rejected as a whole, e.g. batching disabled or URL too long
+LOGIN_URL_PREFIX = "https://accounts.google.com/" # Requests with an expired cookie are redirected to the Google sign-in page
+MIN_PAGE_SIZE = 12 # The page size requested by the ImageFX web app itself
+STREAM_CHUNK_SIZE = 64 * 1024
+PREVIEW_FOLDER_NAME = "previews" # Subfolder of the output folder for the previews of tiered mode
+THUMBNAIL_FOLDER_NAME = "thumbnails" # Subfolder next to the images for their thumbnails, see ImagePostProcessor
+IMAGE_FORMATS = {'.jpg': ('JPEG', 'image/jpeg'), '.png': ('PNG', 'image/png'), '.webp': ('WEBP', 'image/webp'), '.gif': ('GIF', 'image/gif')} # Extension: (Pillow format, Content-Type)
+
+
+def fetch_media_input(media_key, height=None, width=None):
+    """
+    Builds the tRPC input of media.fetchMedia, without height/width the original image is returned
+    """
+    input_json = {"json": {"mediaKey": media_key, "height": height, "width": width}}
+    undefined_values = {name: ["undefined"] for name, value in (("height", height), ("width", width)) if value is None}
+    if undefined_values:
+        input_json["meta"] = {"values": undefined_values}
+    return input_json
 
-def download_image_and_prompt(media_key, cookies, output_folder="imagefx_images", create_time=None,
-                                     total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
-                                     on_thread_complete=None): # Modified: on_thread_complete receives download result
+
+def fetch_media_params(media_key, height=None, width=None):
+    return {"input": json.dumps(fetch_media_input(media_key, height, width), separators=(",", ":"))}
+
+
+def fetch_user_history_params(cursor="", limit=100):
+    return {"input": json.dumps({"json": {"cursor": cursor, "limit": limit, "type": "IMAGE_FX"}, "meta": {"values": {}}}, separators=(",", ":"))}
+
+
+def fetch_media_batch_url(count):
     """
-    Downloads the original image and prompt using mediaKey, and saves them to subfolders by date (modified version)
+    URL of a tRPC batch request of count media.fetchMedia calls, the path lists the procedure once per call
     """
-    api_url = "https://labs.google/fx/api/trpc/media.fetchMedia"
-    params = {
-        "input": '{"json":{"mediaKey":"' + media_key + '","height":null,"width":null},"meta":{"values":{"height":["undefined"],"width":["undefined"]}}}'
-    }
-    session = requests.Session()
-    retries = Retry(total=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+    base_url, procedure = FETCH_MEDIA_API_URL.rsplit("/", 1)
+    return base_url + "/" + ",".join([procedure] * count)
+
+
+def fetch_media_batch_params(media_keys, height=None, width=None):
+    # The inputs of a batch are keyed by the index of their call
+    inputs = {str(index): fetch_media_input(media_key, height, width) for index, media_key in enumerate(media_keys)}
+    return {"batch": "1", "input": json.dumps(inputs, separators=(",", ":"))}
+
 
-    success = False # Flag indicating whether the download was successful
+def parse_retry_after(value):
+    """
+    Converts a Retry-After header (seconds or an HTTP date) to seconds, returns None if it is missing or invalid
+    """
+    if not value:
+        return None
     try:
-        response = session.get(api_url, params=params, cookies=cookies, timeout=30)
-        response.encoding = 'utf-8'
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-        if response.status_code == 200:
-            response_json = response.json()
-            result_data_json_result = response_json['result']['data']['json']['result']
-            encoded_image = result_data_json_result['image']['encodedImage']
-            prompt_text = result_data_json_result.get('image').get('prompt')
 
-            if encoded_image:
+def is_auth_failure(status_code, url):
+    """
+    A 401/403 response, or a redirect to the Google sign-in page, means the cookie has expired or was signed out
+    """
+    return status_code in (401, 403) or str(url).startswith(LOGIN_URL_PREFIX)
+
+
+class AdaptiveRateController:
+    """
+    AIMD concurrency controller shared by all download workers. The allowed number of requests in flight grows by one
+    per window of fast successful responses, and is multiplied by decrease_factor on 429/503 or when the latency rises
+    above latency_factor times its moving average. A Retry-After header pauses all workers, not only the one that received it.
+    """
+    def __init__(self, max_limit, min_limit=1, initial_limit=None, latency_factor=2.0, decrease_factor=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 2))
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.pause_until = 0.0
+        self.average_latency = None
+        self.last_decrease_time = 0.0
+        self.condition = threading.Condition()
+
+    def current_limit(self):
+        return max(self.min_limit, min(self.max_limit, int(self.limit)))
+
+    def pause_remaining(self):
+        return max(0.0, self.pause_until - time.monotonic())
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.pause_remaining()
+                if pause:
+                    self.condition.wait(pause)
+                elif self.in_flight < self.current_limit():
+                    break
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self.condition:
+            if self.pause_remaining() or self.in_flight >= self.current_limit():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def wait_if_paused(self):
+        pause = self.pause_remaining()
+        if pause:
+            time.sleep(pause)
+
+    def record_response(self, status, latency=None, retry_after=None):
+        with self.condition:
+            now = time.monotonic()
+            if retry_after:
+                self.pause_until = max(self.pause_until, now + retry_after)
+            if status in (429, 503):
+                self._decrease(now, f"HTTP {status}")
+            elif status == 200 and latency is not None:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                if latency > self.average_latency * self.latency_factor:
+                    self._decrease(now, f"latency {latency:.2f}s")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit) # +1 after a full window of successes
+                self.average_latency = 0.9 * self.average_latency + 0.1 * latency
+            self.condition.notify_all()
+
+    def _decrease(self, now, reason):
+        # Responses to requests sent before the last decrease must not lower the limit again
+        if now - self.last_decrease_time < (self.average_latency or 1.0):
+            return
+        self.last_decrease_time = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        print(f"  -> Rate control: {reason}, concurrency lowered to {self.current_limit()}")
+
+
+class SharedLimiter:
+    """
+    Limits shared by the downloaders of several accounts: the requests in flight of all of them together (max_concurrency)
+    and the saved image bytes per second (max_bytes_per_second, a token bucket with one second of burst). Each downloader
+    still applies its own limits (thread count, AdaptiveRateController) first.
+    """
+    def __init__(self, max_concurrency=None, max_bytes_per_second=None):
+        self.max_concurrency = max_concurrency
+        self.max_bytes_per_second = max_bytes_per_second
+        self.in_flight = 0
+        self.available_bytes = float(max_bytes_per_second or 0)
+        self.last_refill_time = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _wait_time(self):
+        # Seconds until the bandwidth budget is positive again, the bytes of finished images are charged after the fact
+        if not self.max_bytes_per_second:
+            return 0.0
+        now = time.monotonic()
+        self.available_bytes = min(self.max_bytes_per_second, self.available_bytes + (now - self.last_refill_time) * self.max_bytes_per_second)
+        self.last_refill_time = now
+        return max(0.0, -self.available_bytes / self.max_bytes_per_second)
+
+    def _full(self):
+        return self.max_concurrency and self.in_flight >= self.max_concurrency
+
+    def wait_time(self):
+        with self.condition:
+            return self._wait_time()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait_time = self._wait_time()
+                if not wait_time and not self._full():
+                    break
+                self.condition.wait(wait_time or None)
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self.condition:
+            if self._wait_time() or self._full():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record_bytes(self, byte_size):
+        with self.condition:
+            self._wait_time()
+            self.available_bytes -= byte_size
+
+
+class ControlledRetry(Retry):
+    """
+    urllib3 Retry that reports every retried response to an AdaptiveRateController before backing off,
+    and counts the retries by status code (or exception name) in DownloadMetrics
+    """
+    def __init__(self, *args, rate_controller=None, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_controller = rate_controller
+        self.metrics = metrics
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_controller = self.rate_controller
+        retry.metrics = self.metrics
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.rate_controller and response is not None:
+            self.rate_controller.record_response(response.status, retry_after=self.get_retry_after(response))
+        if self.metrics:
+            self.metrics.record_retry(response.status if response is not None else type(error).__name__)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class DownloadMetrics:
+    """
+    Thread-safe metrics of the download pipeline: image and byte counters, retries by status code, latency histograms per
+    stage (http: until the response headers arrive, decode: base64 decoding, write: saving the files) and gauges such as
+    queue depths, which are read whenever a snapshot is taken.
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    STAGES = ('http', 'decode', 'write')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.total = None # Number of images to download, None while it is unknown (e.g. the crawl is still running)
+        self.queued = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes_saved = 0
+        self.retries_by_status = {}
+        self.histograms = {stage: {'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0} for stage in self.STAGES}
+        self.gauges = {}
+        self.show_progress_bar = False # Set by MetricsReporter, the downloaders then leave out their own progress prints
+
+    def add_total(self, count):
+        with self.lock:
+            self.total = (self.total or 0) + count
+
+    def set_gauge(self, name, read_value):
+        with self.lock:
+            self.gauges[name] = read_value
+
+    def record_queued(self, count=1):
+        with self.lock:
+            self.queued += count
+
+    def record_retry(self, status):
+        with self.lock:
+            self.retries_by_status[str(status)] = self.retries_by_status.get(str(status), 0) + 1
+
+    def record_result(self, result):
+        with self.lock:
+            if result['success']:
+                self.succeeded += 1
+                self.bytes_saved += result['byte_size'] or 0
+            else:
+                self.failed += 1
+            for stage, seconds in result['timings'].items():
+                histogram = self.histograms[stage]
+                histogram['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+                histogram['sum'] += seconds
+                histogram['count'] += 1
+                histogram['max'] = max(histogram['max'], seconds)
+
+    def _percentile(self, histogram, fraction):
+        # Upper bound of the bucket that contains the percentile, the largest observation for the overflow bucket
+        if not histogram['count']:
+            return None
+        cumulative_count = 0
+        for bucket_index, count in enumerate(histogram['buckets']):
+            cumulative_count += count
+            if cumulative_count >= fraction * histogram['count']:
+                break
+        if bucket_index < len(self.LATENCY_BUCKETS):
+            return min(self.LATENCY_BUCKETS[bucket_index], histogram['max'])
+        return histogram['max']
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            completed = self.succeeded + self.failed
+            expected = self.total if self.total is not None else self.queued
+            images_per_second = completed / elapsed if elapsed else 0.0
+            snapshot = {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'elapsed_seconds': round(elapsed, 3),
+                'images_total': self.total,
+                'images_queued': self.queued,
+                'images_succeeded': self.succeeded,
+                'images_failed': self.failed,
+                'bytes_saved': self.bytes_saved,
+                'images_per_second': round(images_per_second, 3),
+                'bytes_per_second': round(self.bytes_saved / elapsed if elapsed else 0.0, 1),
+                'eta_seconds': round((expected - completed) / images_per_second, 1) if images_per_second and expected >= completed else None,
+                'retries_by_status': dict(self.retries_by_status),
+                'stages': {
+                    stage: {'count': histogram['count'], 'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+                            'p50': self._percentile(histogram, 0.5), 'p99': self._percentile(histogram, 0.99)}
+                    for stage, histogram in self.histograms.items()
+                },
+            }
+            gauges = dict(self.gauges)
+        snapshot['gauges'] = {name: read_value() for name, read_value in gauges.items()} # Read outside the lock, they take their own locks
+        return snapshot
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        with self.lock:
+            histograms = {stage: dict(histogram, buckets=list(histogram['buckets'])) for stage, histogram in self.histograms.items()}
+        lines = [
+            "# TYPE imagefx_images_total counter",
+            f'imagefx_images_total{{result="succeeded"}} {snapshot["images_succeeded"]}',
+            f'imagefx_images_total{{result="failed"}} {snapshot["images_failed"]}',
+            "# TYPE imagefx_images_queued_total counter",
+            f"imagefx_images_queued_total {snapshot['images_queued']}",
+            "# TYPE imagefx_bytes_saved_total counter",
+            f"imagefx_bytes_saved_total {snapshot['bytes_saved']}",
+            "# TYPE imagefx_retries_total counter",
+        ]
+        lines += [f'imagefx_retries_total{{status="{status}"}} {count}' for status, count in sorted(snapshot['retries_by_status'].items())]
+        lines.append("# TYPE imagefx_stage_seconds histogram")
+        for stage, histogram in histograms.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), histogram['buckets']):
+                cumulative_count += count
+                lines.append(f'imagefx_stage_seconds_bucket{{stage="{stage}",le="{upper_bound}"}} {cumulative_count}')
+            lines.append(f'imagefx_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'imagefx_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        for name, value in snapshot['gauges'].items():
+            lines += [f"# TYPE imagefx_{name} gauge", f"imagefx_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """
+    Reports DownloadMetrics while a download runs: a JSON line every metrics_interval seconds appended to metrics_file
+    ("-" for the console), a progress bar with ETA, and a Prometheus text endpoint on http://127.0.0.1:<prometheus_port>/metrics
+    """
+    def __init__(self, metrics, metrics_file=None, metrics_interval=10, progress_bar=False, prometheus_port=None):
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.progress_bar = progress_bar
+        self.prometheus_port = prometheus_port
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.prometheus_server = None
+        self.progress_line_length = 0
+
+    def start(self):
+        self.metrics.show_progress_bar = self.progress_bar
+        if self.prometheus_port is not None:
+            metrics = self.metrics
+
+            class MetricsRequestHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    data = metrics.prometheus_text().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.prometheus_server = ThreadingHTTPServer(("127.0.0.1", self.prometheus_port), MetricsRequestHandler)
+            self.prometheus_server.daemon_threads = True
+            threading.Thread(target=self.prometheus_server.serve_forever, daemon=True).start()
+        if self.metrics_file or self.progress_bar:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            snapshot = self.metrics.snapshot()
+            if self.progress_bar:
+                self._draw_progress_bar(snapshot)
+                print("")
+            if self.metrics_file:
+                self._write_json_line(snapshot) # Final totals
+        if self.prometheus_server:
+            self.prometheus_server.shutdown()
+            self.prometheus_server.server_close()
+        self.metrics.show_progress_bar = False
+
+    def _run(self):
+        next_report_time = time.monotonic() + self.metrics_interval
+        while not self.stop_event.wait(0.5 if self.progress_bar else max(0.5, next_report_time - time.monotonic())):
+            snapshot = self.metrics.snapshot()
+            if self.progress_bar:
+                self._draw_progress_bar(snapshot)
+            if self.metrics_file and time.monotonic() >= next_report_time:
+                self._write_json_line(snapshot)
+                next_report_time += self.metrics_interval
+
+    def _write_json_line(self, snapshot):
+        line = json.dumps(snapshot, ensure_ascii=False)
+        if self.metrics_file == "-":
+            if self.progress_bar:
+                print("")
+            print(line)
+            return
+        with open(self.metrics_file, "a", encoding='utf-8') as f:
+            f.write(line + "\n")
+
+    def _draw_progress_bar(self, snapshot):
+        completed = snapshot['images_succeeded'] + snapshot['images_failed']
+        total = snapshot['images_total']
+        if total:
+            fraction = min(1.0, completed / total)
+            filled = int(fraction * 30)
+            progress = f"[{'#' * filled}{'-' * (30 - filled)}] {completed}/{total} {fraction:.0%}"
+        else:
+            progress = f"{completed}/{snapshot['images_queued']}"
+        eta = snapshot['eta_seconds']
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "--:--:--"
+        line = (f"{progress} | {snapshot['images_per_second']:.1f} img/s | {snapshot['bytes_per_second'] / 1e6:.1f} MB/s | "
+                f"{snapshot['images_failed']} failed | ETA {eta_text}")
+        print("\r" + line.ljust(self.progress_line_length), end="", flush=True)
+        self.progress_line_length = len(line)
+
+
+class RetryScheduler:
+    """
+    Deferred retries of failed downloads, on top of the inline urllib3 retries of single requests: a failed image goes
+    to the back of the work queue after retry_delay * 2 ** (attempt - 1) seconds, up to max_attempts attempts, so no worker
+    sleeps for it. Counts the images still in progress, so the feeder knows when the last retry has finished.
+    """
+    def __init__(self, max_attempts=3, retry_delay=10):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.attempts = {} # Attempts so far of the images that failed at least once
+        self.due_items = [] # Heap of (due time, sequence number, item)
+        self.sequence = itertools.count()
+        self.in_progress = 0
+        self.failed_items = [] # (item, error, attempts) of the images that failed for good
+        self.succeeded_media_keys = set() # Downloaded in this run, dropped from the failed keys report
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            self.in_progress += 1
+
+    def schedule_retry(self, item):
+        """
+        Schedules the next attempt of a failed image, returns its delay, or None when the attempts are used up
+        """
+        with self.condition:
+            attempts = self.attempts.get(item.media_key, 1)
+            if attempts >= self.max_attempts:
+                return None
+            self.attempts[item.media_key] = attempts + 1
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            heapq.heappush(self.due_items, (time.monotonic() + delay, next(self.sequence), item))
+            self.condition.notify_all()
+            return delay
+
+    def requeue(self, item):
+        """
+        Puts an image back at the end of the queue right away, without counting an attempt (after an expired cookie)
+        """
+        with self.condition:
+            heapq.heappush(self.due_items, (time.monotonic(), next(self.sequence), item))
+            self.condition.notify_all()
+
+    def finish(self, item, result):
+        with self.condition:
+            attempts = self.attempts.pop(item.media_key, 1)
+            if result['success']:
+                self.succeeded_media_keys.add(item.media_key)
+            else:
+                self.failed_items.append((item, result['error'], attempts))
+            self.in_progress -= 1
+            self.condition.notify_all()
+
+    def pop_due(self):
+        with self.condition:
+            if self.due_items and self.due_items[0][0] <= time.monotonic():
+                return heapq.heappop(self.due_items)[2]
+            return None
+
+    def seconds_until_due(self):
+        with self.condition:
+            return max(0.0, self.due_items[0][0] - time.monotonic()) if self.due_items else None
+
+    def is_finished(self):
+        with self.condition:
+            return not self.in_progress
+
+    def wait_for_retry(self):
+        """
+        Blocks until a retry is due and returns its item, returns None once every image has finished
+        """
+        with self.condition:
+            while self.in_progress:
+                if self.due_items and self.due_items[0][0] <= time.monotonic():
+                    return heapq.heappop(self.due_items)[2]
+                self.condition.wait(self.due_items[0][0] - time.monotonic() if self.due_items else None)
+            return None
+
+
+def write_failed_keys_report(failed_keys_file, failed_items, downloaded_media_keys=(), state_store=None):
+    """
+    Writes the images that failed for good to failed_keys_file, as JSON Lines in the crawl result format plus the error and
+    the number of attempts, so they can be downloaded again with download --crawl-result-file <failed_keys_file>.
+    The entries of earlier runs are kept until their image is downloaded (it is in downloaded_media_keys, or done in
+    state_store when an image was skipped as already downloaded) or fails again.
+    """
+    failed_media_keys = {item.media_key for item, _, _ in failed_items}
+    entries = []
+    if os.path.exists(failed_keys_file):
+        if state_store:
+            downloaded_media_keys = set(downloaded_media_keys) | state_store.get_done_media_keys()
+        with open(failed_keys_file, 'r', encoding='utf-8') as f:
+            for line in f:
                 try:
-                    image_data = base64.b64decode(encoded_image)
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                media_key = entry.get('media_key') if isinstance(entry, dict) else None
+                if media_key and media_key not in downloaded_media_keys and media_key not in failed_media_keys:
+                    entries.append(entry)
+    elif not failed_items:
+        return
+    entries.extend(dict(item.to_dict(), error=error, attempts=attempts) for item, error, attempts in failed_items)
+    temp_filename = failed_keys_file + ".part"
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(temp_filename, failed_keys_file)
+    if failed_items:
+        print(f"{len(failed_items)} images could not be downloaded, '{failed_keys_file}' lists the {len(entries)} images "
+              f"still missing (download them again with: download --crawl-result-file {failed_keys_file}).")
 
-                    if create_time:
-                        date_object = datetime.fromisoformat(create_time.replace("Z", "+00:00"))
-                        date_folder_name = date_object.strftime("%Y-%m-%d")
-                        date_folder_path = os.path.join(output_folder, date_folder_name)
-                        os.makedirs(date_folder_path, exist_ok=True)
 
-                        image_filename = os.path.join(date_folder_path, f"{media_key}.jpg")
-                        prompt_filename = os.path.join(date_folder_path, f"{media_key}.txt")
-                    else:
-                        image_filename = os.path.join(output_folder, f"{media_key}.jpg")
-                        prompt_filename = os.path.join(output_folder, f"{media_key}.txt")
+def read_cookie_file(cookie_file):
+    with open(cookie_file, 'r', encoding='utf-8') as f:
+        return f.read().strip()
 
-                    with open(image_filename, "wb") as f:
-                        f.write(image_data)
 
-                    if prompt_text:
-                        with open(prompt_filename, "w", encoding='utf-8') as f:
-                            f.write(prompt_text)
-                    else:
-                        print(f"  -> Warning: Prompt text not found in response for {media_key}")
-                    success = True # Mark as successful
+class AuthMonitor:
+    """
+    Pauses the downloads when the cookie expires during a run, instead of letting every remaining image fail. A request
+    rejected with report_rejected() is confirmed with one cheap authenticated request first, since the server may also refuse
+    a single image, then pauses all workers in wait_until_valid() until a new cookie is available: cookie_file is
+    read again every poll_interval seconds for at most wait_time seconds, or with prompt the user is asked to paste one.
+    cookies is the {'Cookie': cookie_string} dict of the crawler and the downloader, the new cookie is stored in it.
+    Without a source for a new cookie, or once wait_time has passed, the remaining images fail without being requested.
+    """
+    def __init__(self, cookies, cookie_file=None, prompt=False, wait_time=3600, poll_interval=5):
+        self.cookies = cookies
+        self.cookie_file = cookie_file
+        self.prompt = prompt
+        self.wait_time = wait_time
+        self.poll_interval = poll_interval
+        self.expired_cookie = None # The rejected cookie, while waiting for a new one
+        self.expired_time = None
+        self.gave_up = False
+        self.probing = False # A rejection is being confirmed by cookie_is_expired()
+        self.condition = threading.Condition()
+
+    def report_rejected(self, cookie):
+        """
+        Reports a request whose cookie was rejected, returns whether the image should be requested again with a new cookie.
+        Returns False without giving up (gave_up stays False) if the cookie still works, the caller then treats the rejection
+        as a failure of this image only.
+        """
+        with self.condition:
+            waited = self.probing
+            while self.probing: # Another worker is confirming a rejection right now, its answer applies to this request too
+                self.condition.wait()
+            if self.gave_up:
+                return False
+            if self.expired_cookie is not None or cookie != self.cookies['Cookie']: # Already paused, or replaced by a newer cookie
+                return True
+            if waited:
+                return False # Confirmed by the request of the other worker, the cookie still works
+            self.probing = True
+        expired = self.cookie_is_expired(cookie)
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+            if not expired:
+                return False
+            if not self.cookie_file and not self.prompt:
+                self.gave_up = True
+                print("The cookie was rejected (expired or signed out), the remaining images are skipped. "
+                      "Run again with a new cookie, use --cookie-file to reload it during a run instead.")
+                return False
+            self.expired_cookie = cookie
+            self.expired_time = time.monotonic()
+            if self.cookie_file:
+                print(f"The cookie was rejected (expired or signed out), the downloads are paused. Save a new Cookie string to "
+                      f"'{self.cookie_file}' to continue (waiting at most {self.wait_time:g} seconds).")
+            return True
+
+    def cookie_is_expired(self, cookie):
+        """
+        Requests the newest history entry with cookie, returns whether the cookie was rejected there too
+        """
+        try:
+            response = requests.get(FETCH_USER_HISTORY_API_URL, params=fetch_user_history_params(limit=1), cookies={'Cookie': cookie}, timeout=30)
+        except requests.exceptions.RequestException:
+            return False # Unknown, the image is retried like any other failed download
+        response.close()
+        return is_auth_failure(response.status_code, response.url)
+
+    def is_paused(self):
+        with self.condition:
+            return self.expired_cookie is not None
+
+    def _load_new_cookie(self):
+        if self.prompt:
+            return input("\nThe cookie was rejected (expired or signed out), the downloads are paused.\n"
+                         "Paste a new Cookie string to continue (leave blank to stop): ").strip() or None
+        try:
+            return read_cookie_file(self.cookie_file)
+        except OSError: # The file may be replaced at this moment, it is read again at the next poll
+            return ""
+
+    def wait_until_valid(self):
+        """
+        Blocks while the cookie is expired, returns False once the downloads gave up waiting for a new one
+        """
+        with self.condition:
+            while self.expired_cookie is not None:
+                new_cookie = self._load_new_cookie()
+                if new_cookie and new_cookie != self.expired_cookie:
+                    self.cookies['Cookie'] = new_cookie
+                    self.expired_cookie = None
+                    print("New cookie loaded, continuing the downloads.")
+                elif new_cookie is None or time.monotonic() - self.expired_time >= self.wait_time:
+                    self.gave_up = True
+                    self.expired_cookie = None
+                    print("No new cookie, the remaining images are skipped. Run again with a new cookie to download them.")
+                else:
+                    self.condition.wait(self.poll_interval) # Another thread may load the new cookie meanwhile
+                    continue
+                self.condition.notify_all()
+            return not self.gave_up
+
+
+def download_result(success, byte_size=None, sha256=None, error=None, auth_failed=False):
+    # timings holds the seconds spent per DownloadMetrics stage
+    return {'success': success, 'byte_size': byte_size, 'sha256': sha256, 'error': error, 'auth_failed': auth_failed, 'extension': None,
+            'timings': {}}
+
+
+def media_folder(output_folder, create_time=None):
+    if create_time:
+        date_object = datetime.fromisoformat(create_time.replace("Z", "+00:00"))
+        date_folder_name = date_object.strftime("%Y-%m-%d")
+        return os.path.join(output_folder, date_folder_name)
+    return output_folder
+
+
+def media_file_paths(media_key, output_folder="imagefx_images", create_time=None, writer=None):
+    """
+    Returns the image and prompt file paths of mediaKey, the date subfolder of create_time is created if needed
+    """
+    if writer and writer.shard_writer: # Only temporary files are written outside the shards, the date folders are inside them
+        folder = output_folder
+    else:
+        folder = media_folder(output_folder, create_time)
+    if writer:
+        writer.ensure_folder(folder)
+    else:
+        os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{media_key}.jpg"), os.path.join(folder, f"{media_key}.txt")
+
+
+def unique_temp_filename(filename, suffix=".part"):
+    """
+    Returns a new temporary file name next to filename, random so that concurrent writers of the same file never share one.
+    Open it with mode "xb" rather than using tempfile.mkstemp, whose 0600 permissions would stay on the file renamed into place.
+    """
+    return f"{filename}.{os.urandom(6).hex()}{suffix}"
+
+
+def thumbnail_file_path(image_filename):
+    return os.path.join(os.path.dirname(image_filename), THUMBNAIL_FOLDER_NAME, os.path.basename(image_filename))
+
+
+def image_media_key(filename):
+    """
+    Returns the mediaKey of an image file name (<mediaKey>.jpg, or another extension of IMAGE_FORMATS), None for other files
+    """
+    media_key, extension = os.path.splitext(filename)
+    return media_key if extension in IMAGE_FORMATS else None
+
+
+def converted_extension(convert_format=None):
+    """
+    Returns the extension every image is saved with when it is re-encoded to convert_format, None without convert_format
+    """
+    return "." + convert_format if convert_format else None
+
+
+def sniff_image_extension(data):
+    """
+    Returns the file extension of the image format whose magic bytes data starts with, .jpg for anything else
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return ".gif"
+    return ".jpg"
+
+
+def fsync_folder(folder):
+    if os.name == 'nt':
+        return # Folders cannot be opened on Windows, NTFS journals the rename itself
+    folder_fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(folder_fd)
+    finally:
+        os.close(folder_fd)
+
+
+def encode_image(image, extension, quality=90):
+    image_format = IMAGE_FORMATS[extension][0]
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB') # JPEG has no alpha channel
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+def post_process_image(image_data, temp_filename=None, convert_format=None, quality=90, thumbnail_size=None):
+    """
+    Post-processes one decoded image (image_data bytes, or the file temp_filename), runs in a worker process of
+    ImagePostProcessor. Returns (extension, image_data, thumbnail_data): the extension of the detected format (or of
+    convert_format once re-encoded), the re-encoded bytes (None if the downloaded bytes are kept) and a thumbnail in the same
+    format that fits in thumbnail_size pixels (None without thumbnail_size).
+    """
+    decode = convert_format or thumbnail_size
+    if image_data is None:
+        with open(temp_filename, "rb") as f:
+            image_data = f.read() if decode else f.read(16) # The format alone only needs the magic bytes
+    extension = sniff_image_extension(image_data)
+    converted_data = thumbnail_data = None
+    if decode:
+        image = Image.open(io.BytesIO(image_data))
+        if convert_format and "." + convert_format != extension:
+            extension = "." + convert_format
+            converted_data = encode_image(image, extension, quality)
+        if thumbnail_size:
+            image.thumbnail((thumbnail_size, thumbnail_size))
+            thumbnail_data = encode_image(image, extension, quality)
+    return extension, converted_data, thumbnail_data
+
+
+class ImagePostProcessor:
+    """
+    Post-processing stage between the download workers and the FileWriter. Every image is saved with the extension of its
+    real format, detected from its magic bytes, optionally re-encoded to convert_format ('jpg', 'png' or 'webp', at quality)
+    and with a thumbnail of thumbnail_size pixels in the thumbnails subfolder next to it. Re-encoding and thumbnails require
+    Pillow and run in a pool of processes worker processes (default: one per CPU core), which works on the bytes the
+    downloaders just decoded instead of reading the saved files again, and uses the cores the download threads leave idle.
+    If the worker processes cannot import this script (e.g. when it was loaded with importlib) or the pool breaks, the images
+    are post-processed in the writer threads instead.
+    """
+    def __init__(self, convert_format=None, quality=90, thumbnail_size=None, processes=None):
+        if convert_format and "." + convert_format not in IMAGE_FORMATS:
+            raise ValueError(f"unknown image format: {convert_format}")
+        if (convert_format or thumbnail_size) and Image is None:
+            raise RuntimeError("Re-encoding images and creating thumbnails requires Pillow, please install it first: pip install Pillow")
+        self.convert_format = convert_format
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.lock = threading.Lock()
+        # Detecting the format alone reads a few bytes, the writer threads do that without a process pool
+        self.executor = self._create_pool(processes) if convert_format or thumbnail_size else None
+
+    def _create_pool(self, processes):
+        try:
+            pickle.dumps(post_process_image) # The workers import this script by module name to find the function
+        except (pickle.PicklingError, AttributeError, TypeError):
+            print("The post-processing worker processes cannot import this script, the images are post-processed in the writer threads instead.")
+            return None
+        # The workers are started from a fresh process, forking a process whose download threads are running can deadlock
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(start_method))
+
+    def _stop_pool(self, error):
+        with self.lock:
+            if self.executor is None:
+                return
+            executor, self.executor = self.executor, None
+        print(f"The post-processing worker processes failed ({error!r}), the images are post-processed in the writer threads instead.")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, image_data=None, temp_filename=None):
+        """
+        Starts post-processing the image in a worker process and returns its Future, None without a process pool
+        """
+        executor = self.executor
+        if executor is None:
+            return None
+        try:
+            return executor.submit(post_process_image, image_data, temp_filename, self.convert_format, self.quality, self.thumbnail_size)
+        except RuntimeError: # The pool broke or was stopped meanwhile, process() then works in the writer thread
+            return None
+
+    def process(self, image_data=None, temp_filename=None, future=None):
+        """
+        Returns the (extension, image_data, thumbnail_data) of post_process_image, from the Future of submit() if there is one.
+        A failure of the pool itself is not a failure of the image, it is then processed in the calling thread.
+        """
+        if future:
+            try:
+                return future.result()
+            except (BrokenExecutor, pickle.PicklingError, CancelledError) as e:
+                self._stop_pool(e)
+        return post_process_image(image_data, temp_filename, self.convert_format, self.quality, self.thumbnail_size)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
 
-                except Exception as e:
-                    print(f"  -> Failed to save image/prompt {media_key}: {e}")
+
+def build_post_processor(detect_format=False, convert_format=None, quality=90, thumbnail_size=None, processes=None):
+    """
+    Returns an ImagePostProcessor if detect_format, convert_format or thumbnail_size is set, None otherwise (every image is then
+    saved as downloaded, as .jpg)
+    """
+    if not detect_format and not convert_format and not thumbnail_size:
+        return None
+    return ImagePostProcessor(convert_format, quality, thumbnail_size, processes)
+
+
+class FileWriter:
+    """
+    Writer stage of the download pipeline. Download workers hand decoded images over with submit(), writer threads write
+    them to a uniquely named temporary ".part" file and os.replace it into place, so an interrupted run never leaves a
+    truncated image under its final name and two jobs of the same image never share a temporary file. With fsync=True every
+    file is flushed to disk before it counts as saved, and the folders of a whole batch are synced once after the renames.
+    writer_threads=0 writes in the calling thread instead.
+    With dedup=True an image whose SHA-256 matches an image saved before is hard-linked to it instead of written again.
+    With a prompt_index (PromptIndex) the prompts of every written batch are added to it in one transaction, prompt_files=False
+    then skips the .txt file next to every image. With a shard_writer (ArchiveShardWriter) the files are appended to its
+    tar shards instead of saved as loose files (dedup does not apply then). With an object_store (S3ObjectStore) the files are
+    uploaded to it instead, the writer threads are then the upload threads. A post_processor (ImagePostProcessor) gets every
+    image at submit(), the writer threads then save it with the extension, bytes and thumbnail it returns.
+    """
+    def __init__(self, writer_threads=2, fsync=False, fsync_batch_size=32, queue_size=None, dedup=False, prompt_index=None, prompt_files=True,
+                 shard_writer=None, object_store=None, post_processor=None):
+        self.writer_threads = writer_threads
+        self.fsync = fsync
+        self.fsync_batch_size = fsync_batch_size
+        self.queue = queue.Queue(maxsize=queue_size or max(1, writer_threads) * 8) # Download workers block while the disk falls behind
+        self.threads = []
+        self.created_folders = set() # Folders already created in this run, so os.makedirs runs once per date folder instead of once per image
+        self.folder_lock = threading.Lock()
+        self.dedup = dedup
+        self.image_filenames_by_sha256 = {}
+        self.deduplicated_count = 0
+        self.dedup_lock = threading.Lock()
+        self.prompt_index = prompt_index
+        self.prompt_files = prompt_files
+        self.shard_writer = shard_writer
+        self.object_store = object_store
+        self.post_processor = post_processor
+        self.stream_temp_folder = tempfile.gettempdir() if object_store else None # Streamed uploads are decoded here, see MediaStreamDecoder
+
+    def ensure_folder(self, folder):
+        if self.object_store:
+            return # Nothing is written to the local disk, the folders only name the object keys
+        if folder not in self.created_folders:
+            with self.folder_lock:
+                if folder not in self.created_folders:
+                    os.makedirs(folder, exist_ok=True)
+                    self.created_folders.add(folder)
+
+    def add_saved_images(self, saved_images, output_folder):
+        """
+        Seeds the dedup index with (media_key, create_time, sha256, extension) rows of images saved by earlier runs. Rows of
+        older versions have no extension, the image is then looked up under every extension of IMAGE_FORMATS.
+        """
+        with self.dedup_lock:
+            for media_key, create_time, sha256, extension in saved_images:
+                if sha256 in self.image_filenames_by_sha256:
+                    continue
+                base_filename = os.path.join(media_folder(output_folder, create_time), media_key)
+                if extension:
+                    self.image_filenames_by_sha256[sha256] = base_filename + extension
+                    continue
+                image_filename = next((base_filename + image_extension for image_extension in IMAGE_FORMATS if os.path.exists(base_filename + image_extension)), None)
+                if image_filename:
+                    self.image_filenames_by_sha256[sha256] = image_filename
+
+    def start(self):
+        for _ in range(self.writer_threads):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        """
+        Waits until every submitted file is written, then stops the writer threads and closes the current shard
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.shard_writer:
+            self.shard_writer.close()
+        if self.post_processor:
+            self.post_processor.close()
+
+    def submit(self, media_key, image_filename, prompt_filename, prompt_text, result, on_complete,
+               image_data=None, temp_filename=None, create_time=None):
+        """
+        Queues the image (image_data bytes, or an already written temp_filename) and prompt for writing.
+        on_complete receives result once both files are in place, or a failed result if writing them failed.
+        """
+        job = {'media_key': media_key, 'image_filename': image_filename, 'prompt_filename': prompt_filename, 'prompt_text': prompt_text,
+               'result': result, 'on_complete': on_complete, 'image_data': image_data, 'temp_filename': temp_filename,
+               'create_time': create_time, 'thumbnail_data': None,
+               # Starts at once in a worker process, the writer thread waits for it when the job is taken from the queue
+               'post_processing': self.post_processor.submit(image_data, temp_filename) if self.post_processor else None}
+        if self.threads:
+            self.queue.put(job)
+        else:
+            self._write_batch([job])
+
+    def _run(self):
+        stop = False
+        while not stop:
+            job = self.queue.get()
+            if job is None:
+                break
+            jobs = [job]
+            while len(jobs) < self.fsync_batch_size: # Take whatever else is already queued, up to one batch
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            self._write_batch(jobs)
+
+    def _write_batch(self, jobs):
+        results = []
+        for job in jobs:
+            write_start_time = time.perf_counter()
+            failed_result = self._post_process(job) if self.post_processor else None
+            if failed_result:
+                result = failed_result
+            elif self.shard_writer:
+                result = self._add_to_shard(job)
+            elif self.object_store:
+                result = self._upload(job)
             else:
-                print(f"  -> Failed to download media.fetchMedia, encodedImage missing in response for {media_key}")
+                result = self._write(job)
+            if result['success']: # Saved by the state store, so dedup and skip detection know the extension of the saved file
+                result['extension'] = os.path.splitext(job['image_filename'])[1]
+            result['timings']['write'] = time.perf_counter() - write_start_time
+            results.append(result)
+        if self.shard_writer:
+            try:
+                self.shard_writer.flush()
+            except OSError as e:
+                print(f"  -> Failed to write archive shard {self.shard_writer.shard_filename}: {e}")
+                results = [download_result(False, error=f"save failed: {e}") if result['success'] else result for result in results]
+        elif self.fsync and not self.object_store:
+            folders = {os.path.dirname(job['image_filename']) for job, result in zip(jobs, results) if result['success']}
+            for folder in folders:
+                try:
+                    fsync_folder(folder)
+                except OSError as e:
+                    print(f"  -> Warning: failed to sync folder {folder}: {e}")
+        if self.prompt_index:
+            self._index_prompts(jobs, results) # Before on_complete, so an image only counts as downloaded once its prompt is indexed
+        for job, result in zip(jobs, results):
+            job['on_complete'](result)
+
+    def _index_prompts(self, jobs, results):
+        rows = [(job['media_key'], job['create_time'], job['image_filename'], result['byte_size'], job['prompt_text'])
+                for job, result in zip(jobs, results) if result['success'] and job['prompt_text']]
+        if not rows:
+            return
+        try:
+            self.prompt_index.add_prompts(rows)
+        except sqlite3.Error as e:
+            print(f"  -> Failed to add {len(rows)} prompts to the prompt index: {e}")
+            if not self.prompt_files: # The prompts are not saved anywhere else, the images are downloaded again later
+                for index, (job, result) in enumerate(zip(jobs, results)):
+                    if result['success'] and job['prompt_text']:
+                        results[index] = download_result(False, error=f"prompt index failed: {e}")
+
+    def _post_process(self, job):
+        """
+        Applies the extension, re-encoded bytes and thumbnail of the post-processing to job, returns a failed result if it failed
+        """
+        try:
+            extension, image_data, job['thumbnail_data'] = self.post_processor.process(job['image_data'], job['temp_filename'], job['post_processing'])
+        except Exception as e:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+            print(f"  -> Failed to post-process image {job['media_key']}: {e}")
+            return download_result(False, error=f"post-processing failed: {e}")
+        job['image_filename'] = os.path.splitext(job['image_filename'])[0] + extension
+        if image_data is not None: # Re-encoded, the downloaded bytes are not saved
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+            job['image_data'], job['temp_filename'] = image_data, None
+        return None
+
+    def _add_to_shard(self, job):
+        media_key = job['media_key']
+        if not job['prompt_text']:
+            print(f"  -> Warning: Prompt text not found in response for {media_key}")
+        try: # The prompt index then points into the shard
+            job['image_filename'] = self.shard_writer.add(media_key, job['create_time'], job['prompt_text'] if self.prompt_files else None,
+                                                          image_data=job['image_data'], temp_filename=job['temp_filename'], sha256=job['result']['sha256'],
+                                                          extension=os.path.splitext(job['image_filename'])[1], thumbnail_data=job['thumbnail_data'])
+        except Exception as e:
+            print(f"  -> Failed to save image/prompt {media_key}: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        finally:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+        return job['result']
+
+    def _upload(self, job):
+        media_key = job['media_key']
+        try: # The prompt is uploaded first, as with loose files
+            if not job['prompt_text']:
+                print(f"  -> Warning: Prompt text not found in response for {media_key}")
+            elif self.prompt_files:
+                self.object_store.upload(job['prompt_filename'], job['prompt_text'].encode('utf-8'))
+            if job['thumbnail_data']:
+                self.object_store.upload(thumbnail_file_path(job['image_filename']), job['thumbnail_data'])
+            job['image_filename'] = self.object_store.upload(job['image_filename'], job['image_data'], job['temp_filename']) # For the prompt index
+        except Exception as e:
+            print(f"  -> Failed to save image/prompt {media_key}: {e}")
+            return download_result(False, error=f"upload failed: {e}")
+        finally:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+        return job['result']
+
+    def _write_temp_file(self, filename, data):
+        temp_filename = unique_temp_filename(filename)
+        with open(temp_filename, "xb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return temp_filename
+
+    def _write(self, job):
+        media_key = job['media_key']
+        temp_filename = job['temp_filename']
+        prompt_temp_filename = thumbnail_temp_filename = None
+        try:
+            link_filename = self._link_duplicate(job) if self.dedup else None
+            if link_filename:
+                if temp_filename:
+                    os.remove(temp_filename) # The streamed copy is not needed any more
+                temp_filename = link_filename
+            elif job['image_data'] is not None:
+                temp_filename = self._write_temp_file(job['image_filename'], job['image_data'])
+            elif self.fsync:
+                with open(temp_filename, "rb+") as f:
+                    os.fsync(f.fileno())
+            # The prompt is moved into place first, so an existing image always has its prompt next to it
+            if not job['prompt_text']:
+                print(f"  -> Warning: Prompt text not found in response for {media_key}")
+            elif self.prompt_files:
+                prompt_temp_filename = self._write_temp_file(job['prompt_filename'], job['prompt_text'].encode('utf-8'))
+                os.replace(prompt_temp_filename, job['prompt_filename'])
+            if job['thumbnail_data']: # Also before the image, so skip_existing never skips an image without its thumbnail
+                thumbnail_filename = thumbnail_file_path(job['image_filename'])
+                self.ensure_folder(os.path.dirname(thumbnail_filename))
+                thumbnail_temp_filename = self._write_temp_file(thumbnail_filename, job['thumbnail_data'])
+                os.replace(thumbnail_temp_filename, thumbnail_filename)
+            os.replace(temp_filename, job['image_filename'])
+            if link_filename and os.path.lexists(link_filename): # rename() does nothing when both names already link to the same file
+                os.remove(link_filename)
+            if self.dedup and not link_filename:
+                with self.dedup_lock:
+                    self.image_filenames_by_sha256[job['result']['sha256']] = job['image_filename']
+        except Exception as e:
+            for filename in (temp_filename, prompt_temp_filename, thumbnail_temp_filename):
+                if filename and os.path.exists(filename):
+                    os.remove(filename)
+            print(f"  -> Failed to save image/prompt {media_key}: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        return job['result']
+
+    def _link_duplicate(self, job):
+        """
+        Hard-links an already saved image with the same SHA-256 to a temporary file next to the image, returns its name or None
+        """
+        with self.dedup_lock:
+            existing_filename = self.image_filenames_by_sha256.get(job['result']['sha256'])
+        if not existing_filename or existing_filename == job['image_filename']:
+            return None
+        link_filename = unique_temp_filename(job['image_filename'], ".link.part")
+        try:
+            os.link(existing_filename, link_filename)
+        except OSError:
+            return None # The original is gone or the file system has no hard links, a normal copy is written
+        with self.dedup_lock:
+            self.deduplicated_count += 1
+        return link_filename
+
+
+class ArchiveShardWriter:
+    """
+    Appends the saved images and prompts to rolling uncompressed tar shards (imagefx-00001.tar, imagefx-00002.tar, ...) in
+    output_folder instead of loose files, so a large library is a few big files that are listed and copied as sequential bulk
+    I/O. A new shard is started once the current one reaches max_bytes or max_files images, and by every run (shards are
+    never appended to later). Inside a shard the files keep their <date>/<mediaKey>.jpg names, <shard>.index.jsonl lists the
+    offset and size of every image and prompt for random access (see read_shard_image).
+    """
+    SHARD_NAME_PATTERN = re.compile(r"imagefx-(\d+)\.tar$")
+
+    def __init__(self, output_folder, max_bytes=None, max_files=None, fsync=False):
+        self.output_folder = output_folder
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fsync = fsync
+        self.lock = threading.Lock() # All writer threads append to the same shard
+        self.tar = None
+        self.shard_filename = None
+        self.shard_file_count = 0
+        self.index_file = None
+        self.pending_index_lines = [] # Written at flush(), after the members they point to
+        os.makedirs(output_folder, exist_ok=True)
+        shard_numbers = [int(match.group(1)) for match in map(self.SHARD_NAME_PATTERN.match, os.listdir(output_folder)) if match]
+        self.next_shard_number = max(shard_numbers, default=0) + 1
+
+    def add(self, media_key, create_time, prompt_text=None, image_data=None, temp_filename=None, sha256=None, extension=".jpg",
+            thumbnail_data=None):
+        """
+        Appends the image (image_data bytes, or the file temp_filename), its prompt and its thumbnail (thumbnail_data bytes, in
+        <date>/thumbnails) to the current shard, returns the path of the image inside the shard (<shard>/<date>/<mediaKey>.jpg)
+        """
+        image_name = os.path.join(media_folder("", create_time), f"{media_key}{extension}").replace(os.sep, "/")
+        with self.lock:
+            if (self.tar is None or (self.max_bytes and self.tar.offset >= self.max_bytes)
+                    or (self.max_files and self.shard_file_count >= self.max_files)):
+                self._open_next_shard()
+            entry = {'media_key': media_key, 'create_time': create_time, 'name': image_name, 'sha256': sha256}
+            start_offset = self.tar.offset
+            try:
+                if prompt_text: # The prompt goes first, as with loose files
+                    prompt_data = prompt_text.encode('utf-8')
+                    entry['prompt_offset'], entry['prompt_size'] = self._add_member(os.path.splitext(image_name)[0] + ".txt", io.BytesIO(prompt_data), len(prompt_data))
+                if thumbnail_data:
+                    thumbnail_name = thumbnail_file_path(image_name).replace(os.sep, "/")
+                    entry['thumbnail_offset'], entry['thumbnail_size'] = self._add_member(thumbnail_name, io.BytesIO(thumbnail_data), len(thumbnail_data))
+                if image_data is not None:
+                    entry['offset'], entry['size'] = self._add_member(image_name, io.BytesIO(image_data), len(image_data))
+                else:
+                    with open(temp_filename, 'rb') as f:
+                        entry['offset'], entry['size'] = self._add_member(image_name, f, os.fstat(f.fileno()).st_size)
+            except Exception: # Drops a half written member, so the shard stays a valid tar file
+                self.tar.fileobj.seek(start_offset)
+                self.tar.fileobj.truncate()
+                self.tar.offset = start_offset
+                raise
+            self.pending_index_lines.append(json.dumps(entry) + "\n")
+            self.shard_file_count += 1
+            return os.path.join(self.shard_filename, image_name)
+
+    def _add_member(self, name, fileobj, size):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time()) # A float would add a pax header to every member
+        self.tar.addfile(tarinfo, fileobj)
+        return self.tar.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE, size # The data ends at the current offset, padded to whole blocks
+
+    def _open_next_shard(self):
+        self._close_shard()
+        self.shard_filename = os.path.join(self.output_folder, f"imagefx-{self.next_shard_number:05d}.tar")
+        self.next_shard_number += 1
+        self.tar = tarfile.open(self.shard_filename, "w")
+        self.index_file = open(self.shard_filename + ".index.jsonl", 'w', encoding='utf-8')
+        self.shard_file_count = 0
+
+    def flush(self):
+        """
+        Flushes the members added so far (and syncs them to disk with fsync=True), then their index lines, so the index never
+        lists an image that is not saved
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.tar is None:
+            return
+        self.tar.fileobj.flush()
+        if self.fsync:
+            os.fsync(self.tar.fileobj.fileno())
+        self.index_file.writelines(self.pending_index_lines)
+        self.pending_index_lines = []
+        self.index_file.flush()
+        if self.fsync:
+            os.fsync(self.index_file.fileno())
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self._flush()
+        self.tar.close() # Writes the end-of-archive blocks
+        self.index_file.close()
+        self.tar = None
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+
+class S3ObjectStore:
+    """
+    Uploads the saved images and prompts to an S3-compatible bucket (AWS S3, MinIO, ...) instead of the local disk, requires
+    boto3. The paths below root become the object keys below the prefix of url (s3://bucket/prefix), so the bucket has the
+    same <date>/<mediaKey>.jpg layout as an output folder. One pooled client is shared by all upload threads; objects larger
+    than multipart_size megabytes are uploaded as a multipart upload, several parts at a time. The credentials are taken from
+    the usual AWS environment variables or configuration files.
+    """
+    PART_CONCURRENCY = 4 # Parts of one multipart upload sent at the same time
+
+    def __init__(self, url, root, endpoint_url=None, multipart_size=8, upload_threads=2):
+        if boto3 is None:
+            raise RuntimeError("The S3 output requires boto3, please install it first: pip install boto3")
+        match = re.match(r"s3://([^/]+)/?(.*)$", url)
+        if not match:
+            raise ValueError(f"not an s3://bucket/prefix URL: {url}")
+        self.bucket = match.group(1)
+        self.prefix = match.group(2).strip("/")
+        self.root = root
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, config=BotoConfig(
+            max_pool_connections=max(10, upload_threads * self.PART_CONCURRENCY), # Keep-alive connections for every part in flight
+            retries={'max_attempts': 10, 'mode': 'adaptive'}
+        ))
+        part_size = max(int(multipart_size * 1e6), 5 * 1024 * 1024) # S3 rejects parts smaller than 5 MiB
+        self.transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=self.PART_CONCURRENCY)
+
+    def _key(self, filename):
+        relative_path = os.path.relpath(filename, self.root).replace(os.sep, "/")
+        return "/".join(part for part in (self.prefix, relative_path) if part and part != ".")
+
+    def folder_url(self, folder):
+        return f"s3://{self.bucket}/{self._key(folder)}"
+
+    def upload(self, filename, data=None, source_filename=None):
+        """
+        Uploads data (bytes), or the local file source_filename, as the object of the local path filename, returns its s3:// URL
+        """
+        key = self._key(filename)
+        extension = os.path.splitext(filename)[1]
+        extra_args = {'ContentType': IMAGE_FORMATS[extension][1] if extension in IMAGE_FORMATS else 'text/plain; charset=utf-8'}
+        if data is not None:
+            self.client.upload_fileobj(io.BytesIO(data), self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        else:
+            self.client.upload_file(source_filename, self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        return f"s3://{self.bucket}/{key}"
+
+    def list_media_keys(self, folder, extension=None, thumbnails=False):
+        """
+        Returns the mediaKeys of the images uploaded to folder and its date folders, extension and thumbnails filter them as in
+        index_downloaded_media_keys
+        """
+        folder_key = self._key(folder)
+        prefix = folder_key + "/" if folder_key else ""
+        image_names, thumbnail_names = {}, set()
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                name = item['Key'][len(prefix):]
+                media_key = image_media_key(name.rsplit("/", 1)[-1])
+                if not media_key:
+                    continue
+                if name.startswith(THUMBNAIL_FOLDER_NAME + "/") or f"/{THUMBNAIL_FOLDER_NAME}/" in name:
+                    thumbnail_names.add(name.replace(THUMBNAIL_FOLDER_NAME + "/", "", 1))
+                elif name.count("/") <= 1 and not name.startswith(PREVIEW_FOLDER_NAME + "/") and (not extension or name.endswith(extension)):
+                    image_names[name] = media_key
+        return {media_key for name, media_key in image_names.items() if not thumbnails or name in thumbnail_names}
+
+
+def build_shard_writer(output_folder, shard_size=None, shard_max_files=None, fsync=False):
+    """
+    Returns an ArchiveShardWriter for shards of shard_size megabytes and/or shard_max_files images, None if neither is set
+    """
+    if not shard_size and not shard_max_files:
+        return None
+    return ArchiveShardWriter(output_folder, shard_size * 1e6 if shard_size else None, shard_max_files, fsync)
+
+
+def read_shard_index(shard_filename):
+    """
+    Returns the index entries of an archive shard by mediaKey, an incomplete last line (from an interrupted run) is ignored
+    """
+    entries = {}
+    index_filename = shard_filename + ".index.jsonl"
+    if not os.path.exists(index_filename):
+        return entries
+    with open(index_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['media_key']] = entry
+    return entries
+
+
+def read_shard_image(shard_filename, media_key):
+    """
+    Reads the image and prompt of mediaKey straight from their offsets in an archive shard, returns (image_data, prompt_text),
+    or None if the shard does not contain mediaKey
+    """
+    entry = read_shard_index(shard_filename).get(media_key)
+    if entry is None:
+        return None
+    prompt_text = None
+    with open(shard_filename, 'rb') as f:
+        f.seek(entry['offset'])
+        image_data = f.read(entry['size'])
+        if 'prompt_offset' in entry:
+            f.seek(entry['prompt_offset'])
+            prompt_text = f.read(entry['prompt_size']).decode('utf-8')
+    return image_data, prompt_text
+
+
+def save_media_response(media_key, response_json, output_folder="imagefx_images", create_time=None, writer=None, on_complete=None):
+    """
+    Extracts the image and prompt from a media.fetchMedia response and hands them to writer to be saved in subfolders by date,
+    on_complete receives the download result
+    """
+    try:
+        result_data_json_result = response_json['result']['data']['json']['result']
+        encoded_image = result_data_json_result['image']['encodedImage']
+        prompt_text = result_data_json_result.get('image').get('prompt')
+    except (KeyError, TypeError, AttributeError) as e:
+        print(f"  -> Failed to parse media.fetchMedia response for {media_key}: {e!r}")
+        on_complete(download_result(False, error=f"invalid response: {e!r}"))
+        return
+
+    if encoded_image:
+        try:
+            decode_start_time = time.perf_counter()
+            image_data = base64.b64decode(encoded_image)
+            sha256 = hashlib.sha256(image_data).hexdigest()
+            decode_seconds = time.perf_counter() - decode_start_time
+            image_filename, prompt_filename = media_file_paths(media_key, output_folder, create_time, writer)
+        except Exception as e:
+            print(f"  -> Failed to save image/prompt {media_key}: {e}")
+            on_complete(download_result(False, error=f"save failed: {e}"))
+            return
+        result = download_result(True, byte_size=len(image_data), sha256=sha256)
+        result['timings']['decode'] = decode_seconds
+        writer.submit(media_key, image_filename, prompt_filename, prompt_text, result, on_complete, image_data=image_data, create_time=create_time)
+    else:
+        print(f"  -> Failed to download media.fetchMedia, encodedImage missing in response for {media_key}")
+        on_complete(download_result(False, error="encodedImage missing"))
+
+
+class MediaStreamDecoder:
+    """
+    Incrementally parses a media.fetchMedia response body fed in chunks. The base64 encodedImage value is decoded
+    chunk by chunk straight into a uniquely named temporary file next to image_filename (or in temp_folder, when nothing is saved next to it),
+    everything else (prompt etc.) is kept as a small JSON skeleton, so memory use is bounded by the chunk size instead of
+    several copies of the image.
+    """
+    ENCODED_IMAGE_PATTERN = re.compile(rb'"encodedImage"\s*:\s*"')
+
+    def __init__(self, image_filename, temp_folder=None):
+        self.image_filename = image_filename
+        if temp_folder: # Only uploaded from there and removed, the private permissions of mkstemp fit
+            file_descriptor, self.temp_filename = tempfile.mkstemp(suffix=".part", prefix=os.path.basename(image_filename) + ".", dir=temp_folder)
+            self.file = os.fdopen(file_descriptor, "wb")
+        else: # A unique name, so concurrent streams of the same image never write into the same file
+            self.temp_filename = unique_temp_filename(image_filename)
+            self.file = open(self.temp_filename, "xb")
+        self.skeleton = bytearray() # The response without the encodedImage value
+        self.pending_base64 = b"" # Trailing base64 characters that do not form a complete 4-character group yet
+        self.in_encoded_image = False
+        self.found_encoded_image = False
+        self.byte_size = 0
+        self.sha256 = hashlib.sha256()
+        self.decode_seconds = 0.0 # Time spent parsing and decoding, not waiting for the network
+
+    def feed(self, data):
+        decode_start_time = time.perf_counter()
+        self._feed(data)
+        self.decode_seconds += time.perf_counter() - decode_start_time
+
+    def _feed(self, data):
+        while data:
+            if self.in_encoded_image:
+                end = data.find(b'"')
+                encoded_chunk = data if end == -1 else data[:end]
+                self._decode(encoded_chunk.replace(b"\\", b"")) # JSON may escape "/" as "\/"
+                if end == -1:
+                    return
+                self.in_encoded_image = False
+                data = data[end:] # The closing quote goes back into the skeleton
+            else:
+                search_start = max(0, len(self.skeleton) - 64) # The key may be split between two chunks
+                self.skeleton += data
+                if self.found_encoded_image:
+                    return
+                match = self.ENCODED_IMAGE_PATTERN.search(self.skeleton, search_start)
+                if match is None:
+                    return
+                self.found_encoded_image = True
+                self.in_encoded_image = True
+                data = bytes(self.skeleton[match.end():])
+                del self.skeleton[match.end():]
+
+    def _decode(self, encoded_chunk):
+        encoded_data = self.pending_base64 + encoded_chunk
+        usable_length = len(encoded_data) - len(encoded_data) % 4
+        self.pending_base64 = encoded_data[usable_length:]
+        if usable_length:
+            self._write(base64.b64decode(encoded_data[:usable_length]))
+
+    def _write(self, image_data):
+        self.file.write(image_data)
+        self.sha256.update(image_data)
+        self.byte_size += len(image_data)
+
+    def finish(self):
+        """
+        Flushes the remaining base64 characters and returns the parsed JSON skeleton (encodedImage is an empty string in it)
+        """
+        if self.pending_base64:
+            decode_start_time = time.perf_counter()
+            self._write(base64.b64decode(self.pending_base64 + b"=" * (-len(self.pending_base64) % 4)))
+            self.decode_seconds += time.perf_counter() - decode_start_time
+            self.pending_base64 = b""
+        self.file.close()
+        return json.loads(self.skeleton)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+
+def finish_media_stream(media_key, decoder, prompt_filename, writer, on_complete, create_time=None):
+    """
+    Completes a MediaStreamDecoder and hands the image and prompt to writer, on_complete receives the download result
+    """
+    try:
+        response_json = decoder.finish()
+        prompt_text = response_json['result']['data']['json']['result'].get('image').get('prompt')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        decoder.abort()
+        print(f"  -> Failed to parse media.fetchMedia response for {media_key}: {e!r}")
+        on_complete(download_result(False, error=f"invalid response: {e!r}"))
+        return
+
+    if not decoder.byte_size:
+        decoder.abort()
+        print(f"  -> Failed to download media.fetchMedia, encodedImage missing in response for {media_key}")
+        on_complete(download_result(False, error="encodedImage missing"))
+        return
+
+    result = download_result(True, byte_size=decoder.byte_size, sha256=decoder.sha256.hexdigest())
+    result['timings']['decode'] = decoder.decode_seconds
+    writer.submit(media_key, decoder.image_filename, prompt_filename, prompt_text, result, on_complete, temp_filename=decoder.temp_filename,
+                  create_time=create_time)
+
+
+def stream_media_response(media_key, response, output_folder="imagefx_images", create_time=None, writer=None, on_complete=None):
+    """
+    Saves a streamed (stream=True) media.fetchMedia response with MediaStreamDecoder and writer, on_complete receives the download result
+    """
+    decoder = None
+    try:
+        image_filename, prompt_filename = media_file_paths(media_key, output_folder, create_time, writer)
+        decoder = MediaStreamDecoder(image_filename, writer.stream_temp_folder if writer else None)
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            decoder.feed(chunk)
+    except requests.exceptions.RequestException:
+        if decoder:
+            decoder.abort()
+        raise
+    except Exception as e:
+        if decoder:
+            decoder.abort()
+        print(f"  -> Failed to save image/prompt {media_key}: {e}")
+        on_complete(download_result(False, error=f"save failed: {e}"))
+        return
+    finally:
+        response.close()
+    finish_media_stream(media_key, decoder, prompt_filename, writer, on_complete, create_time)
+
+
+def download_image_and_prompt(media_key, cookies, output_folder="imagefx_images", create_time=None,
+                                     total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                                     on_thread_complete=None, session=None, streaming=False, rate_controller=None, writer=None, image_size=None): # Modified: on_thread_complete receives download result
+    """
+    Downloads the original image and prompt using mediaKey, and saves them to subfolders by date (modified version)
+    If a session is passed in (e.g. the pooled session of BatchDownloader), it is reused instead of creating a new one.
+    With streaming=True the response is decoded chunk by chunk straight to the file instead of being loaded into memory.
+    The files are saved by writer (a FileWriter), without one they are written atomically in the calling thread.
+    image_size=(height, width) requests a resized image instead of the original.
+    on_thread_complete receives the download result {'success', 'byte_size', 'sha256', 'error'} once the files are saved,
+    from a writer thread if the writer has any.
+    """
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+        session.mount("https://", HTTPAdapter(max_retries=retries))
+    if writer is None:
+        writer = FileWriter(writer_threads=0)
+    latency = None
+
+    def on_complete(result):
+        if latency is not None:
+            result['timings']['http'] = latency
+        if on_thread_complete:
+            on_thread_complete(result)
+
+    try:
+        response = session.get(FETCH_MEDIA_API_URL, params=fetch_media_params(media_key, *(image_size or ())), cookies=cookies, timeout=30, stream=streaming)
+        response.encoding = 'utf-8'
+        # Retried responses were already reported by ControlledRetry and their elapsed time includes the backoff
+        retry_history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+        latency = None if retry_history else response.elapsed.total_seconds()
+        if rate_controller:
+            rate_controller.record_response(response.status_code, latency, parse_retry_after(response.headers.get('Retry-After')))
+
+        if is_auth_failure(response.status_code, response.url):
+            response.close()
+            on_complete(download_result(False, error=f"authentication failed: HTTP {response.status_code}", auth_failed=True))
+        elif response.status_code == 200:
+            if streaming:
+                stream_media_response(media_key, response, output_folder, create_time, writer, on_complete)
+            else:
+                save_media_response(media_key, response.json(), output_folder, create_time, writer, on_complete)
 
         else:
             print(f"  -> Failed to download media.fetchMedia, status code: {response.status_code}")
             print(response.text)
+            on_complete(download_result(False, error=f"HTTP {response.status_code}"))
 
     except requests.exceptions.RequestException as e:
         print(f"  -> Request to download media.fetchMedia failed (mediaKey: {media_key}): {e}")
+        on_complete(download_result(False, error=f"request failed: {e}"))
+
+
+def download_media_batch(items, cookies, output_folder="imagefx_images", on_item_complete=None, session=None, rate_controller=None,
+                         writer=None, image_size=None):
+    """
+    Downloads several images with one tRPC batch request, which carries a media.fetchMedia call per item and is answered
+    with an array of their results in the same order. on_item_complete(item, result) receives the download result of every
+    image of the batch. Returns the items whose call failed within the batch, to be downloaded one by one, all items if the
+    request itself failed, or None if the server does not accept batch requests.
+    The response is parsed in one piece (not streamed), so it holds all images of the batch in memory at once.
+    """
+    if session is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))))
+    if writer is None:
+        writer = FileWriter(writer_threads=0)
+    try:
+        response = session.get(fetch_media_batch_url(len(items)), params=fetch_media_batch_params([item.media_key for item in items], *(image_size or ())),
+                               cookies=cookies, timeout=30)
+        retry_history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+        latency = None if retry_history else response.elapsed.total_seconds() # The round trip of the whole batch
+        if rate_controller:
+            rate_controller.record_response(response.status_code, latency, parse_retry_after(response.headers.get('Retry-After')))
+        if is_auth_failure(response.status_code, response.url):
+            for item in items:
+                on_item_complete(item, download_result(False, error=f"authentication failed: HTTP {response.status_code}", auth_failed=True))
+            return []
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = None
+    except requests.exceptions.RequestException as e:
+        print(f"  -> Batch request of media.fetchMedia failed ({len(items)} images): {e}")
+        return items
+
+    if not isinstance(response_json, list) or len(response_json) != len(items):
+        print(f"  -> Batch request of media.fetchMedia failed, status code: {response.status_code}")
+        return None if response.status_code in BATCH_UNSUPPORTED_STATUS_CODES else items
+    fallback_items = []
+    for item, item_json in zip(items, response_json):
+        if not isinstance(item_json, dict) or 'result' not in item_json: # A tRPC error of this call
+            fallback_items.append(item)
+            continue
+
+        def on_complete(result, item=item):
+            if latency is not None:
+                result['timings']['http'] = latency
+            on_item_complete(item, result)
+
+        save_media_response(item.media_key, item_json, output_folder, item.create_time, writer, on_complete)
+    if fallback_items:
+        print(f"  -> {len(fallback_items)} of {len(items)} images of the batch request failed, downloading them one by one.")
+    return fallback_items
+
+
+def print_deduplicated_count(writer):
+    if writer.deduplicated_count:
+        print(f"{writer.deduplicated_count} images were identical to an already saved image and were hard-linked instead of saved again.")
 
+
+def index_downloaded_media_keys(output_folder, extension=None, thumbnails=False):
+    """
+    Collects the mediaKeys of all images already saved in output_folder with a single os.scandir walk over the date folders,
+    including the images in the archive shards of output_folder. With extension (see converted_extension) only the images
+    saved with it count, with thumbnails only the images that have a thumbnail, so the images saved before --convert-format
+    or --thumbnail-size was used are downloaded and post-processed again.
+    """
+    media_keys = set()
+    if not os.path.isdir(output_folder):
+        return media_keys
+    thumbnail_names = {} # Folder: names in its thumbnails subfolder, listed once per folder
+
+    def saved_media_key(folder, name):
+        media_key = image_media_key(name)
+        if not media_key or (extension and not name.endswith(extension)):
+            return None
+        if thumbnails:
+            if folder not in thumbnail_names:
+                thumbnail_folder = os.path.join(folder, THUMBNAIL_FOLDER_NAME)
+                thumbnail_names[folder] = set(os.listdir(thumbnail_folder)) if os.path.isdir(thumbnail_folder) else set()
+            if name not in thumbnail_names[folder]:
+                return None
+        return media_key
+
+    with os.scandir(output_folder) as entries:
+        for entry in entries:
+            if entry.name == THUMBNAIL_FOLDER_NAME: # Thumbnails of the images saved without create_time
+                continue
+            if entry.is_dir():
+                with os.scandir(entry.path) as date_folder_entries:
+                    for date_folder_entry in date_folder_entries:
+                        media_key = saved_media_key(entry.path, date_folder_entry.name)
+                        if media_key:
+                            media_keys.add(media_key)
+            elif image_media_key(entry.name): # Images saved without create_time are in output_folder itself
+                media_key = saved_media_key(output_folder, entry.name)
+                if media_key:
+                    media_keys.add(media_key)
+            elif entry.name.endswith(".tar.index.jsonl"):
+                media_keys.update(media_key for media_key, index_entry in read_shard_index(entry.path[:-len(".index.jsonl")]).items()
+                                  if (not extension or index_entry['name'].endswith(extension))
+                                  and (not thumbnails or 'thumbnail_offset' in index_entry))
+    return media_keys
+
+
+def known_downloaded_media_keys(output_folder, state_store=None, object_store=None, extension=None, thumbnails=False):
+    """
+    Returns the mediaKeys of the images already downloaded, the known images an incremental crawl stops at: the images
+    state_store records as done, or without a state database the images saved in output_folder (or uploaded to object_store).
+    extension and thumbnails are passed on as in index_downloaded_media_keys, the state database only knows the extension.
+    """
+    if state_store:
+        return state_store.get_done_media_keys(extension)
+    if object_store:
+        return object_store.list_media_keys(output_folder, extension, thumbnails)
+    return index_downloaded_media_keys(output_folder, extension, thumbnails)
+
+
+def skip_downloaded_media_keys(media_keys_info, output_folder, object_store=None, extension=None, thumbnails=False):
+    if object_store:
+        existing_media_keys = object_store.list_media_keys(output_folder, extension, thumbnails)
+        output_folder = object_store.folder_url(output_folder)
+    else:
+        existing_media_keys = index_downloaded_media_keys(output_folder, extension, thumbnails)
+    print(f"Found {len(existing_media_keys)} images already saved in '{output_folder}', they will be skipped.")
+    remaining_media_keys_info = (item for item in media_keys_info if item.media_key not in existing_media_keys)
+    return list(remaining_media_keys_info) if isinstance(media_keys_info, list) else remaining_media_keys_info # A list stays countable for the progress
+
+
+def ask_preview_size():
+    preview_size_input = input("Download a small preview of every image first, then the originals (tiered mode)? \n"
+                               "The previews are saved in the '" + PREVIEW_FOLDER_NAME + "' subfolder and give a browsable catalog quickly, using a fraction of the bandwidth.\n"
+                               "Enter the preview size in pixels (e.g. 256), leave blank to only download the originals: ").strip()
+    return int(preview_size_input) if preview_size_input.isdigit() else None
+
+
+def download_with_previews(downloader, media_keys_info, preview_size=None):
+    """
+    Tiered download: with preview_size, first fetches a preview_size pixel preview of every image into the previews subfolder,
+    then backfills the originals in the same order (newest first). Returns the number of originals downloaded.
+    """
+    if not preview_size:
+        return downloader.download_media_keys(media_keys_info)
+    media_keys_info = list(media_keys_info) # Both passes go over the same list
+    preview_downloader = copy.copy(downloader)
+    preview_downloader.output_folder = os.path.join(downloader.output_folder, PREVIEW_FOLDER_NAME)
+    preview_downloader.image_size = (preview_size, preview_size)
+    preview_downloader.state_store = None # The download state only tracks the originals
+    preview_downloader.skip_existing = True # Previews of an earlier run are not fetched again
+    preview_downloader.success_count = 0
+    preview_downloader.failure_count = 0
+    preview_downloader.failed_keys_file = None # The report lists the originals
+    preview_downloader.prompt_index = None # The prompt index lists the originals as well
+    print(f"Tiered mode: downloading {preview_size}px previews of {len(media_keys_info)} images first...")
+    preview_downloader.download_media_keys(media_keys_info)
+    print("Previews done, downloading the originals...")
+    return downloader.download_media_keys(media_keys_info)
+
+
+def create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store=None, auth_monitor=None,
+                      prompt_index=None):
+    """
+    Asks which download engine to use and creates the corresponding downloader
+    """
+    skip_existing_input = input("Skip images that already exist in the output folder? (yes/no, default: no): ").lower()
+    skip_existing = skip_existing_input in ['yes', 'y']
+    fsync_input = input("Flush every saved file to disk with fsync (slower, but no saved image is lost on a power failure)? (yes/no, default: no): ").lower()
+    fsync = fsync_input in ['yes', 'y']
+    dedup_input = input("Hard-link images identical to an already saved image instead of saving another copy (deduplication)? (yes/no, default: no): ").lower()
+    dedup = dedup_input in ['yes', 'y']
+    adaptive_input = input("Adjust the number of concurrent downloads automatically based on server responses (adaptive rate control)? \n"
+                           "The thread limit (or the in-flight limit of the async engine) becomes the upper limit, concurrency is lowered on 429/503 or slow responses (yes/no, default: no): ").lower()
+    adaptive = adaptive_input in ['yes', 'y']
+    engine_input = input("Choose the download engine: 'threads' or 'async' (async requires aiohttp and suits hundreds of concurrent requests) (default: threads): ").strip().lower()
+    engine = 'async' if engine_input == 'async' else 'threads'
+    max_concurrency = 100
+    if engine == 'async' and aiohttp is not None:
+        max_concurrency_input = input(f"Enter the maximum number of requests in flight (default: {max_concurrency}): ")
+        if max_concurrency_input.isdigit():
+            max_concurrency = int(max_concurrency_input)
+    return build_downloader(
+        cookies, output_folder,
+        engine=engine,
+        max_threads=max_threads,
+        max_concurrency=max_concurrency,
+        adaptive=adaptive,
+        total_retries=total_retries, backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        state_store=state_store,
+        skip_existing=skip_existing,
+        fsync=fsync,
+        dedup=dedup,
+        failed_keys_file="failed_media_keys.jsonl",
+        auth_monitor=auth_monitor,
+        prompt_index=prompt_index
+    )
+
+
+def build_downloader(cookies, output_folder, engine='threads', max_threads=10, max_concurrency=100, adaptive=False,
+                     total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), state_store=None,
+                     skip_existing=False, fsync=False, dedup=False, writer_threads=2, shared_limiter=None, max_attempts=3, retry_delay=10,
+                     failed_keys_file=None, auth_monitor=None, batch_size=1, prompt_index=None, prompt_files=True, shard_size=None,
+                     shard_max_files=None, s3_url=None, s3_endpoint_url=None, s3_multipart_size=8, detect_format=False, convert_format=None,
+                     image_quality=90, thumbnail_size=None, post_processes=None):
+    """
+    Creates the downloader of the given engine ('threads' or 'async') without asking anything. batch_size > 1 fetches that
+    many images per tRPC batch request (threads engine only, the async engine hides round trips with concurrency instead).
+    With s3_url (s3://bucket/prefix) the images and prompts are uploaded to that bucket instead of saved in output_folder
+    (see S3ObjectStore). detect_format, convert_format, image_quality, thumbnail_size and post_processes configure the
+    post-processing of the images (see ImagePostProcessor).
+    """
+    object_store = S3ObjectStore(s3_url, output_folder, s3_endpoint_url, s3_multipart_size, writer_threads) if s3_url else None
+    if engine == 'async':
+        if aiohttp is None:
+            print("aiohttp is not installed, falling back to the multi-threaded engine. Install it with: pip install aiohttp")
+        else:
+            if batch_size > 1: # Rejected by load_options, library callers only get a warning
+                print(f"The async engine does not batch requests, batch_size {batch_size} is ignored.")
+            return AsyncBatchDownloader(
+                cookies, output_folder,
+                total_retries=total_retries, backoff_factor=backoff_factor,
+                status_forcelist=status_forcelist,
+                max_concurrency=max_concurrency,
+                state_store=state_store,
+                skip_existing=skip_existing,
+                fsync=fsync,
+                dedup=dedup,
+                writer_threads=writer_threads,
+                rate_controller=AdaptiveRateController(max_concurrency) if adaptive else None,
+                shared_limiter=shared_limiter,
+                max_attempts=max_attempts,
+                retry_delay=retry_delay,
+                failed_keys_file=failed_keys_file,
+                auth_monitor=auth_monitor,
+                prompt_index=prompt_index,
+                prompt_files=prompt_files,
+                shard_size=shard_size,
+                shard_max_files=shard_max_files,
+                object_store=object_store,
+                detect_format=detect_format,
+                convert_format=convert_format,
+                image_quality=image_quality,
+                thumbnail_size=thumbnail_size,
+                post_processes=post_processes
+            )
+    return BatchDownloader(
+        cookies, output_folder,
+        total_retries=total_retries, backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        max_threads=max_threads,
+        state_store=state_store,
+        skip_existing=skip_existing,
+        fsync=fsync,
+        dedup=dedup,
+        writer_threads=writer_threads,
+        rate_controller=AdaptiveRateController(max_threads) if adaptive else None,
+        shared_limiter=shared_limiter,
+        max_attempts=max_attempts,
+        retry_delay=retry_delay,
+        failed_keys_file=failed_keys_file,
+        auth_monitor=auth_monitor,
+        batch_size=batch_size,
+        prompt_index=prompt_index,
+        prompt_files=prompt_files,
+        shard_size=shard_size,
+        shard_max_files=shard_max_files,
+        object_store=object_store,
+        detect_format=detect_format,
+        convert_format=convert_format,
+        image_quality=image_quality,
+        thumbnail_size=thumbnail_size,
+        post_processes=post_processes
+    )
+
+
+class MediaKeyInfo:
+    """
+    One crawled image, a __slots__ record instead of a dict so that long histories stay small in memory
+    """
+    __slots__ = ('media_key', 'create_time')
+
+    def __init__(self, media_key, create_time=None):
+        self.media_key = media_key
+        self.create_time = create_time
+
+    def __repr__(self):
+        return f"MediaKeyInfo({self.media_key!r}, {self.create_time!r})"
+
+    def to_dict(self):
+        return {'media_key': self.media_key, 'create_time': self.create_time}
+
+
+def iter_crawl_result(crawl_result_file):
+    """
+    Yields the MediaKeyInfo records of a crawl result file lazily, in crawl order. Reads the JSON Lines crawl log as well as
+    the JSON array written by older versions; an incomplete last line (from an interrupted crawl) is ignored.
+    """
+    if not os.path.exists(crawl_result_file):
+        return
+    with open(crawl_result_file, 'r', encoding='utf-8') as f:
+        if f.read(1) == "[":
+            f.seek(0)
+            for item in json.load(f):
+                yield MediaKeyInfo(item['media_key'], item.get('create_time'))
+            return
+        f.seek(0)
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'media_key' in entry: # Checkpoint lines only hold the cursor
+                yield MediaKeyInfo(entry['media_key'], entry.get('create_time'))
+
+
+def crawl_resume_point(crawl_result_file):
+    """
+    Returns (cursor, crawled_count, after) of the last checkpoint of crawl_result_file if that crawl stopped early (a page
+    request failed, the program was stopped or max_keys was reached), None if it ended or there is no checkpoint.
+    after is the last mediaKey taken from the page of cursor when max_keys cut that page short, None otherwise.
+    """
+    if not os.path.exists(crawl_result_file):
+        return None
+    checkpoint = None
+    with open(crawl_result_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('{"cursor"'): # Only the checkpoint lines are parsed
+                try:
+                    checkpoint = json.loads(line)
+                except ValueError:
+                    pass
+    if not checkpoint or not (checkpoint.get('cursor') or checkpoint.get('after')):
+        return None
+    return checkpoint['cursor'], checkpoint.get('crawled') or 0, checkpoint.get('after')
+
+
+class CrawlLog:
+    """
+    Append-only JSON Lines crawl result file, written page by page while crawling: one compact
+    {"media_key", "create_time"} line per image, then a {"cursor", "crawled"} checkpoint line with the nextPageToken the
+    crawl continues from ("" once it has ended) and the number of links crawled so far, plus "after" (the last mediaKey taken)
+    when max_keys stopped the crawl in the middle of the page of cursor. An interrupted crawl loses at most the page that was being written.
+    A mediaKey that is already in the log is not written again (an incremental sync crawls the images that are still pending
+    or failed again). With append=False the previous content is replaced, but only once the first page arrives.
+    """
+    def __init__(self, crawl_result_file, append=True):
+        self.crawl_result_file = crawl_result_file
+        self.append = append
+        self.file = None
+        self.written_count = 0
+        self.media_keys = set() # The mediaKeys in the log, read from the existing file before the first page is appended
+
+    def append_page(self, page, cursor, crawled_count=None, after=None):
+        if self.file is None:
+            if self.append:
+                self._repair()
+                self.media_keys.update(item.media_key for item in iter_crawl_result(self.crawl_result_file))
+            self.file = open(self.crawl_result_file, 'a' if self.append else 'w', encoding='utf-8')
+        page = [item for item in page if item.media_key not in self.media_keys]
+        self.media_keys.update(item.media_key for item in page)
+        lines = [json.dumps(item.to_dict(), ensure_ascii=False, separators=(",", ":")) for item in page]
+        checkpoint = {'cursor': cursor, 'crawled': crawled_count}
+        if after:
+            checkpoint['after'] = after
+        lines.append(json.dumps(checkpoint, separators=(",", ":")))
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush() # One write and flush per page, so the page and its checkpoint land together
+        self.written_count += len(page)
+
+    def _repair(self):
+        # Converts the JSON array of older versions to JSON Lines, and cuts off an incomplete last line so appending starts on a new line
+        if not os.path.exists(self.crawl_result_file):
+            return
+        with open(self.crawl_result_file, 'rb+') as f:
+            is_json_array = f.read(1) == b"["
+            size = f.seek(0, os.SEEK_END)
+            if not is_json_array and size:
+                f.seek(max(0, size - 65536))
+                tail = f.read()
+                if not tail.endswith(b"\n"):
+                    f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+        if is_json_array:
+            temp_filename = self.crawl_result_file + ".part"
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                for item in iter_crawl_result(self.crawl_result_file):
+                    f.write(json.dumps(item.to_dict(), ensure_ascii=False, separators=(",", ":")) + "\n")
+            os.replace(temp_filename, self.crawl_result_file)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.written_count:
+            print(f"Successfully saved {self.written_count} crawled image links to file '{self.crawl_result_file}'.")
+
+
+# --- Library API: crawl(), download() and sync() run without prompts and return their results, for scripts and schedulers ---
+
+DOWNLOADER_OPTION_NAMES = ('engine', 'max_threads', 'max_concurrency', 'adaptive', 'total_retries', 'backoff_factor', 'status_forcelist',
+                           'skip_existing', 'fsync', 'dedup', 'writer_threads', 'max_attempts', 'retry_delay', 'failed_keys_file',
+                           'batch_size', 'prompt_files', 'shard_size', 'shard_max_files', 's3_url', 's3_endpoint_url', 's3_multipart_size',
+                           'detect_format', 'convert_format', 'image_quality', 'thumbnail_size', 'post_processes')
+RETRY_OPTION_NAMES = ('total_retries', 'backoff_factor', 'status_forcelist')
+REPORT_OPTION_NAMES = ('metrics_file', 'metrics_interval', 'progress_bar', 'prometheus_port')
+AUTH_OPTION_NAMES = ('cookie_file', 'auth_wait_time')
+SYNC_OPTION_NAMES = ('output_folder', 'crawl_result_file', 'state_db_file', 'incremental', 'streaming', 'max_keys', 'page_size', 'page_sleep_time',
+                     'stop_after_known', 'preview_size', 'resume_crawl', 'prompt_index_file')
+
+
+def crawl(cookie, max_keys=None, page_size=100, page_sleep_time=1, known_media_keys=None, stop_after_known=12,
+          total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), crawl_result_file=None, resume_crawl=False,
+          cookie_file=None, auth_wait_time=3600):
+    """
+    Crawls the image history of the account behind cookie, returns a list of MediaKeyInfo records, newest first.
+    With known_media_keys (e.g. known_downloaded_media_keys()), those are skipped and the crawl stops after stop_after_known of them in a row.
+    With crawl_result_file, the links are also written to that file page by page (replacing its previous content). With
+    resume_crawl, a crawl of that file that stopped early (interrupted, or cut short by max_keys) is continued from its last
+    checkpoint and only the new links are returned.
+    When the cookie expires, the crawl waits up to auth_wait_time seconds for a new cookie in cookie_file (see AuthMonitor).
+    """
+    resume_point = crawl_resume_point(crawl_result_file) if crawl_result_file and resume_crawl else None
+    cookies = {'Cookie': cookie}
+    media_keys_crawler = MediaKeyCrawler(
+        cookies, max_keys,
+        total_retries=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+        page_sleep_time=page_sleep_time,
+        page_size=page_size,
+        known_media_keys=known_media_keys,
+        stop_after_known=stop_after_known,
+        crawl_log=CrawlLog(crawl_result_file, append=bool(resume_point)) if crawl_result_file else None,
+        resume_point=resume_point,
+        auth_monitor=AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time)
+    )
+    try:
+        return media_keys_crawler.get_all_media_keys_info()
     finally:
-        if on_thread_complete:
-            on_thread_complete(success) # Modified: Pass the download result to the callback function
+        if media_keys_crawler.crawl_log:
+            media_keys_crawler.crawl_log.close()
+
+
+def download(cookie, media_keys_info, output_folder="imagefx_images", state_db_file="download_state.db", resume=True, preview_size=None,
+             prompt_index_file="prompt_index.db", cookie_file=None, auth_wait_time=3600, **downloader_options):
+    """
+    Downloads the images of media_keys_info (MediaKeyInfo records, e.g. from iter_crawl_result(), consumed lazily)
+    into output_folder. With resume, images that state_db_file records as
+    downloaded are skipped (state_db_file=None disables the state database). downloader_options are passed to build_downloader,
+    except the MetricsReporter options (metrics_file, metrics_interval, progress_bar, prometheus_port). The prompts are
+    also written to the searchable prompt index prompt_index_file (see PromptIndex, None disables it). When the cookie
+    expires, the downloads pause for up to auth_wait_time seconds until cookie_file holds a new cookie (see AuthMonitor).
+    Returns {'downloaded', 'failed', 'skipped', 'seconds'}.
+    """
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    report_options = {name: downloader_options.pop(name) for name in REPORT_OPTION_NAMES if name in downloader_options}
+    state_store = DownloadStateStore(state_db_file) if state_db_file else None
+    prompt_index = PromptIndex(prompt_index_file) if prompt_index_file else None
+    skipped_count = 0
+    reporter = None
+    try:
+        if state_store and resume:
+            done_media_keys = state_store.get_done_media_keys(converted_extension(downloader_options.get('convert_format')))
+
+            def pending_media_keys_info(media_keys_info=media_keys_info):
+                nonlocal skipped_count
+                for item in media_keys_info:
+                    if item.media_key in done_media_keys:
+                        skipped_count += 1
+                    else:
+                        yield item
+
+            media_keys_info = pending_media_keys_info()
+        cookies = {'Cookie': cookie}
+        downloader = build_downloader(cookies, output_folder, state_store=state_store, prompt_index=prompt_index,
+                                      auth_monitor=AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time), **downloader_options)
+        reporter = MetricsReporter(downloader.metrics, **report_options)
+        reporter.start()
+        download_with_previews(downloader, media_keys_info, preview_size)
+    finally:
+        if reporter:
+            reporter.stop()
+        if state_store:
+            state_store.close()
+        if prompt_index:
+            prompt_index.close()
+    return {'downloaded': downloader.success_count, 'failed': downloader.failure_count, 'skipped': skipped_count,
+            'seconds': time.time() - start_time}
+
+
+def sync(cookie, output_folder="imagefx_images", crawl_result_file="media_keys_crawl_result.json", state_db_file="download_state.db",
+         incremental=True, streaming=True, max_keys=None, page_size=100, page_sleep_time=1, stop_after_known=12, preview_size=None,
+         resume_crawl=True, prompt_index_file="prompt_index.db", cookie_file=None, auth_wait_time=3600, **downloader_options):
+    """
+    Crawls the history and downloads the new images, appending the new links to crawl_result_file page by page. With
+    incremental, the images state_db_file records as downloaded are known images and the crawl stops at them, otherwise the
+    file is replaced. The images an earlier run queued but did not download (pending or failed) are downloaded again.
+    With streaming, downloading starts while the crawl is still running (not combined with preview_size, which needs the
+    whole list first). With resume_crawl, a crawl that stopped early (interrupted, or cut short by max_keys) continues from
+    its last checkpoint instead of starting over (the images added since then are picked up by the next incremental sync).
+    prompt_index_file, cookie_file and auth_wait_time and the downloader_options are handled as in download().
+    Returns {'crawled', 'downloaded', 'failed', 'seconds'}.
+    """
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    report_options = {name: downloader_options.pop(name) for name in REPORT_OPTION_NAMES if name in downloader_options}
+    checkpoint = crawl_resume_point(crawl_result_file) if resume_crawl or incremental else None
+    resume_point = checkpoint if resume_crawl else None
+    crawl_log = CrawlLog(crawl_result_file, append=incremental or bool(resume_point))
+    cookies = {'Cookie': cookie} # Shared by the crawler and the downloader, so a reloaded cookie is used by both
+    auth_monitor = AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time)
+    state_store = DownloadStateStore(state_db_file) if state_db_file else None
+    prompt_index = PromptIndex(prompt_index_file) if prompt_index_file else None
+    reporter = None
+    try:
+        downloader = build_downloader(cookies, output_folder, state_store=state_store, prompt_index=prompt_index, auth_monitor=auth_monitor,
+                                      **downloader_options)
+        known_media_keys = known_downloaded_media_keys(output_folder, state_store, downloader.object_store, converted_extension(downloader.convert_format),
+                                                       bool(downloader.thumbnail_size)) if incremental else None
+        media_keys_crawler = MediaKeyCrawler(
+            cookies, max_keys,
+            page_sleep_time=page_sleep_time,
+            page_size=page_size,
+            known_media_keys=known_media_keys,
+            stop_after_known=stop_after_known,
+            crawl_log=crawl_log,
+            resume_point=resume_point,
+            pending_checkpoint=None if resume_crawl else checkpoint, # Still continued by a later run with resume_crawl
+            auth_monitor=auth_monitor,
+            **{name: downloader_options[name] for name in RETRY_OPTION_NAMES if name in downloader_options}
+        )
+        # Not downloaded by an earlier run (failed, or the run was stopped), downloaded after the new images
+        retry_items = state_store.get_unfinished_media_keys_info() if state_store else []
+        retry_media_keys = {item.media_key for item in retry_items}
+        if retry_items:
+            print(f"{len(retry_items)} images that an earlier run did not download are queued again.")
+        reporter = MetricsReporter(downloader.metrics, **report_options)
+        reporter.start()
+        if streaming and not preview_size:
+            media_keys_crawler.rate_controller = downloader.rate_controller
+            new_items = (item for item in media_keys_crawler.iter_media_keys_info() if item.media_key not in retry_media_keys)
+            downloader.download_media_keys(itertools.chain(new_items, retry_items))
+        else:
+            media_keys_info = [item for item in media_keys_crawler.get_all_media_keys_info() if item.media_key not in retry_media_keys] + retry_items
+            if media_keys_info:
+                download_with_previews(downloader, media_keys_info, preview_size)
+    finally:
+        if reporter:
+            reporter.stop()
+        if state_store:
+            state_store.close()
+        if prompt_index:
+            prompt_index.close()
+        crawl_log.close()
+    return {'crawled': crawl_log.written_count, 'downloaded': downloader.success_count, 'failed': downloader.failure_count,
+            'seconds': time.time() - start_time}
+
+
+def sync_accounts(accounts, max_total_concurrency=None, max_bandwidth=None):
+    """
+    Syncs several accounts at the same time, so the whole backup takes about as long as the largest account. Every account
+    is a dict of sync() arguments (cookie, output_folder, ... and downloader options such as max_threads or adaptive, which
+    are the limits of that account) plus an optional name. max_total_concurrency caps the requests in flight of all accounts
+    together and max_bandwidth their saved megabytes per second.
+    Returns {'accounts': {name: result of sync(), or {'error': ...}}, 'downloaded', 'failed', 'failed_accounts', 'seconds'}.
+    """
+    start_time = time.time()
+    shared_limiter = SharedLimiter(max_total_concurrency, max_bandwidth * 1e6 if max_bandwidth else None)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(accounts))) as executor:
+        futures = {}
+        for index, account in enumerate(accounts):
+            account = dict(account)
+            name = account.pop('name', None) or account.get('output_folder') or f"account{index + 1}"
+            print(f"Account '{name}': starting the sync into '{account.get('output_folder', 'imagefx_images')}'.")
+            futures[name] = executor.submit(sync, shared_limiter=shared_limiter, **account)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e: # One account failing (e.g. an expired cookie) does not stop the others
+                print(f"Account '{name}' failed: {e!r}")
+                results[name] = {'error': repr(e)}
+    for name, result in results.items():
+        if 'error' not in result:
+            print(f"Account '{name}': {result['crawled']} new links crawled, {result['downloaded']} images downloaded, {result['failed']} failed.")
+    return {
+        'accounts': results,
+        'downloaded': sum(result.get('downloaded', 0) for result in results.values()),
+        'failed': sum(result.get('failed', 0) for result in results.values()),
+        'failed_accounts': sum('error' in result for result in results.values()),
+        'seconds': time.time() - start_time,
+    }
+
+
+def index_prompt_files(output_folder="imagefx_images", prompt_index_file="prompt_index.db", crawl_result_file=None):
+    """
+    Adds the images of output_folder that have a prompt .txt file but are not in prompt_index_file yet (e.g. saved by older
+    versions) to the prompt index, with their creation times from crawl_result_file. Returns the number of prompts added.
+    """
+    create_times = {item.media_key: item.create_time for item in iter_crawl_result(crawl_result_file)} if crawl_result_file else {}
+    prompt_index = PromptIndex(prompt_index_file)
+    added_count = 0
+    try:
+        indexed_media_keys = prompt_index.get_media_keys()
+        folders = []
+        if os.path.isdir(output_folder):
+            with os.scandir(output_folder) as entries: # The date folders, not the previews
+                folders = [output_folder] + [entry.path for entry in entries if entry.is_dir() and entry.name != PREVIEW_FOLDER_NAME]
+        rows = []
+        for folder in folders:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    media_key = image_media_key(entry.name)
+                    if not media_key or media_key in indexed_media_keys:
+                        continue
+                    try:
+                        with open(os.path.join(folder, f"{media_key}.txt"), 'r', encoding='utf-8') as f:
+                            prompt_text = f.read()
+                    except OSError: # No prompt file next to this image
+                        continue
+                    rows.append((media_key, create_times.get(media_key), entry.path, entry.stat().st_size, prompt_text))
+                    if len(rows) >= 500:
+                        prompt_index.add_prompts(rows)
+                        added_count += len(rows)
+                        rows = []
+        if rows:
+            prompt_index.add_prompts(rows)
+            added_count += len(rows)
+    finally:
+        prompt_index.close()
+    return added_count
+
+
+def search_prompts(query, prompt_index_file="prompt_index.db", max_results=100):
+    """
+    Returns the images of prompt_index_file whose prompt contains every word of query, newest first (see PromptIndex.search)
+    """
+    prompt_index = PromptIndex(prompt_index_file)
+    try:
+        return prompt_index.search(query, max_results)
+    finally:
+        prompt_index.close()
+
+
+# --- Command line: python "ImageFX downloader - en.py" {crawl,download,sync,index,search} [options], without arguments the prompts are used ---
+
+DEFAULT_OPTIONS = {
+    'cookie': None,
+    'cookie_file': None,
+    'auth_wait_time': 3600,
+    'output_folder': "imagefx_images",
+    'crawl_result_file': "media_keys_crawl_result.json",
+    'state_db_file': "download_state.db",
+    'prompt_index_file': "prompt_index.db",
+    'max_keys': None,
+    'total_retries': 10,
+    'backoff_factor': 1,
+    'status_forcelist': (429, 500, 502, 503, 504),
+    'page_sleep_time': 1,
+    'page_size': 100,
+    'stop_after_known': 12,
+    'incremental': True,
+    'streaming': True,
+    'resume': True,
+    'resume_crawl': True,
+    'preview_size': None,
+    'engine': 'threads',
+    'max_threads': 10,
+    'max_concurrency': 100,
+    'writer_threads': 2,
+    'adaptive': False,
+    'skip_existing': False,
+    'fsync': False,
+    'dedup': False,
+    'max_attempts': 3,
+    'retry_delay': 10,
+    'failed_keys_file': "failed_media_keys.jsonl",
+    'batch_size': 1,
+    'prompt_files': True,
+    'shard_size': None,
+    'shard_max_files': None,
+    's3_url': None,
+    's3_endpoint_url': None,
+    's3_multipart_size': 8,
+    'detect_format': False,
+    'convert_format': None,
+    'image_quality': 90,
+    'thumbnail_size': None,
+    'post_processes': None,
+    'json': False,
+    'progress_bar': False,
+    'metrics_file': None,
+    'metrics_interval': 10,
+    'prometheus_port': None,
+    'accounts': None,
+    'max_total_concurrency': None,
+    'max_bandwidth': None,
+    'query': None,
+    'max_results': 100,
+}
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'on'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'no', 'n', 'off', ''):
+        return False
+    raise ValueError(f"not a yes/no value: {value!r}")
+
+
+def parse_status_codes(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(int(code) for code in value)
+
+
+OPTION_TYPES = {
+    'cookie': str, 'cookie_file': str, 'output_folder': str, 'crawl_result_file': str, 'state_db_file': str, 'engine': str,
+    'prompt_index_file': str, 'query': str, 'max_results': int, 'shard_size': float, 'shard_max_files': int,
+    's3_url': str, 's3_endpoint_url': str, 's3_multipart_size': float, 'convert_format': str, 'image_quality': int, 'thumbnail_size': int,
+    'post_processes': int,
+    'max_keys': int, 'total_retries': int, 'page_size': int, 'stop_after_known': int, 'preview_size': int,
+    'max_threads': int, 'max_concurrency': int, 'writer_threads': int, 'max_attempts': int, 'batch_size': int,
+    'backoff_factor': float, 'page_sleep_time': float, 'retry_delay': float, 'failed_keys_file': str, 'auth_wait_time': float,
+    'status_forcelist': parse_status_codes,
+    'incremental': parse_bool, 'streaming': parse_bool, 'resume': parse_bool, 'resume_crawl': parse_bool, 'adaptive': parse_bool, 'skip_existing': parse_bool,
+    'fsync': parse_bool, 'dedup': parse_bool, 'prompt_files': parse_bool, 'detect_format': parse_bool, 'json': parse_bool,
+    'progress_bar': parse_bool, 'metrics_file': str, 'metrics_interval': float, 'prometheus_port': int,
+    'accounts': str, 'max_total_concurrency': int, 'max_bandwidth': float,
+}
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Downloads your Google ImageFX images and prompts without prompts. Every option can also be set in a JSON config file (--config) or as an IMAGEFX_<OPTION> environment variable, e.g. IMAGEFX_COOKIE, IMAGEFX_MAX_THREADS. Precedence: command line > environment > config file > defaults.",
+        argument_default=argparse.SUPPRESS # Only options that are actually given override the environment and the config file
+    )
+    parser.add_argument("command", choices=['crawl', 'download', 'sync', 'index', 'search'],
+                        help="crawl: save the links to the crawl result file; download: download the links of the crawl result file; sync: crawl the new images and download them; "
+                             "index: add the prompt .txt files of the output folder to the prompt index; search: list the images whose prompt contains every word of QUERY")
+    parser.add_argument("query", nargs='*', help="search: the words to look for, e.g. red fox")
+    parser.add_argument("--config", help="JSON file with options, keys as in the long option names with underscores (e.g. max_threads)")
+    parser.add_argument("--cookie", help="Cookie string of labs.google (prefer --cookie-file or IMAGEFX_COOKIE, command lines are visible to other users)")
+    parser.add_argument("--cookie-file", help="file that contains the Cookie string, read again when the cookie expires during a run")
+    parser.add_argument("--auth-wait-time", type=float, help="seconds to wait for a new cookie in --cookie-file when the cookie expires during a run (default: 3600)")
+    parser.add_argument("--output-folder", help="default: imagefx_images")
+    parser.add_argument("--crawl-result-file", help="JSON Lines crawl log, default: media_keys_crawl_result.json (the name is kept from the JSON array format of older versions)")
+    parser.add_argument("--state-db-file", help="download state database, default: download_state.db")
+    parser.add_argument("--prompt-index-file", help="searchable SQLite database of the prompts, default: prompt_index.db ('' to disable)")
+    parser.add_argument("--prompt-files", action=argparse.BooleanOptionalAction, help="also save every prompt as a .txt file next to its image (default: on)")
+    parser.add_argument("--max-results", type=int, help="search: maximum number of images listed, 0 for all (default: 100)")
+    parser.add_argument("--max-keys", type=int, help="maximum number of links to crawl in one run, the next run continues the crawl (see --resume-crawl)")
+    parser.add_argument("--total-retries", type=int, help="default: 10")
+    parser.add_argument("--backoff-factor", type=float, help="default: 1")
+    parser.add_argument("--status-forcelist", type=parse_status_codes, help="status codes to retry, default: 429,500,502,503,504")
+    parser.add_argument("--page-sleep-time", type=float, help="seconds between two pages of the crawl, default: 1")
+    parser.add_argument("--page-size", type=int, help="links per page, halved automatically until accepted, default: 100")
+    parser.add_argument("--stop-after-known", type=int, help="incremental sync stops after this many known images in a row, default: 12")
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, help="sync: only crawl images newer than the images already downloaded (default: on)")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, help="sync: download while crawling (default: on)")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, help="download: skip images the state database records as downloaded (default: on)")
+    parser.add_argument("--resume-crawl", action=argparse.BooleanOptionalAction, help="crawl/sync: continue an interrupted crawl from its last saved page (default: on)")
+    parser.add_argument("--preview-size", type=int, help="tiered mode: download previews of this many pixels first, then the originals")
+    parser.add_argument("--engine", choices=['threads', 'async'], help="download engine, default: threads")
+    parser.add_argument("--max-threads", type=int, help="download threads of the threads engine, default: 10")
+    parser.add_argument("--max-concurrency", type=int, help="requests in flight of the async engine, default: 100")
+    parser.add_argument("--writer-threads", type=int, help="file writer threads, default: 2")
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, help="adaptive rate control (default: off)")
+    parser.add_argument("--skip-existing", action=argparse.BooleanOptionalAction, help="skip images already in the output folder (default: off)")
+    parser.add_argument("--fsync", action=argparse.BooleanOptionalAction, help="fsync every saved file (default: off)")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, help="hard-link identical images (default: off)")
+    parser.add_argument("--batch-size", type=int, help="threads engine: images fetched per tRPC batch request (default: 1, no batching; invalid with --engine async)")
+    parser.add_argument("--shard-size", type=float, help="append the images and prompts to rolling tar shards of this many megabytes, each with a .index.jsonl offset index, instead of loose files (default: off)")
+    parser.add_argument("--shard-max-files", type=int, help="start a new tar shard after this many images (also turns the shards on)")
+    parser.add_argument("--s3-url", help="upload the images and prompts to this S3-compatible bucket instead of the output folder, e.g. s3://backup/imagefx (requires boto3, credentials from the AWS_* environment variables)")
+    parser.add_argument("--s3-endpoint-url", help="endpoint of an S3-compatible server other than AWS, e.g. http://127.0.0.1:9000 for MinIO")
+    parser.add_argument("--s3-multipart-size", type=float, help="objects larger than this many megabytes are uploaded in parts of this size (default: 8)")
+    parser.add_argument("--detect-format", action=argparse.BooleanOptionalAction, help="save every image with the extension of its real format (.jpg, .png, .webp or .gif, detected from its first bytes) instead of always .jpg (default: off)")
+    parser.add_argument("--convert-format", choices=['jpg', 'png', 'webp'], help="re-encode the images to this format before saving them (requires Pillow, also turns --detect-format on)")
+    parser.add_argument("--image-quality", type=int, help="quality of --convert-format and the thumbnails, 1-100 (default: 90)")
+    parser.add_argument("--thumbnail-size", type=int, help="also save a thumbnail of at most this many pixels in a thumbnails subfolder next to every image (requires Pillow)")
+    parser.add_argument("--post-processes", type=int, help="worker processes that re-encode the images and create the thumbnails (default: one per CPU core)")
+    parser.add_argument("--max-attempts", type=int, help="attempts per image, failed images are retried at the end of the queue (default: 3)")
+    parser.add_argument("--retry-delay", type=float, help="seconds before the first deferred retry of a failed image, doubled for every further attempt (default: 10)")
+    parser.add_argument("--failed-keys-file", help="report of the images that failed for good, default: failed_media_keys.jsonl")
+    parser.add_argument("--json", action=argparse.BooleanOptionalAction, help="print the result as a JSON line at the end")
+    parser.add_argument("--progress-bar", action=argparse.BooleanOptionalAction, help="show a progress bar with ETA instead of the periodic progress lines (default: off)")
+    parser.add_argument("--metrics-file", help="append a JSON line of metrics (throughput, stage latencies, queue depths, retries) to this file every --metrics-interval seconds, '-' for the console")
+    parser.add_argument("--metrics-interval", type=float, help="default: 10")
+    parser.add_argument("--prometheus-port", type=int, help="serve the metrics for Prometheus on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--accounts", help='sync: sync all account profiles of this JSON file at the same time, e.g. [{"name": "work", "cookie_file": "work.txt", "max_threads": 4}]')
+    parser.add_argument("--max-total-concurrency", type=int, help="--accounts: requests in flight of all accounts together (default: no limit)")
+    parser.add_argument("--max-bandwidth", type=float, help="--accounts: saved megabytes per second of all accounts together (default: no limit)")
+    return parser
+
+
+def check_optional_dependencies(options):
+    """
+    Raises a ValueError naming the package to install when options need an optional package that is not installed
+    """
+    if (options.get('convert_format') or options.get('thumbnail_size')) and Image is None:
+        raise ValueError("convert_format and thumbnail_size require Pillow, please install it first: pip install Pillow")
+    if options.get('s3_url') and boto3 is None:
+        raise ValueError("s3_url requires boto3, please install it first: pip install boto3")
+
+
+def check_option_conflicts(options):
+    """
+    Raises a ValueError when options combine settings that cannot be used together
+    """
+    if options.get('s3_url') and (options.get('shard_size') or options.get('shard_max_files')):
+        raise ValueError("the archive shards are written to the output folder and cannot be combined with s3_url")
+    if options.get('engine') == 'async' and (options.get('batch_size') or 1) > 1:
+        raise ValueError("batch_size only applies to the threads engine, the async engine does not batch requests")
+
+
+def load_options(args, environ=None):
+    """
+    Merges the options: command line arguments > IMAGEFX_* environment variables > config file > DEFAULT_OPTIONS
+    """
+    environ = os.environ if environ is None else environ
+    options = dict(DEFAULT_OPTIONS)
+    config_file = args.pop('config', None) or environ.get('IMAGEFX_CONFIG')
+    if config_file:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            options.update({name.replace('-', '_'): value for name, value in json.load(f).items()})
+    for name, option_type in OPTION_TYPES.items():
+        value = environ.get('IMAGEFX_' + name.upper())
+        if value is not None:
+            options[name] = option_type(value)
+    options.update(args)
+    for name, option_type in OPTION_TYPES.items():
+        if options.get(name) is not None:
+            options[name] = option_type(options[name])
+    unknown_options = set(options) - set(DEFAULT_OPTIONS)
+    if unknown_options:
+        raise ValueError(f"unknown options: {', '.join(sorted(unknown_options))}")
+    check_option_conflicts(options)
+    check_optional_dependencies(options)
+    if options['cookie_file'] and not options['cookie']:
+        options['cookie'] = read_cookie_file(options['cookie_file'])
+    return options
+
+
+def load_accounts(accounts_file, options):
+    """
+    Reads the account profiles of accounts_file, a JSON list of objects with the keys of the config file plus an optional name.
+    Options that a profile does not set are taken from options (except the metrics reporting options, which only apply to
+    the profile that sets them). The output folder defaults to <output_folder>/<name>, relative crawl result, state
+    database, prompt index and failed keys files are placed in the output folder of the account.
+    """
+    with open(accounts_file, 'r', encoding='utf-8') as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, list) or not profiles:
+        raise ValueError(f"{accounts_file} must contain a list of account profiles")
+    account_option_names = ('cookie', 'auth_wait_time') + SYNC_OPTION_NAMES + DOWNLOADER_OPTION_NAMES
+    accounts = []
+    for index, profile in enumerate(profiles):
+        profile = {name.replace('-', '_'): value for name, value in profile.items()}
+        unknown_options = set(profile) - set(account_option_names + REPORT_OPTION_NAMES) - {'name', 'cookie_file'}
+        if unknown_options:
+            raise ValueError(f"unknown options in account {index + 1}: {', '.join(sorted(unknown_options))}")
+        for name, option_type in OPTION_TYPES.items():
+            if profile.get(name) is not None:
+                profile[name] = option_type(profile[name])
+        cookie_file = profile.pop('cookie_file', None)
+        if cookie_file and not profile.get('cookie'):
+            profile['cookie'] = read_cookie_file(cookie_file)
+        name = str(profile.pop('name', None) or os.path.basename(os.path.normpath(profile.get('output_folder') or "")) or f"account{index + 1}")
+        account = {option: options[option] for option in account_option_names}
+        account.update(profile)
+        account['cookie_file'] = cookie_file if profile.get('cookie') else options['cookie_file'] # The file the cookie of the account came from, read again when it expires
+        if not account['cookie']:
+            raise ValueError(f"account '{name}' has no cookie or cookie_file")
+        account['output_folder'] = profile.get('output_folder') or os.path.join(options['output_folder'], name)
+        if account['s3_url'] and not profile.get('s3_url'): # The accounts share the bucket, each under its own prefix
+            account['s3_url'] = account['s3_url'].rstrip("/") + "/" + name
+        account['crawl_result_file'] = os.path.join(account['output_folder'], account['crawl_result_file'])
+        if account['state_db_file']:
+            account['state_db_file'] = os.path.join(account['output_folder'], account['state_db_file'])
+        if account['prompt_index_file']:
+            account['prompt_index_file'] = os.path.join(account['output_folder'], account['prompt_index_file'])
+        if account['failed_keys_file']:
+            account['failed_keys_file'] = os.path.join(account['output_folder'], account['failed_keys_file'])
+        if any(other['name'] == name for other in accounts):
+            raise ValueError(f"more than one account is named '{name}'")
+        check_option_conflicts(account)
+        check_optional_dependencies(account)
+        accounts.append(dict(account, name=name))
+    return accounts
+
+
+def run_command_line(argv):
+    """
+    Runs a crawl/download/sync/index/search command without prompts, returns the exit code (1 if any image failed, 2 for invalid options)
+    """
+    args = vars(build_argument_parser().parse_intermixed_args(argv))
+    command = args.pop('command')
+    if 'query' in args:
+        args['query'] = " ".join(args['query']) # The words may be given as separate arguments
+    try:
+        options = load_options(args)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Invalid options: {e}")
+        return 2
+    if options['accounts'] and command != 'sync':
+        print("--accounts only works with the sync command.")
+        return 2
+    if command in ('crawl', 'download', 'sync') and not options['cookie'] and not options['accounts']:
+        print("A Cookie string is required: use --cookie-file, --cookie or the IMAGEFX_COOKIE environment variable.")
+        return 2
+    downloader_options = {name: options[name] for name in DOWNLOADER_OPTION_NAMES + REPORT_OPTION_NAMES}
+    auth_options = {name: options[name] for name in AUTH_OPTION_NAMES}
+
+    if command == 'index':
+        start_time = time.time()
+        result = {'indexed': index_prompt_files(options['output_folder'], options['prompt_index_file'], options['crawl_result_file']),
+                  'seconds': time.time() - start_time}
+        print(f"Added {result['indexed']} prompts of '{options['output_folder']}' to the prompt index '{options['prompt_index_file']}'.")
+    elif command == 'search':
+        if not options['prompt_index_file'] or not os.path.exists(options['prompt_index_file']):
+            print(f"Prompt index '{options['prompt_index_file']}' not found. It is written by download and sync, the index command adds the images saved before.")
+            return 2
+        start_time = time.time()
+        matches = search_prompts(options['query'] or "", options['prompt_index_file'], options['max_results'])
+        for match in matches: # One image path per line, so the list can be piped to other commands
+            print(json.dumps(match, ensure_ascii=False) if options['json'] else match['image_path'])
+        result = {'matches': len(matches), 'seconds': time.time() - start_time}
+    elif command == 'crawl':
+        start_time = time.time()
+        media_keys_info = crawl(options['cookie'], options['max_keys'], page_size=options['page_size'], page_sleep_time=options['page_sleep_time'],
+                                crawl_result_file=options['crawl_result_file'], resume_crawl=options['resume_crawl'], **auth_options,
+                                **{name: options[name] for name in RETRY_OPTION_NAMES})
+        result = {'crawled': len(media_keys_info), 'seconds': time.time() - start_time}
+    elif command == 'download':
+        media_keys_info = iter_crawl_result(options['crawl_result_file'])
+        first_item = next(media_keys_info, None) # The rest of the file is read while downloading
+        if first_item is None:
+            print(f"No links found in '{options['crawl_result_file']}', run the crawl or sync command first.")
+            return 2
+        result = download(options['cookie'], itertools.chain([first_item], media_keys_info), options['output_folder'], options['state_db_file'],
+                          resume=options['resume'], preview_size=options['preview_size'], prompt_index_file=options['prompt_index_file'],
+                          **auth_options, **downloader_options)
+    elif options['accounts']:
+        try:
+            accounts = load_accounts(options['accounts'], options)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Invalid options: {e}")
+            return 2
+        result = sync_accounts(accounts, options['max_total_concurrency'], options['max_bandwidth'])
+    else:
+        result = sync(options['cookie'], options['output_folder'], options['crawl_result_file'], options['state_db_file'],
+                      incremental=options['incremental'], streaming=options['streaming'], max_keys=options['max_keys'],
+                      page_size=options['page_size'], page_sleep_time=options['page_sleep_time'],
+                      stop_after_known=options['stop_after_known'], preview_size=options['preview_size'], resume_crawl=options['resume_crawl'],
+                      prompt_index_file=options['prompt_index_file'], **auth_options, **downloader_options)
+
+    if options['json']:
+        print(json.dumps(result))
+    return 1 if result.get('failed') or result.get('failed_accounts') else 0
 
 
 def main():
     """
-    Main function: Gets mediaKey list and downloads images and prompts in batches using multi-threading (final multi-threading version - removed on-the-fly download mode)
+    Without command line arguments the interactive prompts are used, otherwise the given command runs unattended
+    """
+    if len(sys.argv) == 1:
+        interactive_main()
+    else:
+        sys.exit(run_command_line(sys.argv[1:]))
+
+
+def interactive_main():
+    """
+    Main function: Gets the mediaKey list and downloads the images and prompts with multiple threads, in one of two modes:
+    crawl first, then download the whole list after a confirmation (the default), or streaming mode, which downloads while the links are still being crawled
     """
     output_folder = "imagefx_images"
     os.makedirs(output_folder, exist_ok=True)
     crawl_result_file = "media_keys_crawl_result.json"
+    state_db_file = "download_state.db"
+    state_store = DownloadStateStore(state_db_file)
+    prompt_index = PromptIndex("prompt_index.db") # Searchable with: python "ImageFX downloader - en.py" search WORDS
 
     total_retries = 10
     backoff_factor = 1
     status_forcelist = (429, 500, 502, 503, 504)
     page_sleep_time = 1
+    page_size = 100
     max_keys = None
     max_threads = 10
+    stop_after_known = 12
 
     load_from_file_prompt = input("Load saved crawl results and directly enter batch download mode? \n"
                                      "If you are running for the first time, you should choose 'no' (yes/no, default: no): ").lower()
@@ -96,8 +2619,7 @@ def main():
         media_keys_info = []
         if os.path.exists(crawl_result_file):
             try:
-                with open(crawl_result_file, 'r', encoding='utf-8') as f:
-                    media_keys_info = json.load(f)
+                media_keys_info = list(iter_crawl_result(crawl_result_file))
                 print(f"Successfully loaded {len(media_keys_info)} image links from file '{crawl_result_file}'.")
                 if media_keys_info:
                     cookie_string = input("Please paste your Cookie string \n"
@@ -109,6 +2631,7 @@ def main():
                         print("Cookie string cannot be empty. Please re-run the program and enter Cookie.")
                         return
                     cookies = {'Cookie': cookie_string}
+                    auth_monitor = AuthMonitor(cookies, prompt=True) # Asks for a new cookie if it expires during the run
                     print("")
                     print("********************")
                     print("")
@@ -122,21 +2645,29 @@ def main():
                     print("********************")
                     print("")
 
+                    done_media_keys = state_store.get_done_media_keys()
+                    if done_media_keys:
+                        resume_input = input(f"According to '{state_db_file}', {len(done_media_keys)} images have already been downloaded. Only download the images that are still pending or failed (resume)? (yes/no, default: yes): ").lower()
+                        if resume_input not in ['no', 'n']:
+                            media_keys_info = [item for item in media_keys_info if item.media_key not in done_media_keys]
+                            print(f"{len(media_keys_info)} images left to download.")
+                        print("")
+                        print("********************")
+                        print("")
+
                     print("Starting batch download of images...")
-                    downloader = BatchDownloader(
-                        cookies, output_folder,
-                        total_retries=total_retries, backoff_factor=backoff_factor,
-                        status_forcelist=status_forcelist,
-                        max_threads=max_threads
-                    )
+                    downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+                    preview_size = ask_preview_size()
                     start_time = time.time()
-                    downloaded_count = downloader.download_media_keys(media_keys_info)
+                    downloaded_count = download_with_previews(downloader, media_keys_info, preview_size)
                     end_time = time.time()
                     duration = end_time - start_time
 
                     print(f"\nDownload task completed!")
                     print(f"Downloaded {downloaded_count} images in total, saved in '{output_folder}' folder.")
                     print(f"Total time spent: {duration:.2f} seconds")
+                    state_store.close()
+                    prompt_index.close()
                     return
 
                 else:
@@ -160,6 +2691,7 @@ def main():
         print("Cookie string cannot be empty. Please re-run the program and enter Cookie.")
         return
     cookies = {'Cookie': cookie_string}
+    auth_monitor = AuthMonitor(cookies, prompt=True) # Asks for a new cookie if it expires during the run
     print("")
     print("********************")
     print("")
@@ -227,8 +2759,19 @@ def main():
                                      "    - If crawling speed is too fast causing errors, you can increase the delay appropriately, e.g., set to '2' or '3'.\n"
                                      "    - In most cases, the default value '1' second is sufficient.\n"
                                      f"Enter page request delay (seconds) (default: {page_sleep_time}): ")
-    if page_sleep_time_input.isdigit():
-        page_sleep_time = int(page_sleep_time_input)
+    if page_sleep_time_input:
+        page_sleep_time = float(page_sleep_time_input)
+    print("")
+    print("********************")
+    print("")
+
+
+    page_size_input = input(f"Enter the number of image links requested per page (default: {page_size}) \n"
+                            "**Purpose:** Larger pages need fewer requests to crawl the whole history, the next page is requested while the current one is processed.\n"
+                            "**Note:** If the server does not accept the size, it is halved automatically until it is accepted.\n"
+                            f"Enter the number of image links per page (default: {page_size}): ")
+    if page_size_input.isdigit():
+        page_size = int(page_size_input)
     print("")
     print("********************")
     print("")
@@ -249,45 +2792,92 @@ def main():
     print("********************")
     print("")
 
+    streaming_mode_input = input("Download images while the links are still being crawled (streaming mode)? \n"
+                                 "**Purpose:** Downloading starts as soon as the first page of links is crawled, instead of waiting for the whole crawl to finish, which saves a lot of time for large libraries.\n"
+                                 "**Note:** In streaming mode you will not be asked to confirm before downloading starts.\n"
+                                 "Use streaming mode? (yes/no, default: no): ").lower()
+    streaming_mode = streaming_mode_input in ['yes', 'y']
+    print("")
+    print("********************")
+    print("")
+
+    incremental_sync_input = input("Only crawl images created since the last run (incremental sync)? \n"
+                                   f"**Purpose:** Uses the images recorded as downloaded in '{state_db_file}' as an index of known images. The history is returned newest first, "
+                                   f"so crawling stops once {stop_after_known} known images in a row are found, and only the new images are downloaded.\n"
+                                   "**Setting suggestions:**\n"
+                                   "    - Choose 'yes' for regular backups after the first complete run.\n"
+                                   "    - Choose 'no' for the first run or if you want to re-crawl everything.\n"
+                                   "Use incremental sync? (yes/no, default: no): ").lower()
+    incremental_sync = incremental_sync_input in ['yes', 'y']
+    known_media_keys = set()
+    if incremental_sync:
+        known_media_keys = state_store.get_done_media_keys()
+        print(f"Loaded {len(known_media_keys)} downloaded images from '{state_db_file}'.")
+    print("")
+    print("********************")
+    print("")
+
+    resume_point = crawl_resume_point(crawl_result_file)
+    pending_checkpoint = None
+    if resume_point:
+        resume_crawl_input = input(f"The last crawl stopped early after {resume_point[1]} links. Continue it from the last saved page instead of starting over? "
+                                   "The images added since then are picked up by the next incremental sync. (yes/no, default: yes): ").lower()
+        if resume_crawl_input in ['no', 'n']:
+            pending_checkpoint = resume_point if incremental_sync else None # The links are kept, so it can still be continued later
+            resume_point = None
+        print("")
+        print("********************")
+        print("")
+
     downloaded_count = 0
     start_time = time.time()
 
-    # --- The following code block removes the judgment about download_threshold, and always executes the mode of crawling links first and then downloading in batches ---
-    print(f"\n--- Will always use the mode of crawling links first and then downloading in batches ---")
-
-    print("Starting to crawl image links and creation times...")
     media_keys_crawler = MediaKeyCrawler(
         cookies, max_keys,
         total_retries=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
-        page_sleep_time=page_sleep_time
+        page_sleep_time=page_sleep_time,
+        page_size=page_size,
+        known_media_keys=known_media_keys,
+        stop_after_known=stop_after_known,
+        resume_point=resume_point,
+        pending_checkpoint=pending_checkpoint,
+        auth_monitor=auth_monitor,
+        crawl_log=CrawlLog(crawl_result_file, append=incremental_sync or bool(resume_point)) # Written page by page, so an interrupted crawl keeps its links
     )
-    media_keys_info = media_keys_crawler.get_all_media_keys_info()
+    if streaming_mode:
+        print(f"\n--- Streaming mode: crawling links and downloading images at the same time ---")
+        downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+        media_keys_crawler.rate_controller = downloader.rate_controller # The crawl runs concurrently, so it also honours throttling
+
+        # The downloader pulls items from the generator as it goes, so the crawl pauses whenever its bounded queue is full
+        downloaded_count = downloader.download_media_keys(media_keys_crawler.iter_media_keys_info())
+        media_keys_crawler.crawl_log.close()
+        if not media_keys_crawler.crawl_log.written_count and known_media_keys:
+            print("No new images found since the last run.")
+        elif not media_keys_crawler.crawl_log.written_count:
+            print("Link crawling failed, please check error messages. Download not started.")
+    else:
+        # --- The following code block removes the judgment about download_threshold, and always executes the mode of crawling links first and then downloading in batches ---
+        print(f"\n--- Will always use the mode of crawling links first and then downloading in batches ---")
 
-    if media_keys_info:
-        try:
-            with open(crawl_result_file, 'w', encoding='utf-8') as f:
-                json.dump(media_keys_info, f, ensure_ascii=False, indent=4)
-            print(f"Successfully saved crawl results to file '{crawl_result_file}'.")
-        except Exception as e:
-            print(f"Failed to save crawl results to file: {e}")
+        print("Starting to crawl image links and creation times...")
+        media_keys_info = media_keys_crawler.get_all_media_keys_info()
+        media_keys_crawler.crawl_log.close()
 
         if media_keys_info:
             user_confirmation = input(f"Link crawling completed, {len(media_keys_info)} image links crawled. Start downloading images? (yes/no, default: no): ")
             if user_confirmation.lower() in ['yes', 'y']:
                 print("Starting batch download of images...")
-                downloader = BatchDownloader(
-                    cookies, output_folder,
-                    total_retries=total_retries, backoff_factor=backoff_factor,
-                    status_forcelist=status_forcelist,
-                    max_threads=max_threads,
-                )
-                downloaded_count = downloader.download_media_keys(media_keys_info)
+                downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+                downloaded_count = download_with_previews(downloader, media_keys_info, ask_preview_size())
             else:
                 print("User cancelled download.")
+        elif known_media_keys:
+            print("No new images found since the last run.")
         else:
             print("Link crawling failed, please check error messages. Download not started.")
 
-    # --- Removed else branch, only keeping the code for crawl-first and then download mode ---
+        # --- Removed else branch, only keeping the code for crawl-first and then download mode ---
 
 
     end_time = time.time()
@@ -296,129 +2886,831 @@ def main():
     print(f"\nDownload task completed!")
     print(f"Downloaded {downloaded_count} images in total, saved in '{output_folder}' folder.")
     print(f"Total time spent: {duration:.2f} seconds")
+    state_store.close()
+    prompt_index.close()
 
 
 class MediaKeyCrawler:
-    def __init__(self, cookies, max_keys=None, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), page_sleep_time=1):
+    def __init__(self, cookies, max_keys=None, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), page_sleep_time=1,
+                 known_media_keys=None, stop_after_known=12, rate_controller=None, page_size=100, prefetch=True, crawl_log=None, resume_point=None,
+                 pending_checkpoint=None, auth_monitor=None):
         self.cookies = cookies
         self.max_keys = max_keys
         self.total_retries = total_retries
         self.backoff_factor = backoff_factor
         self.status_forcelist = status_forcelist
         self.page_sleep_time = page_sleep_time
+        self.known_media_keys = known_media_keys or set() # Downloaded mediaKeys are skipped, a run of stop_after_known of them ends the crawl
+        self.stop_after_known = stop_after_known
+        self.rate_controller = rate_controller
+        self.page_size = page_size # Halved automatically until the server accepts it
+        self.crawl_log = crawl_log # Optional CrawlLog that every page is written to as soon as it is crawled
+        self.resume_point = resume_point # (cursor, crawled_count, after) of crawl_resume_point() to continue an interrupted crawl
+        self.pending_checkpoint = pending_checkpoint # Checkpoint of an earlier crawl this one does not continue, kept when it stops at known images
+        self.prefetch = prefetch # Request the next page while the current one is being processed
+        self.auth_monitor = auth_monitor # Optional AuthMonitor, the page is requested again once a new cookie is loaded
         self.session = requests.Session()
         retries = Retry(total=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist)
         self.session.mount("https://", HTTPAdapter(max_retries=retries))
 
     def get_all_media_keys_info(self):
         media_keys_info = []
-        media_keys_count = 0
-        next_page_token = ""
-        has_next_page = True
+        for page in self.iter_media_keys_pages():
+            media_keys_info.extend(page)
+        return media_keys_info
 
-        while has_next_page:
-            api_url = "https://labs.google/fx/api/trpc/media.fetchUserHistory"
-            params = {
-                "input": '{"json":{"cursor":"' + next_page_token + '","limit":12, "type":"IMAGE_FX"},"meta":{"values":{}}}'
-            }
+    def iter_media_keys_info(self):
+        for page in self.iter_media_keys_pages():
+            yield from page
+
+    def fetch_page(self, cursor, delay=0):
+        """
+        Requests one page of media.fetchUserHistory after waiting delay seconds, returns the response or None if the request failed
+        """
+        if delay:
+            time.sleep(delay)
+        if self.rate_controller:
+            self.rate_controller.wait_if_paused()
+        params = fetch_user_history_params(cursor, self.page_size)
+        while True:
+            cookie = self.cookies['Cookie']
             try:
-                response = self.session.get(api_url, params=params, cookies=self.cookies, timeout=30)
+                response = self.session.get(FETCH_USER_HISTORY_API_URL, params=params, cookies={'Cookie': cookie}, timeout=30)
+                if self.rate_controller: # Latency is not reported, it is a different endpoint than the downloads
+                    self.rate_controller.record_response(response.status_code, retry_after=parse_retry_after(response.headers.get('Retry-After')))
             except requests.exceptions.RequestException as e:
                 print(f"Error fetching media.fetchUserHistory in MediaKeyCrawler: {e}")
-                has_next_page = False
-                break
+                return None
+            if not (self.auth_monitor and is_auth_failure(response.status_code, response.url) and self.auth_monitor.report_rejected(cookie)):
+                return response
+            self.auth_monitor.wait_until_valid()
+
+    def report_interruption(self):
+        if self.crawl_log and (self.crawl_log.written_count or self.resume_point):
+            print(f"The crawl stopped early, the next run continues it from the last page saved in '{self.crawl_log.crawl_result_file}'.")
+
+    def fetch_first_page(self):
+        """
+        Requests the first page, halving page_size while the server rejects it (tRPC answers a limit that is too large with
+        a validation error), so the rest of the crawl uses the largest page size the endpoint accepts
+        """
+        while True:
+            response = self.fetch_page(self.resume_point[0] if self.resume_point else "")
+            if response is None or response.status_code not in (400, 413, 422) or self.page_size <= MIN_PAGE_SIZE:
+                return response
+            page_size = max(MIN_PAGE_SIZE, self.page_size // 2)
+            print(f"The server rejected a page size of {self.page_size} (status code {response.status_code}), trying {page_size}.")
+            self.page_size = page_size
+
+    def iter_media_keys_pages(self):
+        """
+        Generator that yields the crawled mediaKey information page by page, so downloading can start before the crawl finishes.
+        With prefetch, the next page is requested in the background as soon as the current one is parsed and does not stop the
+        crawl, so the page delay and the round trip overlap with the processing of the current page by the caller.
+        """
+        media_keys_count = self.resume_point[1] if self.resume_point else 0 # The checkpoints count the links of the interrupted crawl too
+        run_count = 0 # max_keys limits the links of this run, the next run continues from where it stopped
+        known_run = 0
+        has_next_page = True
+        cursor, skip_until = (self.resume_point[0], self.resume_point[2]) if self.resume_point else ("", None)
+        if self.resume_point:
+            print(f"Continuing the interrupted crawl after {media_keys_count} links.")
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch_executor:
+            response = self.fetch_first_page()
+            while has_next_page:
+                if response is None:
+                    self.report_interruption()
+                    break
+                if response.status_code != 200 or is_auth_failure(response.status_code, response.url):
+                    print(f"Failed to get media.fetchUserHistory, status code: {response.status_code}")
+                    print(response.text)
+                    self.report_interruption()
+                    break
+
+                page = []
+                stop_checkpoint = None # (cursor, crawled_count, after) to continue from when this page stops the crawl early
+                try:
+                    response_json = response.json()
+                except ValueError as e: # A truncated or non-JSON body (e.g. an error page) interrupts the crawl like a failed request
+                    print(f"Failed to parse the media.fetchUserHistory response: {e}")
+                    self.report_interruption()
+                    break
+                try:
+                    history_result = response_json['result']['data']['json']['result']
+                except (KeyError, TypeError):
+                    history_result = {}
+                next_page_token = history_result.get('nextPageToken', "")
 
-            if response.status_code == 200:
-                response_json = response.json()
-                if 'result' in response_json and 'data' in response_json['result'] and 'json' in response_json['result']['data'] and \
-                   'result' in response_json['result']['data']['json'] and 'userWorkflows' in response_json['result']['data']['json']['result']:
-                    user_workflows = response_json['result']['data']['json']['result']['userWorkflows']
+                if 'userWorkflows' in history_result:
+                    user_workflows = history_result['userWorkflows']
+
+                    if skip_until:
+                        page_media_keys = [workflow['name'] for workflow in user_workflows]
+                        if skip_until in page_media_keys: # max_keys stopped the last run after this mediaKey of the page
+                            user_workflows = user_workflows[page_media_keys.index(skip_until) + 1:]
+                        skip_until = None
 
                     if user_workflows:
-                        for workflow in user_workflows:
+                        for index, workflow in enumerate(user_workflows):
                             media_key = workflow['name']
                             create_time = workflow['createTime']
-                            media_keys_info.append({'media_key': media_key, 'create_time': create_time})
+                            if media_key in self.known_media_keys:
+                                known_run += 1
+                                if known_run >= self.stop_after_known:
+                                    has_next_page = False
+                                    stop_checkpoint = self.pending_checkpoint
+                                    print(f"Found {known_run} already downloaded images in a row, stopped getting more mediaKeys.")
+                                    break
+                                continue
+                            known_run = 0
+                            page.append(MediaKeyInfo(media_key, create_time))
                             media_keys_count += 1
+                            run_count += 1
 
-                            if self.max_keys and media_keys_count >= self.max_keys:
+                            if self.max_keys and run_count >= self.max_keys:
                                 has_next_page = False
+                                if index + 1 < len(user_workflows):
+                                    stop_checkpoint = (cursor, media_keys_count, media_key)
+                                elif next_page_token:
+                                    stop_checkpoint = (next_page_token, media_keys_count, None)
                                 print(f"Reached maximum number of crawled links {self.max_keys}, stopped getting more mediaKeys.")
                                 break
                     else:
                         print("Warning: userWorkflows is empty in response, but contains nextPageToken, continue trying next page.")
-                elif 'result' in response_json and 'data' in response_json['result'] and 'json' in response_json['result']['data'] and \
-                     'result' in response_json['result']['data']['json'] and 'nextPageToken' in response_json['result']['data']['json']['result']:
+                elif 'nextPageToken' in history_result:
                     print("Warning: userWorkflows is missing in response, but contains nextPageToken, continue trying next page.")
                 else:
                     print("Warning: Response format is abnormal, may be missing userWorkflows or nextPageToken.")
                     has_next_page = False
 
+                next_response = None
+                if has_next_page and next_page_token and self.prefetch: # Only once this page did not stop the crawl, a stopped crawl must not request another page
+                    next_response = prefetch_executor.submit(self.fetch_page, next_page_token, self.page_sleep_time)
+
+                if self.crawl_log:
+                    if has_next_page:
+                        self.crawl_log.append_page(page, next_page_token, media_keys_count)
+                    else:
+                        self.crawl_log.append_page(page, *(stop_checkpoint or ("", media_keys_count)))
+                if page:
+                    yield page
+
                 if not has_next_page:
                     break
 
-                next_page_token = response_json['result']['data']['json']['result'].get('nextPageToken', "")
                 has_next_page = bool(next_page_token)
-                if has_next_page and (not self.max_keys or media_keys_count < self.max_keys):
+                if has_next_page:
                     print(f"Crawled {media_keys_count} image links, remaining pages: {has_next_page}")
-                    time.sleep(self.page_sleep_time)
-
-            else:
-                print(f"Failed to get media.fetchUserHistory, status code: {response.status_code}")
-                print(response.text)
-                has_next_page = False
-
-        return media_keys_info
+                    cursor = next_page_token
+                    response = next_response.result() if next_response else self.fetch_page(next_page_token, self.page_sleep_time)
 
 
 class BatchDownloader:
-    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_threads=10):
+    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_threads=10, state_store=None, skip_existing=False, streaming=True,
+                 rate_controller=None, writer_threads=2, fsync=False, dedup=False, image_size=None, metrics=None, shared_limiter=None,
+                 max_attempts=3, retry_delay=10, failed_keys_file=None, auth_monitor=None, batch_size=1, prompt_index=None, prompt_files=True,
+                 shard_size=None, shard_max_files=None, object_store=None, detect_format=False, convert_format=None, image_quality=90,
+                 thumbnail_size=None, post_processes=None):
         self.cookies = cookies
         self.output_folder = output_folder
         self.total_retries = total_retries
         self.backoff_factor = backoff_factor
         self.status_forcelist = status_forcelist
         self.max_threads = max_threads
-        self.active_threads_count = 0
-        self.threads = []
+        self.state_store = state_store
+        self.skip_existing = skip_existing
+        self.streaming = streaming # Decode responses chunk by chunk to keep memory use low
+        self.rate_controller = rate_controller # Optional AdaptiveRateController, max_threads is then the upper limit
+        self.writer_threads = writer_threads # Threads of the FileWriter, so slow disk I/O does not stall the download workers
+        self.fsync = fsync
+        self.dedup = dedup # Hard-link identical images instead of writing them again
+        self.image_size = image_size # (height, width) of the requested images, None for the originals
+        self.shared_limiter = shared_limiter # Optional SharedLimiter, applied after the own limits
+        self.max_attempts = max_attempts # Failed images are retried at the back of the queue, see RetryScheduler
+        self.retry_delay = retry_delay
+        self.failed_keys_file = failed_keys_file # Report of the images that failed for good, None to skip it
+        self.auth_monitor = auth_monitor # Optional AuthMonitor that pauses the workers while the cookie is expired
+        self.batch_size = batch_size # Images per tRPC batch request, taken from the images already queued
+        self.prompt_index = prompt_index # Optional PromptIndex that the FileWriter adds the prompts to
+        self.shard_size = shard_size # Megabytes per tar shard, see ArchiveShardWriter (None together with shard_max_files: loose files)
+        self.shard_max_files = shard_max_files
+        self.object_store = object_store # Optional S3ObjectStore that the files are uploaded to instead of output_folder
+        self.detect_format = detect_format # Post-processing options, see ImagePostProcessor
+        self.convert_format = convert_format
+        self.image_quality = image_quality
+        self.thumbnail_size = thumbnail_size
+        self.post_processes = post_processes
+        self.prompt_files = prompt_files # Also save every prompt as a .txt file next to its image
+        self.retry_scheduler = None
+        self.metrics = metrics or DownloadMetrics() # Shared with the preview pass of download_with_previews
         self.success_count = 0 # Built-in success counter for BatchDownloader
+        self.failure_count = 0
+        self.lock = threading.Lock() # Protects success_count, which is updated from all worker threads
+        # One keep-alive connection pool shared by all workers, sized so that every worker can hold its own connection
+        self.session = requests.Session()
+        retries = ControlledRetry(total=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                                  rate_controller=self.rate_controller, metrics=self.metrics)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.max_threads, max_retries=retries))
 
     def download_media_keys(self, media_keys_info):
-        downloaded_count = 0
-        for index, item in enumerate(media_keys_info): # Use enumerate to get index
-            media_key = item['media_key']
-            create_time = item['create_time']
-
-            while self.active_threads_count >= self.max_threads:
-                time.sleep(0.1)
-                self.threads = [t for t in self.threads if t.is_alive()]
-                self.active_threads_count = len(self.threads)
-
-            thread = threading.Thread(
-                target=download_image_and_prompt,
-                args=(media_key, self.cookies, self.output_folder, create_time),
-                kwargs={'on_thread_complete': lambda result, mk=media_key: self.update_thread_completion(result, mk)} # Modified: lambda receives result and media_key
-            )
-            self.threads.append(thread)
-            thread.start()
-            self.active_threads_count += 1
-
-        for thread in self.threads:
-            thread.join()
+        if self.skip_existing:
+            media_keys_info = skip_downloaded_media_keys(media_keys_info, self.output_folder, self.object_store,
+                                                         converted_extension(self.convert_format), bool(self.thumbnail_size))
+        if isinstance(media_keys_info, list):
+            self.metrics.add_total(len(media_keys_info)) # Unknown for a streaming crawl, the ETA then uses the queued images
+        # A fixed number of worker threads drain a bounded queue, instead of starting one thread per image
+        task_queue = queue.Queue(maxsize=self.max_threads * self.batch_size * 2)
+        self.retry_scheduler = RetryScheduler(self.max_attempts, self.retry_delay)
+        writer = FileWriter(self.writer_threads, fsync=self.fsync, dedup=self.dedup, prompt_index=self.prompt_index, prompt_files=self.prompt_files,
+                            shard_writer=build_shard_writer(self.output_folder, self.shard_size, self.shard_max_files, self.fsync),
+                            object_store=self.object_store,
+                            post_processor=build_post_processor(self.detect_format, self.convert_format, self.image_quality, self.thumbnail_size,
+                                                                self.post_processes))
+        if self.dedup and self.state_store:
+            writer.add_saved_images(self.state_store.get_saved_images(), self.output_folder)
+        writer.start()
+        self.metrics.set_gauge('download_queue_depth', task_queue.qsize)
+        self.metrics.set_gauge('writer_queue_depth', writer.queue.qsize)
+        if self.rate_controller:
+            self.metrics.set_gauge('concurrency_limit', lambda: round(self.rate_controller.limit, 2))
+        workers = []
+        for _ in range(self.max_threads):
+            worker = threading.Thread(target=self._worker, args=(task_queue, writer), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        for item in media_keys_info:
+            if self.state_store:
+                self.state_store.mark_pending(item)
+            self.metrics.record_queued()
+            self.retry_scheduler.start()
+            task_queue.put(item) # Blocks while the queue is full, so no polling is needed
+            for retry_item in iter(self.retry_scheduler.pop_due, None):
+                task_queue.put(retry_item)
+        while True:
+            retry_item = self.retry_scheduler.wait_for_retry() # Only retries are left, None once every image has finished
+            if retry_item is None:
+                break
+            task_queue.put(retry_item)
+        for _ in workers:
+            task_queue.put(None) # One stop signal per worker
+
+        for worker in workers:
+            worker.join()
+        writer.close() # Waits for the files still queued for writing
+        print_deduplicated_count(writer)
+        if self.failed_keys_file:
+            write_failed_keys_report(self.failed_keys_file, self.retry_scheduler.failed_items,
+                                     self.retry_scheduler.succeeded_media_keys, self.state_store)
 
         # After download is complete, print the final total number of successful downloads
         print(f"\nBatch download completed, {self.success_count} images downloaded successfully.") # Final summary
         return self.success_count # Return the number of successful downloads
 
-
-    def update_thread_completion(self, result, media_key): # Modified: Receives result and media_key
-        self.active_threads_count -= 1
-        if result:
-            self.success_count += 1 # Increase count on success
-            if self.success_count % 10 == 0: # Print every 10 successful downloads
-                print(f"Successfully downloaded {self.success_count} images...") # Batch success prompt
+    def _worker(self, task_queue, writer):
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            items = [item]
+            while len(items) < self.batch_size: # Only the images already queued, a batch is never waited for
+                try:
+                    item = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    task_queue.put(None) # The stop signal is taken again after this batch
+                    break
+                items.append(item)
+            if len(items) > 1:
+                items = self._download_batch(items, writer) # The images left to download one by one
+            for item in items:
+                self._download_one(item, writer)
+
+    def _download_one(self, item, writer):
+        media_key = item.media_key
+        if self.auth_monitor and not self.auth_monitor.wait_until_valid():
+            self.update_thread_completion(download_result(False, error="cookie expired", auth_failed=True), item)
+            return
+        if self.rate_controller:
+            self.rate_controller.acquire()
+        if self.shared_limiter:
+            self.shared_limiter.acquire()
+        cookies = dict(self.cookies) # The cookie sent, a rejection is only reported if no newer cookie was loaded meanwhile
+        try:
+            download_image_and_prompt(
+                media_key, cookies, self.output_folder, item.create_time,
+                total_retries=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                on_thread_complete=lambda result, item=item, cookie=cookies['Cookie']: self.update_thread_completion(result, item, cookie),
+                session=self.session, streaming=self.streaming, rate_controller=self.rate_controller, writer=writer,
+                image_size=self.image_size
+            )
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                self.rate_controller.release()
+
+    def _download_batch(self, items, writer):
+        if self.auth_monitor and not self.auth_monitor.wait_until_valid():
+            return items # Skipped one by one by _download_one
+        if self.rate_controller:
+            self.rate_controller.acquire()
+        if self.shared_limiter:
+            self.shared_limiter.acquire()
+        cookies = dict(self.cookies)
+        try:
+            fallback_items = download_media_batch(
+                items, cookies, self.output_folder,
+                on_item_complete=lambda item, result: self.update_thread_completion(result, item, cookies['Cookie']),
+                session=self.session, rate_controller=self.rate_controller, writer=writer, image_size=self.image_size
+            )
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                self.rate_controller.release()
+        if fallback_items is None:
+            with self.lock:
+                if self.batch_size > 1:
+                    self.batch_size = 1
+                    print("The server does not accept tRPC batch requests, downloading one image per request.")
+            fallback_items = items
+        return fallback_items
+
+    def update_thread_completion(self, result, item, cookie=None): # Receives the result, the MediaKeyInfo and the cookie of the download
+        media_key = item.media_key
+        if self.state_store:
+            self.state_store.record_result(media_key, result)
+        if result['auth_failed'] and self.auth_monitor:
+            if self.auth_monitor.report_rejected(cookie):
+                self.metrics.record_retry('auth')
+                self.retry_scheduler.requeue(item) # Downloaded again once the new cookie is loaded
+                return
+            if not self.auth_monitor.gave_up:
+                result['auth_failed'] = False # The cookie still works, only this image was refused, it is retried like any failed image
+        if not result['success'] and not result['auth_failed']: # Retrying with the rejected cookie would fail again
+            delay = self.retry_scheduler.schedule_retry(item)
+            if delay is not None:
+                self.metrics.record_retry('deferred')
+                print(f"  -> Image {media_key}.jpg download failed ({result['error']}), retrying it in {delay:g} seconds.")
+                return
+        self.metrics.record_result(result)
+        if self.shared_limiter and result['success']:
+            self.shared_limiter.record_bytes(result['byte_size'])
+        if result['success']:
+            with self.lock:
+                self.success_count += 1 # Increase count on success
+                success_count = self.success_count
+            if success_count % 10 == 0 and not self.metrics.show_progress_bar: # Print every 10 successful downloads
+                print(f"Successfully downloaded {success_count} images...") # Batch success prompt
         else:
+            with self.lock:
+                self.failure_count += 1
             print(f"  -> Image {media_key}.jpg download failed.") # Print specific media_key on failure
+        self.retry_scheduler.finish(item, result) # Last, so the final counts are complete once the feeder sees the run has finished
+
+
+class AsyncBatchDownloader:
+    """
+    Downloads images on a single asyncio event loop (requires aiohttp), a semaphore limits the number of requests in flight.
+    JSON parsing and base64 decoding are offloaded to a thread pool and the files are saved by FileWriter threads, so neither blocks the event loop.
+    """
+    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_concurrency=100, executor_workers=None, state_store=None, skip_existing=False, streaming=True,
+                 rate_controller=None, writer_threads=2, fsync=False, dedup=False, image_size=None, metrics=None, shared_limiter=None,
+                 max_attempts=3, retry_delay=10, failed_keys_file=None, auth_monitor=None, prompt_index=None, prompt_files=True,
+                 shard_size=None, shard_max_files=None, object_store=None, detect_format=False, convert_format=None, image_quality=90,
+                 thumbnail_size=None, post_processes=None):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio download engine requires aiohttp, please install it first: pip install aiohttp")
+        self.cookies = cookies
+        self.output_folder = output_folder
+        self.total_retries = total_retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.max_concurrency = max_concurrency
+        self.executor_workers = executor_workers
+        self.state_store = state_store
+        self.skip_existing = skip_existing
+        self.streaming = streaming
+        self.rate_controller = rate_controller
+        self.rate_condition = None
+        self.writer_threads = writer_threads
+        self.fsync = fsync
+        self.dedup = dedup
+        self.image_size = image_size
+        self.shared_limiter = shared_limiter
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.failed_keys_file = failed_keys_file
+        self.auth_monitor = auth_monitor
+        self.prompt_index = prompt_index
+        self.prompt_files = prompt_files
+        self.shard_size = shard_size
+        self.shard_max_files = shard_max_files
+        self.object_store = object_store
+        self.detect_format = detect_format
+        self.convert_format = convert_format
+        self.image_quality = image_quality
+        self.thumbnail_size = thumbnail_size
+        self.post_processes = post_processes
+        self.retry_scheduler = None
+        self.metrics = metrics or DownloadMetrics()
+        self.writer = None
+        self.success_count = 0
+        self.failure_count = 0
+
+    def download_media_keys(self, media_keys_info):
+        if self.skip_existing:
+            media_keys_info = skip_downloaded_media_keys(media_keys_info, self.output_folder, self.object_store,
+                                                         converted_extension(self.convert_format), bool(self.thumbnail_size))
+        if isinstance(media_keys_info, list):
+            self.metrics.add_total(len(media_keys_info))
+        asyncio.run(self._download_all(media_keys_info))
+        print(f"\nBatch download completed, {self.success_count} images downloaded successfully.")
+        return self.success_count
+
+    async def _download_all(self, media_keys_info):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.rate_condition = asyncio.Condition()
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency) # Keep-alive connections are reused across requests
+        timeout = aiohttp.ClientTimeout(total=30)
+        tasks = set()
+        self.retry_scheduler = RetryScheduler(self.max_attempts, self.retry_delay)
+        self.writer = FileWriter(self.writer_threads, fsync=self.fsync, dedup=self.dedup, prompt_index=self.prompt_index,
+                                 prompt_files=self.prompt_files,
+                                 shard_writer=build_shard_writer(self.output_folder, self.shard_size, self.shard_max_files, self.fsync),
+                                 object_store=self.object_store,
+                                 post_processor=build_post_processor(self.detect_format, self.convert_format, self.image_quality,
+                                                                     self.thumbnail_size, self.post_processes))
+        if self.dedup and self.state_store:
+            self.writer.add_saved_images(self.state_store.get_saved_images(), self.output_folder)
+        self.writer.start()
+        self.metrics.set_gauge('requests_in_flight', lambda: len(tasks))
+        self.metrics.set_gauge('writer_queue_depth', self.writer.queue.qsize)
+        if self.rate_controller:
+            self.metrics.set_gauge('concurrency_limit', lambda: round(self.rate_controller.limit, 2))
+        with ThreadPoolExecutor(max_workers=self.executor_workers) as executor:
+            # The cookie is sent with every request, so a reloaded cookie is used right away
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                loop = asyncio.get_running_loop()
+                media_keys_iter = iter(media_keys_info)
+                input_finished = False
+                while True:
+                    item = self.retry_scheduler.pop_due()
+                    if item is None and not input_finished:
+                        # next() may block while a streaming crawl fetches its next page, so it runs outside the event loop
+                        item = await loop.run_in_executor(None, next, media_keys_iter, None)
+                        if item is None:
+                            input_finished = True
+                        else:
+                            if self.state_store:
+                                self.state_store.mark_pending(item)
+                            self.metrics.record_queued()
+                            self.retry_scheduler.start()
+                    while item is None and input_finished and not self.retry_scheduler.is_finished():
+                        # Only retries are left, the downloads that may still fail finish on this event loop
+                        await asyncio.sleep(min(0.1, self.retry_scheduler.seconds_until_due() or 0.1))
+                        item = self.retry_scheduler.pop_due()
+                    if item is None:
+                        break
+                    if self.auth_monitor and self.auth_monitor.is_paused():
+                        await loop.run_in_executor(None, self.auth_monitor.wait_until_valid) # No new requests while the cookie is expired
+                    if self.auth_monitor and self.auth_monitor.gave_up:
+                        self._record_result(item, download_result(False, error="cookie expired", auth_failed=True))
+                        continue
+                    await semaphore.acquire() # Waits here while max_concurrency requests are in flight
+                    if self.rate_controller:
+                        await self._acquire_rate_slot()
+                    if self.shared_limiter:
+                        await self._acquire_shared_slot()
+                    task = asyncio.create_task(self._download_one(session, executor, item))
+                    task.add_done_callback(lambda _: semaphore.release())
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.close)
+        print_deduplicated_count(self.writer)
+        if self.failed_keys_file:
+            write_failed_keys_report(self.failed_keys_file, self.retry_scheduler.failed_items,
+                                     self.retry_scheduler.succeeded_media_keys, self.state_store)
+
+    async def _acquire_rate_slot(self):
+        async with self.rate_condition:
+            while not self.rate_controller.try_acquire():
+                try:
+                    # Woken up when a request finishes, or when a Retry-After pause is over
+                    await asyncio.wait_for(self.rate_condition.wait(), timeout=self.rate_controller.pause_remaining() or None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _acquire_shared_slot(self):
+        # The other accounts release their slots from other threads, so this polls instead of waiting on a condition
+        while not self.shared_limiter.try_acquire():
+            await asyncio.sleep(max(0.01, self.shared_limiter.wait_time()))
+
+    async def _release_rate_slot(self):
+        self.rate_controller.release()
+        async with self.rate_condition:
+            self.rate_condition.notify_all()
+
+    async def _download_one(self, session, executor, item):
+        try:
+            await self._download_one_with_retries(session, executor, item)
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                await self._release_rate_slot()
+
+    async def _download_one_with_retries(self, session, executor, item):
+        media_key = item.media_key
+        result = download_result(False)
+        http_seconds = None
+        cookie = None
+        retry_after = None # Retry-After of the last retried response, waited for at least, as urllib3 Retry does
+        for attempt in range(self.total_retries + 1):
+            if attempt:
+                delay = self.backoff_factor * (2 ** (attempt - 1)) # Same backoff formula as urllib3 Retry
+                if self.rate_controller:
+                    delay = max(delay, self.rate_controller.pause_remaining())
+                await asyncio.sleep(max(delay, retry_after or 0))
+                retry_after = None
+            request_start_time = time.monotonic()
+            cookie = self.cookies['Cookie']
+            try:
+                async with session.get(FETCH_MEDIA_API_URL, params=fetch_media_params(media_key, *(self.image_size or ())), headers={'Cookie': cookie}) as response:
+                    http_seconds = time.monotonic() - request_start_time
+                    response_retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if self.rate_controller:
+                        self.rate_controller.record_response(response.status, http_seconds, response_retry_after)
+                    if is_auth_failure(response.status, response.url):
+                        result = download_result(False, error=f"authentication failed: HTTP {response.status}", auth_failed=True)
+                        break
+                    if response.status in self.status_forcelist and attempt < self.total_retries:
+                        if response.status in Retry.RETRY_AFTER_STATUS_CODES:
+                            retry_after = response_retry_after
+                        self.metrics.record_retry(response.status)
+                        continue
+                    status = response.status
+                    if status == 200 and self.streaming:
+                        result = await self._stream_and_save(executor, response, item)
+                        break
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt < self.total_retries:
+                    self.metrics.record_retry(type(e).__name__)
+                    continue
+                print(f"  -> Request to download media.fetchMedia failed (mediaKey: {media_key}): {e}")
+                result = download_result(False, error=f"request failed: {e!r}")
+                break
+
+            if status == 200:
+                loop = asyncio.get_running_loop()
+                saved, on_complete = self._saved_future(loop)
+                await loop.run_in_executor(executor, self._parse_and_save, media_key, item.create_time, body, on_complete)
+                result = await saved
+            else:
+                print(f"  -> Failed to download media.fetchMedia, status code: {status}")
+                print(body.decode('utf-8', errors='replace'))
+                result = download_result(False, error=f"HTTP {status}")
+            break
+
+        if http_seconds is not None:
+            result['timings']['http'] = http_seconds # Of the last attempt, without the backoff
+        requeue = False
+        if result['auth_failed'] and self.auth_monitor: # report_rejected() confirms the rejection with a blocking request, so it runs outside the event loop
+            requeue = await asyncio.get_running_loop().run_in_executor(None, self.auth_monitor.report_rejected, cookie)
+        self._record_result(item, result, requeue)
+
+    def _record_result(self, item, result, requeue=False):
+        media_key = item.media_key
+        if self.state_store:
+            self.state_store.record_result(media_key, result)
+        if requeue:
+            self.metrics.record_retry('auth')
+            self.retry_scheduler.requeue(item)
+            return
+        if result['auth_failed'] and self.auth_monitor and not self.auth_monitor.gave_up:
+            result['auth_failed'] = False # The cookie still works, only this image was refused
+        if not result['success'] and not result['auth_failed']:
+            delay = self.retry_scheduler.schedule_retry(item)
+            if delay is not None:
+                self.metrics.record_retry('deferred')
+                print(f"  -> Image {media_key}.jpg download failed ({result['error']}), retrying it in {delay:g} seconds.")
+                return
+        self.metrics.record_result(result)
+        if self.shared_limiter and result['success']:
+            self.shared_limiter.record_bytes(result['byte_size'])
+        if result['success']:
+            self.success_count += 1 # Only touched from the event loop thread, so no lock is needed
+            if self.success_count % 10 == 0 and not self.metrics.show_progress_bar:
+                print(f"Successfully downloaded {self.success_count} images...")
+        else:
+            self.failure_count += 1
+            print(f"  -> Image {media_key}.jpg download failed.")
+        self.retry_scheduler.finish(item, result)
+
+    async def _stream_and_save(self, executor, response, item):
+        # Decoding and writing run in the executor chunk by chunk, awaited in order so the chunks stay sequential
+        media_key = item.media_key
+        loop = asyncio.get_running_loop()
+        decoder = None
+        try:
+            image_filename, prompt_filename = await loop.run_in_executor(executor, media_file_paths, media_key, self.output_folder, item.create_time, self.writer)
+            decoder = await loop.run_in_executor(executor, MediaStreamDecoder, image_filename, self.writer.stream_temp_folder)
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await loop.run_in_executor(executor, decoder.feed, chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if decoder:
+                decoder.abort()
+            raise # Retried by _download_one
+        except Exception as e:
+            if decoder:
+                decoder.abort()
+            print(f"  -> Failed to save image/prompt {media_key}: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        saved, on_complete = self._saved_future(loop)
+        await loop.run_in_executor(executor, finish_media_stream, media_key, decoder, prompt_filename, self.writer, on_complete,
+                                   item.create_time)
+        return await saved
+
+    def _saved_future(self, loop):
+        # The writer reports the result from its own threads, so it is handed back to the event loop thread-safely
+        saved = loop.create_future()
+        return saved, lambda result: loop.call_soon_threadsafe(saved.set_result, result)
+
+    def _parse_and_save(self, media_key, create_time, body, on_complete):
+        try:
+            response_json = json.loads(body)
+        except ValueError as e:
+            print(f"  -> Failed to parse media.fetchMedia response for {media_key}: {e!r}")
+            on_complete(download_result(False, error=f"invalid response: {e!r}"))
+            return
+        save_media_response(media_key, response_json, self.output_folder, create_time, self.writer, on_complete)
+
+
+class DownloadStateStore:
+    """
+    Records the download state of every mediaKey in a local SQLite database (status pending/done/failed, byte size, hash,
+    attempts and last error), so that an interrupted run can be resumed without downloading everything again.
+    """
+    def __init__(self, db_file="download_state.db"):
+        self.lock = threading.Lock() # The connection is shared by all download threads
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL") # In WAL mode commits then do not wait for an fsync
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "media_key TEXT PRIMARY KEY, create_time TEXT, status TEXT NOT NULL DEFAULT 'pending', "
+                "byte_size INTEGER, sha256 TEXT, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, updated_at TEXT, extension TEXT)"
+            )
+            if 'extension' not in {row[1] for row in self.connection.execute("PRAGMA table_info(downloads)")}: # Databases of older versions
+                self.connection.execute("ALTER TABLE downloads ADD COLUMN extension TEXT")
+
+    def mark_pending(self, item):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO downloads (media_key, create_time, status, updated_at) VALUES (?, ?, 'pending', ?) "
+                "ON CONFLICT(media_key) DO UPDATE SET create_time = excluded.create_time, status = 'pending', updated_at = excluded.updated_at",
+                (item.media_key, item.create_time, datetime.now().isoformat())
+            )
+
+    def record_result(self, media_key, result):
+        with self.lock, self.connection:
+            if result['success']:
+                self.connection.execute(
+                    "UPDATE downloads SET status = 'done', byte_size = ?, sha256 = ?, extension = ?, attempts = attempts + 1, last_error = NULL, "
+                    "updated_at = ? WHERE media_key = ?",
+                    (result['byte_size'], result['sha256'], result.get('extension'), datetime.now().isoformat(), media_key)
+                )
+            else:
+                self.connection.execute(
+                    "UPDATE downloads SET status = 'failed', attempts = attempts + 1, last_error = ?, updated_at = ? WHERE media_key = ?",
+                    (result['error'], datetime.now().isoformat(), media_key)
+                )
+
+    def get_done_media_keys(self, extension=None):
+        """
+        With extension, only the images saved with it (rows of older versions count as .jpg, the only extension they saved)
+        """
+        with self.lock:
+            if extension:
+                rows = self.connection.execute(
+                    "SELECT media_key FROM downloads WHERE status = 'done' AND COALESCE(extension, '.jpg') = ?", (extension,)
+                )
+            else:
+                rows = self.connection.execute("SELECT media_key FROM downloads WHERE status = 'done'")
+            return {row[0] for row in rows}
+
+    def get_unfinished_media_keys_info(self):
+        """
+        Returns the MediaKeyInfo records of the images that were queued but are not downloaded (pending or failed), newest first
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT media_key, create_time FROM downloads WHERE status != 'done' ORDER BY create_time DESC"
+            ).fetchall()
+        return [MediaKeyInfo(media_key, create_time) for media_key, create_time in rows]
+
+    def get_saved_images(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT media_key, create_time, sha256, extension FROM downloads WHERE status = 'done' AND sha256 IS NOT NULL"
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class PromptIndex:
+    """
+    Keeps the prompts of the saved images (mediaKey, creation time, image path, byte size and prompt) in one local SQLite
+    database with an FTS5 full-text index, instead of a small .txt file per image. The trigram tokenizer finds any part of a
+    prompt in any language (also Chinese, which has no spaces between words); without FTS5 the search scans the prompts.
+    """
+    def __init__(self, db_file="prompt_index.db"):
+        self.lock = threading.Lock() # The connection is shared by all writer threads
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                "id INTEGER PRIMARY KEY, media_key TEXT NOT NULL UNIQUE, create_time TEXT, image_path TEXT NOT NULL, byte_size INTEGER, prompt TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS prompts_create_time ON prompts (create_time)")
+            try:
+                self.connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(prompt, content='prompts', content_rowid='id', tokenize='trigram')"
+                )
+                self.full_text = True
+            except sqlite3.OperationalError: # SQLite older than 3.34 or built without FTS5
+                self.full_text = False
+            if self.full_text: # Triggers keep the index in step with the prompts table
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_insert AFTER INSERT ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (rowid, prompt) VALUES (new.id, new.prompt); END"
+                )
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_delete AFTER DELETE ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END"
+                )
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_update AFTER UPDATE ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); "
+                    "INSERT INTO prompts_fts (rowid, prompt) VALUES (new.id, new.prompt); END"
+                )
+
+    def add_prompts(self, rows):
+        """
+        Adds or replaces (media_key, create_time, image_path, byte_size, prompt) rows in a single transaction
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO prompts (media_key, create_time, image_path, byte_size, prompt) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(media_key) DO UPDATE SET create_time = COALESCE(excluded.create_time, create_time), "
+                "image_path = excluded.image_path, byte_size = excluded.byte_size, prompt = excluded.prompt",
+                rows
+            )
+
+    def get_media_keys(self):
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT media_key FROM prompts")}
+
+    def search(self, query, max_results=100):
+        """
+        Returns the images whose prompt contains every word of query (case-insensitive), newest first, as dicts with the keys
+        media_key, create_time, image_path, byte_size and prompt. Words of 3 or more characters are looked up in the full-text
+        index, shorter ones (the trigram index cannot find them) are matched with LIKE among those results.
+        """
+        words = query.split()
+        full_text_words = [word for word in words if len(word) >= 3] if self.full_text else []
+        conditions = []
+        parameters = []
+        if full_text_words:
+            conditions.append("id IN (SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH ?)")
+            parameters.append(" ".join('"' + word.replace('"', '""') + '"' for word in full_text_words)) # Quoted, so the words are never read as query syntax
+        for word in words:
+            if word not in full_text_words:
+                conditions.append("prompt LIKE ? ESCAPE '\\'")
+                parameters.append("%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        sql = "SELECT media_key, create_time, image_path, byte_size, prompt FROM prompts"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY create_time DESC LIMIT ?"
+        parameters.append(max_results if max_results else -1)
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [dict(zip(('media_key', 'create_time', 'image_path', 'byte_size', 'prompt'), row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
 
 
 if __name__ == "__main__":
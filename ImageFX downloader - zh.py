@@ -1,94 +1,2588 @@
 import requests
 from requests.adapters import Retry, HTTPAdapter
+import argparse
 import json
+import copy
 import base64
+import re
 import os
+import sys
 import time
 import threading
-from datetime import datetime
+import queue
+import asyncio
+import sqlite3
+import hashlib
+import heapq
+import itertools
+import bisect
+import io
+import tarfile
+import tempfile
+import pickle
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, CancelledError
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    import aiohttp #  可选依赖，仅 asyncio 下载引擎需要
+except ImportError:
+    aiohttp = None
+try:
+    import boto3 #  可选依赖，仅 S3 输出需要
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+try:
+    from PIL import Image #  可选依赖，仅重新编码图片和生成缩略图时需要
+except ImportError:
+    Image = None
+
+
+FETCH_MEDIA_API_URL = "https://labs.google/fx/api/trpc/media.fetchMedia"
+FETCH_USER_HISTORY_API_URL = "https://labs.google/fx/api/trpc/media.fetchUserHistory"
+BATCH_UNSUPPORTED_STATUS_CODES = (400, 404, 405, 413, 414, 431) #  批量请求整体被拒绝，例如未启用批量调用或 URL 过长
+LOGIN_URL_PREFIX = "https://accounts.google.com/" #  cookie 过期的请求会被重定向到 Google 登录页面
+MIN_PAGE_SIZE = 12 #  ImageFX 网页本身请求的页面大小
+STREAM_CHUNK_SIZE = 64 * 1024
+PREVIEW_FOLDER_NAME = "previews" #  分级模式的预览图保存在输出文件夹的这个子文件夹中
+THUMBNAIL_FOLDER_NAME = "thumbnails" #  图片旁边存放其缩略图的子文件夹，见 ImagePostProcessor
+IMAGE_FORMATS = {'.jpg': ('JPEG', 'image/jpeg'), '.png': ('PNG', 'image/png'), '.webp': ('WEBP', 'image/webp'), '.gif': ('GIF', 'image/gif')} #  扩展名: (Pillow 格式, Content-Type)
+
+
+def fetch_media_input(media_key, height=None, width=None):
+    """
+    构造 media.fetchMedia 的 tRPC 输入，不指定 height/width 时返回原图
+    """
+    input_json = {"json": {"mediaKey": media_key, "height": height, "width": width}}
+    undefined_values = {name: ["undefined"] for name, value in (("height", height), ("width", width)) if value is None}
+    if undefined_values:
+        input_json["meta"] = {"values": undefined_values}
+    return input_json
 
-def download_image_and_prompt(media_key, cookies, output_folder="imagefx_images", create_time=None,
-                                    total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
-                                    on_thread_complete=None): # 修改: on_thread_complete 接收下载结果
+
+def fetch_media_params(media_key, height=None, width=None):
+    return {"input": json.dumps(fetch_media_input(media_key, height, width), separators=(",", ":"))}
+
+
+def fetch_user_history_params(cursor="", limit=100):
+    return {"input": json.dumps({"json": {"cursor": cursor, "limit": limit, "type": "IMAGE_FX"}, "meta": {"values": {}}}, separators=(",", ":"))}
+
+
+def fetch_media_batch_url(count):
     """
-    使用 mediaKey 下载原图和提示词，并按日期保存到子文件夹 (修改后版本)
+    包含 count 个 media.fetchMedia 调用的 tRPC 批量请求的 URL，路径中每个调用列出一次过程名
     """
-    api_url = "https://labs.google/fx/api/trpc/media.fetchMedia"
-    params = {
-        "input": '{"json":{"mediaKey":"' + media_key + '","height":null,"width":null},"meta":{"values":{"height":["undefined"],"width":["undefined"]}}}'
-    }
-    session = requests.Session()
-    retries = Retry(total=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+    base_url, procedure = FETCH_MEDIA_API_URL.rsplit("/", 1)
+    return base_url + "/" + ",".join([procedure] * count)
+
+
+def fetch_media_batch_params(media_keys, height=None, width=None):
+    #  批量请求的输入以调用的序号为键
+    inputs = {str(index): fetch_media_input(media_key, height, width) for index, media_key in enumerate(media_keys)}
+    return {"batch": "1", "input": json.dumps(inputs, separators=(",", ":"))}
+
 
-    success = False #  标记下载是否成功
+def parse_retry_after(value):
+    """
+    把 Retry-After 响应头 (秒数或 HTTP 日期) 转换为秒数，缺失或无效时返回 None
+    """
+    if not value:
+        return None
     try:
-        response = session.get(api_url, params=params, cookies=cookies, timeout=30)
-        response.encoding = 'utf-8'
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-        if response.status_code == 200:
-            response_json = response.json()
-            result_data_json_result = response_json['result']['data']['json']['result']
-            encoded_image = result_data_json_result['image']['encodedImage']
-            prompt_text = result_data_json_result.get('image').get('prompt')
 
-            if encoded_image:
+def is_auth_failure(status_code, url):
+    """
+    401/403 响应，或者被重定向到 Google 登录页面，表示 cookie 已过期或已退出登录
+    """
+    return status_code in (401, 403) or str(url).startswith(LOGIN_URL_PREFIX)
+
+
+class AdaptiveRateController:
+    """
+    所有下载工作线程共享的 AIMD 并发控制器。每当一整轮请求都快速成功时，允许同时进行的请求数加一；
+    遇到 429/503 或延迟超过移动平均值的 latency_factor 倍时，乘以 decrease_factor 降低并发。
+    Retry-After 响应头会暂停所有工作线程，而不仅仅是收到它的那一个。
+    """
+    def __init__(self, max_limit, min_limit=1, initial_limit=None, latency_factor=2.0, decrease_factor=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 2))
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.pause_until = 0.0
+        self.average_latency = None
+        self.last_decrease_time = 0.0
+        self.condition = threading.Condition()
+
+    def current_limit(self):
+        return max(self.min_limit, min(self.max_limit, int(self.limit)))
+
+    def pause_remaining(self):
+        return max(0.0, self.pause_until - time.monotonic())
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.pause_remaining()
+                if pause:
+                    self.condition.wait(pause)
+                elif self.in_flight < self.current_limit():
+                    break
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self.condition:
+            if self.pause_remaining() or self.in_flight >= self.current_limit():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def wait_if_paused(self):
+        pause = self.pause_remaining()
+        if pause:
+            time.sleep(pause)
+
+    def record_response(self, status, latency=None, retry_after=None):
+        with self.condition:
+            now = time.monotonic()
+            if retry_after:
+                self.pause_until = max(self.pause_until, now + retry_after)
+            if status in (429, 503):
+                self._decrease(now, f"HTTP {status}")
+            elif status == 200 and latency is not None:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                if latency > self.average_latency * self.latency_factor:
+                    self._decrease(now, f"延迟 {latency:.2f} 秒")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit) #  一整轮请求成功后加一
+                self.average_latency = 0.9 * self.average_latency + 0.1 * latency
+            self.condition.notify_all()
+
+    def _decrease(self, now, reason):
+        #  上次降低之前发出的请求的响应不应再次降低并发
+        if now - self.last_decrease_time < (self.average_latency or 1.0):
+            return
+        self.last_decrease_time = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        print(f"  -> 速率控制: {reason}，并发数降低到 {self.current_limit()}")
+
+
+class SharedLimiter:
+    """
+    多个账号的下载器共用的限制: 所有账号合计的并发请求数 (max_concurrency)，以及每秒保存的图片字节数
+    (max_bytes_per_second，令牌桶，允许一秒的突发)。每个下载器仍会先应用自己的限制 (线程数、AdaptiveRateController)。
+    """
+    def __init__(self, max_concurrency=None, max_bytes_per_second=None):
+        self.max_concurrency = max_concurrency
+        self.max_bytes_per_second = max_bytes_per_second
+        self.in_flight = 0
+        self.available_bytes = float(max_bytes_per_second or 0)
+        self.last_refill_time = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _wait_time(self):
+        #  带宽预算恢复为正数前需要等待的秒数，已完成图片的字节数在事后扣除
+        if not self.max_bytes_per_second:
+            return 0.0
+        now = time.monotonic()
+        self.available_bytes = min(self.max_bytes_per_second, self.available_bytes + (now - self.last_refill_time) * self.max_bytes_per_second)
+        self.last_refill_time = now
+        return max(0.0, -self.available_bytes / self.max_bytes_per_second)
+
+    def _full(self):
+        return self.max_concurrency and self.in_flight >= self.max_concurrency
+
+    def wait_time(self):
+        with self.condition:
+            return self._wait_time()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait_time = self._wait_time()
+                if not wait_time and not self._full():
+                    break
+                self.condition.wait(wait_time or None)
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self.condition:
+            if self._wait_time() or self._full():
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record_bytes(self, byte_size):
+        with self.condition:
+            self._wait_time()
+            self.available_bytes -= byte_size
+
+
+class ControlledRetry(Retry):
+    """
+    在退避等待之前把每个需要重试的响应报告给 AdaptiveRateController 的 urllib3 Retry，
+    并在 DownloadMetrics 中按状态码 (或异常名称) 统计重试次数
+    """
+    def __init__(self, *args, rate_controller=None, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_controller = rate_controller
+        self.metrics = metrics
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_controller = self.rate_controller
+        retry.metrics = self.metrics
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.rate_controller and response is not None:
+            self.rate_controller.record_response(response.status, retry_after=self.get_retry_after(response))
+        if self.metrics:
+            self.metrics.record_retry(response.status if response is not None else type(error).__name__)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class DownloadMetrics:
+    """
+    下载流水线的线程安全指标: 图片和字节计数、按状态码统计的重试次数、各阶段的延迟直方图
+    (http: 直到收到响应头，decode: base64 解码，write: 保存文件)，以及队列深度等在生成快照时读取的仪表值。
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    STAGES = ('http', 'decode', 'write')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.total = None #  要下载的图片数量，未知时为 None (例如抓取仍在进行中)
+        self.queued = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes_saved = 0
+        self.retries_by_status = {}
+        self.histograms = {stage: {'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0} for stage in self.STAGES}
+        self.gauges = {}
+        self.show_progress_bar = False #  由 MetricsReporter 设置，此时下载器不再打印自己的进度
+
+    def add_total(self, count):
+        with self.lock:
+            self.total = (self.total or 0) + count
+
+    def set_gauge(self, name, read_value):
+        with self.lock:
+            self.gauges[name] = read_value
+
+    def record_queued(self, count=1):
+        with self.lock:
+            self.queued += count
+
+    def record_retry(self, status):
+        with self.lock:
+            self.retries_by_status[str(status)] = self.retries_by_status.get(str(status), 0) + 1
+
+    def record_result(self, result):
+        with self.lock:
+            if result['success']:
+                self.succeeded += 1
+                self.bytes_saved += result['byte_size'] or 0
+            else:
+                self.failed += 1
+            for stage, seconds in result['timings'].items():
+                histogram = self.histograms[stage]
+                histogram['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+                histogram['sum'] += seconds
+                histogram['count'] += 1
+                histogram['max'] = max(histogram['max'], seconds)
+
+    def _percentile(self, histogram, fraction):
+        #  百分位所在桶的上界，超出最大桶时为观测到的最大值
+        if not histogram['count']:
+            return None
+        cumulative_count = 0
+        for bucket_index, count in enumerate(histogram['buckets']):
+            cumulative_count += count
+            if cumulative_count >= fraction * histogram['count']:
+                break
+        if bucket_index < len(self.LATENCY_BUCKETS):
+            return min(self.LATENCY_BUCKETS[bucket_index], histogram['max'])
+        return histogram['max']
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            completed = self.succeeded + self.failed
+            expected = self.total if self.total is not None else self.queued
+            images_per_second = completed / elapsed if elapsed else 0.0
+            snapshot = {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'elapsed_seconds': round(elapsed, 3),
+                'images_total': self.total,
+                'images_queued': self.queued,
+                'images_succeeded': self.succeeded,
+                'images_failed': self.failed,
+                'bytes_saved': self.bytes_saved,
+                'images_per_second': round(images_per_second, 3),
+                'bytes_per_second': round(self.bytes_saved / elapsed if elapsed else 0.0, 1),
+                'eta_seconds': round((expected - completed) / images_per_second, 1) if images_per_second and expected >= completed else None,
+                'retries_by_status': dict(self.retries_by_status),
+                'stages': {
+                    stage: {'count': histogram['count'], 'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+                            'p50': self._percentile(histogram, 0.5), 'p99': self._percentile(histogram, 0.99)}
+                    for stage, histogram in self.histograms.items()
+                },
+            }
+            gauges = dict(self.gauges)
+        snapshot['gauges'] = {name: read_value() for name, read_value in gauges.items()} #  在锁外读取，它们会获取自己的锁
+        return snapshot
+
+    def prometheus_text(self):
+        """
+        以 Prometheus 文本格式返回指标
+        """
+        snapshot = self.snapshot()
+        with self.lock:
+            histograms = {stage: dict(histogram, buckets=list(histogram['buckets'])) for stage, histogram in self.histograms.items()}
+        lines = [
+            "# TYPE imagefx_images_total counter",
+            f'imagefx_images_total{{result="succeeded"}} {snapshot["images_succeeded"]}',
+            f'imagefx_images_total{{result="failed"}} {snapshot["images_failed"]}',
+            "# TYPE imagefx_images_queued_total counter",
+            f"imagefx_images_queued_total {snapshot['images_queued']}",
+            "# TYPE imagefx_bytes_saved_total counter",
+            f"imagefx_bytes_saved_total {snapshot['bytes_saved']}",
+            "# TYPE imagefx_retries_total counter",
+        ]
+        lines += [f'imagefx_retries_total{{status="{status}"}} {count}' for status, count in sorted(snapshot['retries_by_status'].items())]
+        lines.append("# TYPE imagefx_stage_seconds histogram")
+        for stage, histogram in histograms.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), histogram['buckets']):
+                cumulative_count += count
+                lines.append(f'imagefx_stage_seconds_bucket{{stage="{stage}",le="{upper_bound}"}} {cumulative_count}')
+            lines.append(f'imagefx_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'imagefx_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        for name, value in snapshot['gauges'].items():
+            lines += [f"# TYPE imagefx_{name} gauge", f"imagefx_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """
+    在下载过程中报告 DownloadMetrics: 每隔 metrics_interval 秒向 metrics_file 追加一行 JSON ("-" 表示控制台)，
+    显示带预计剩余时间的进度条，以及在 http://127.0.0.1:<prometheus_port>/metrics 提供 Prometheus 文本接口
+    """
+    def __init__(self, metrics, metrics_file=None, metrics_interval=10, progress_bar=False, prometheus_port=None):
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.progress_bar = progress_bar
+        self.prometheus_port = prometheus_port
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.prometheus_server = None
+        self.progress_line_length = 0
+
+    def start(self):
+        self.metrics.show_progress_bar = self.progress_bar
+        if self.prometheus_port is not None:
+            metrics = self.metrics
+
+            class MetricsRequestHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    data = metrics.prometheus_text().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.prometheus_server = ThreadingHTTPServer(("127.0.0.1", self.prometheus_port), MetricsRequestHandler)
+            self.prometheus_server.daemon_threads = True
+            threading.Thread(target=self.prometheus_server.serve_forever, daemon=True).start()
+        if self.metrics_file or self.progress_bar:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            snapshot = self.metrics.snapshot()
+            if self.progress_bar:
+                self._draw_progress_bar(snapshot)
+                print("")
+            if self.metrics_file:
+                self._write_json_line(snapshot) #  最终总计
+        if self.prometheus_server:
+            self.prometheus_server.shutdown()
+            self.prometheus_server.server_close()
+        self.metrics.show_progress_bar = False
+
+    def _run(self):
+        next_report_time = time.monotonic() + self.metrics_interval
+        while not self.stop_event.wait(0.5 if self.progress_bar else max(0.5, next_report_time - time.monotonic())):
+            snapshot = self.metrics.snapshot()
+            if self.progress_bar:
+                self._draw_progress_bar(snapshot)
+            if self.metrics_file and time.monotonic() >= next_report_time:
+                self._write_json_line(snapshot)
+                next_report_time += self.metrics_interval
+
+    def _write_json_line(self, snapshot):
+        line = json.dumps(snapshot, ensure_ascii=False)
+        if self.metrics_file == "-":
+            if self.progress_bar:
+                print("")
+            print(line)
+            return
+        with open(self.metrics_file, "a", encoding='utf-8') as f:
+            f.write(line + "\n")
+
+    def _draw_progress_bar(self, snapshot):
+        completed = snapshot['images_succeeded'] + snapshot['images_failed']
+        total = snapshot['images_total']
+        if total:
+            fraction = min(1.0, completed / total)
+            filled = int(fraction * 30)
+            progress = f"[{'#' * filled}{'-' * (30 - filled)}] {completed}/{total} {fraction:.0%}"
+        else:
+            progress = f"{completed}/{snapshot['images_queued']}"
+        eta = snapshot['eta_seconds']
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "--:--:--"
+        line = (f"{progress} | {snapshot['images_per_second']:.1f} 张/秒 | {snapshot['bytes_per_second'] / 1e6:.1f} MB/s | "
+                f"失败 {snapshot['images_failed']} | 剩余 {eta_text}")
+        print("\r" + line.ljust(self.progress_line_length), end="", flush=True)
+        self.progress_line_length = len(line)
+
+
+class RetryScheduler:
+    """
+    失败下载的延迟重试，在单个请求的 urllib3 内联重试之外: 失败的图片在 retry_delay * 2 ** (attempt - 1) 秒后
+    重新排到工作队列末尾，最多尝试 max_attempts 次，因此不会有工作线程为此等待。同时统计仍在处理中的图片，
+    让投递任务的一方知道最后一次重试何时完成。
+    """
+    def __init__(self, max_attempts=3, retry_delay=10):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.attempts = {} #  至少失败过一次的图片目前的尝试次数
+        self.due_items = [] #  (到期时间, 序号, item) 的堆
+        self.sequence = itertools.count()
+        self.in_progress = 0
+        self.failed_items = [] #  最终失败的图片的 (item, error, attempts)
+        self.succeeded_media_keys = set() #  本次运行下载成功的图片，会从失败报告中移除
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            self.in_progress += 1
+
+    def schedule_retry(self, item):
+        """
+        为失败的图片安排下一次尝试并返回其延迟时间，尝试次数用完时返回 None
+        """
+        with self.condition:
+            attempts = self.attempts.get(item.media_key, 1)
+            if attempts >= self.max_attempts:
+                return None
+            self.attempts[item.media_key] = attempts + 1
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            heapq.heappush(self.due_items, (time.monotonic() + delay, next(self.sequence), item))
+            self.condition.notify_all()
+            return delay
+
+    def requeue(self, item):
+        """
+        立即把图片放回队列末尾，不计入尝试次数 (cookie 过期之后)
+        """
+        with self.condition:
+            heapq.heappush(self.due_items, (time.monotonic(), next(self.sequence), item))
+            self.condition.notify_all()
+
+    def finish(self, item, result):
+        with self.condition:
+            attempts = self.attempts.pop(item.media_key, 1)
+            if result['success']:
+                self.succeeded_media_keys.add(item.media_key)
+            else:
+                self.failed_items.append((item, result['error'], attempts))
+            self.in_progress -= 1
+            self.condition.notify_all()
+
+    def pop_due(self):
+        with self.condition:
+            if self.due_items and self.due_items[0][0] <= time.monotonic():
+                return heapq.heappop(self.due_items)[2]
+            return None
+
+    def seconds_until_due(self):
+        with self.condition:
+            return max(0.0, self.due_items[0][0] - time.monotonic()) if self.due_items else None
+
+    def is_finished(self):
+        with self.condition:
+            return not self.in_progress
+
+    def wait_for_retry(self):
+        """
+        阻塞直到有重试到期并返回其 item，所有图片都处理完毕后返回 None
+        """
+        with self.condition:
+            while self.in_progress:
+                if self.due_items and self.due_items[0][0] <= time.monotonic():
+                    return heapq.heappop(self.due_items)[2]
+                self.condition.wait(self.due_items[0][0] - time.monotonic() if self.due_items else None)
+            return None
+
+
+def write_failed_keys_report(failed_keys_file, failed_items, downloaded_media_keys=(), state_store=None):
+    """
+    把最终失败的图片写入 failed_keys_file，格式为抓取结果文件的 JSON Lines 格式，另加错误信息和尝试次数，
+    这样可以用 download --crawl-result-file <failed_keys_file> 重新下载它们。
+    之前运行留下的条目会保留，直到其图片被下载 (在 downloaded_media_keys 中，或图片作为已下载而被跳过时，
+    在 state_store 中已完成) 或再次失败。
+    """
+    failed_media_keys = {item.media_key for item, _, _ in failed_items}
+    entries = []
+    if os.path.exists(failed_keys_file):
+        if state_store:
+            downloaded_media_keys = set(downloaded_media_keys) | state_store.get_done_media_keys()
+        with open(failed_keys_file, 'r', encoding='utf-8') as f:
+            for line in f:
                 try:
-                    image_data = base64.b64decode(encoded_image)
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                media_key = entry.get('media_key') if isinstance(entry, dict) else None
+                if media_key and media_key not in downloaded_media_keys and media_key not in failed_media_keys:
+                    entries.append(entry)
+    elif not failed_items:
+        return
+    entries.extend(dict(item.to_dict(), error=error, attempts=attempts) for item, error, attempts in failed_items)
+    temp_filename = failed_keys_file + ".part"
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(temp_filename, failed_keys_file)
+    if failed_items:
+        print(f"{len(failed_items)} 张图片未能下载，'{failed_keys_file}' 列出了仍未下载的 {len(entries)} 张图片 "
+              f"(可以用 download --crawl-result-file {failed_keys_file} 重新下载)。")
 
-                    if create_time:
-                        date_object = datetime.fromisoformat(create_time.replace("Z", "+00:00"))
-                        date_folder_name = date_object.strftime("%Y-%m-%d")
-                        date_folder_path = os.path.join(output_folder, date_folder_name)
-                        os.makedirs(date_folder_path, exist_ok=True)
 
-                        image_filename = os.path.join(date_folder_path, f"{media_key}.jpg")
-                        prompt_filename = os.path.join(date_folder_path, f"{media_key}.txt")
-                    else:
-                        image_filename = os.path.join(output_folder, f"{media_key}.jpg")
-                        prompt_filename = os.path.join(output_folder, f"{media_key}.txt")
+def read_cookie_file(cookie_file):
+    with open(cookie_file, 'r', encoding='utf-8') as f:
+        return f.read().strip()
 
-                    with open(image_filename, "wb") as f:
-                        f.write(image_data)
 
-                    if prompt_text:
-                        with open(prompt_filename, "w", encoding='utf-8') as f:
-                            f.write(prompt_text)
-                    else:
-                        print(f"  -> 警告: 未在响应中找到提示词 for {media_key}")
-                    success = True #  标记为成功
+class AuthMonitor:
+    """
+    在运行过程中 cookie 过期时暂停下载，而不是让剩下的所有图片都下载失败。被拒绝的请求通过 report_rejected() 报告后，
+    先用一个开销很小的已认证请求确认 (服务器也可能只拒绝单张图片)，然后所有工作线程在 wait_until_valid() 中暂停，
+    直到有新的 cookie: 每隔 poll_interval 秒重新读取 cookie_file，最多等待
+    wait_time 秒，或者在 prompt 模式下请用户粘贴新的 cookie。cookies 是抓取器和下载器共用的 {'Cookie': cookie_string}
+    字典，新的 cookie 会保存到其中。没有新 cookie 的来源，或者超过 wait_time 后，剩下的图片不再请求，直接记为失败。
+    """
+    def __init__(self, cookies, cookie_file=None, prompt=False, wait_time=3600, poll_interval=5):
+        self.cookies = cookies
+        self.cookie_file = cookie_file
+        self.prompt = prompt
+        self.wait_time = wait_time
+        self.poll_interval = poll_interval
+        self.expired_cookie = None #  等待新 cookie 期间，被拒绝的 cookie
+        self.expired_time = None
+        self.gave_up = False
+        self.probing = False #  cookie_is_expired() 正在确认一次拒绝
+        self.condition = threading.Condition()
+
+    def report_rejected(self, cookie):
+        """
+        报告 cookie 被拒绝的请求，返回是否应该用新的 cookie 重新请求该图片。如果 cookie 仍然有效，返回 False 但不放弃
+        (gave_up 仍为 False)，调用方此时把这次拒绝视为仅这张图片的失败。
+        """
+        with self.condition:
+            waited = self.probing
+            while self.probing: #  另一个工作线程正在确认一次拒绝，它的结果同样适用于这个请求
+                self.condition.wait()
+            if self.gave_up:
+                return False
+            if self.expired_cookie is not None or cookie != self.cookies['Cookie']: #  已经暂停，或已被更新的 cookie 替换
+                return True
+            if waited:
+                return False #  另一个工作线程的请求已确认 cookie 仍然有效
+            self.probing = True
+        expired = self.cookie_is_expired(cookie)
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+            if not expired:
+                return False
+            if not self.cookie_file and not self.prompt:
+                self.gave_up = True
+                print("Cookie 被拒绝 (已过期或已退出登录)，跳过剩下的图片。请使用新的 cookie 重新运行，"
+                      "使用 --cookie-file 则可以在运行过程中重新加载 cookie。")
+                return False
+            self.expired_cookie = cookie
+            self.expired_time = time.monotonic()
+            if self.cookie_file:
+                print(f"Cookie 被拒绝 (已过期或已退出登录)，下载已暂停。请把新的 Cookie 字符串保存到 '{self.cookie_file}' "
+                      f"以继续 (最多等待 {self.wait_time:g} 秒)。")
+            return True
+
+    def cookie_is_expired(self, cookie):
+        """
+        用 cookie 请求最新的一条历史记录，返回 cookie 是否在那里也被拒绝
+        """
+        try:
+            response = requests.get(FETCH_USER_HISTORY_API_URL, params=fetch_user_history_params(limit=1), cookies={'Cookie': cookie}, timeout=30)
+        except requests.exceptions.RequestException:
+            return False #  无法确定，该图片像其他下载失败的图片一样重试
+        response.close()
+        return is_auth_failure(response.status_code, response.url)
+
+    def is_paused(self):
+        with self.condition:
+            return self.expired_cookie is not None
+
+    def _load_new_cookie(self):
+        if self.prompt:
+            return input("\nCookie 被拒绝 (已过期或已退出登录)，下载已暂停。\n"
+                         "请粘贴新的 Cookie 字符串以继续 (留空则停止): ").strip() or None
+        try:
+            return read_cookie_file(self.cookie_file)
+        except OSError: #  文件可能正在被替换，下次轮询时再读取
+            return ""
+
+    def wait_until_valid(self):
+        """
+        cookie 过期期间阻塞，放弃等待新 cookie 后返回 False
+        """
+        with self.condition:
+            while self.expired_cookie is not None:
+                new_cookie = self._load_new_cookie()
+                if new_cookie and new_cookie != self.expired_cookie:
+                    self.cookies['Cookie'] = new_cookie
+                    self.expired_cookie = None
+                    print("已加载新的 cookie，继续下载。")
+                elif new_cookie is None or time.monotonic() - self.expired_time >= self.wait_time:
+                    self.gave_up = True
+                    self.expired_cookie = None
+                    print("没有新的 cookie，跳过剩下的图片。请使用新的 cookie 重新运行以下载它们。")
+                else:
+                    self.condition.wait(self.poll_interval) #  其他线程可能在此期间加载了新的 cookie
+                    continue
+                self.condition.notify_all()
+            return not self.gave_up
+
+
+def download_result(success, byte_size=None, sha256=None, error=None, auth_failed=False):
+    #  timings 记录每个 DownloadMetrics 阶段所用的秒数
+    return {'success': success, 'byte_size': byte_size, 'sha256': sha256, 'error': error, 'auth_failed': auth_failed, 'extension': None,
+            'timings': {}}
+
+
+def media_folder(output_folder, create_time=None):
+    if create_time:
+        date_object = datetime.fromisoformat(create_time.replace("Z", "+00:00"))
+        date_folder_name = date_object.strftime("%Y-%m-%d")
+        return os.path.join(output_folder, date_folder_name)
+    return output_folder
+
+
+def media_file_paths(media_key, output_folder="imagefx_images", create_time=None, writer=None):
+    """
+    返回 mediaKey 对应的图片和提示词文件路径，需要时创建 create_time 对应的日期子文件夹
+    """
+    if writer and writer.shard_writer: #  分片之外只写临时文件，日期文件夹在分片内部
+        folder = output_folder
+    else:
+        folder = media_folder(output_folder, create_time)
+    if writer:
+        writer.ensure_folder(folder)
+    else:
+        os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{media_key}.jpg"), os.path.join(folder, f"{media_key}.txt")
+
+
+def unique_temp_filename(filename, suffix=".part"):
+    """
+    返回 filename 旁边一个新的临时文件名，名称随机，因此同时写入同一文件的多个写入者不会共用临时文件。
+    请用 "xb" 模式打开，而不是使用 tempfile.mkstemp，否则其 0600 权限会保留在重命名到位的文件上。
+    """
+    return f"{filename}.{os.urandom(6).hex()}{suffix}"
+
+
+def thumbnail_file_path(image_filename):
+    return os.path.join(os.path.dirname(image_filename), THUMBNAIL_FOLDER_NAME, os.path.basename(image_filename))
+
+
+def image_media_key(filename):
+    """
+    返回图片文件名 (<mediaKey>.jpg 或 IMAGE_FORMATS 中的其他扩展名) 中的 mediaKey，其他文件返回 None
+    """
+    media_key, extension = os.path.splitext(filename)
+    return media_key if extension in IMAGE_FORMATS else None
+
+
+def converted_extension(convert_format=None):
+    """
+    返回图片重新编码为 convert_format 时保存使用的扩展名，没有 convert_format 时返回 None
+    """
+    return "." + convert_format if convert_format else None
+
+
+def sniff_image_extension(data):
+    """
+    根据 data 开头的魔数返回图片格式对应的扩展名，其他情况返回 .jpg
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return ".gif"
+    return ".jpg"
+
+
+def fsync_folder(folder):
+    if os.name == 'nt':
+        return #  Windows 上无法打开文件夹，NTFS 会自行记录重命名操作
+    folder_fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(folder_fd)
+    finally:
+        os.close(folder_fd)
+
+
+def encode_image(image, extension, quality=90):
+    image_format = IMAGE_FORMATS[extension][0]
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB') #  JPEG 没有透明通道
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+def post_process_image(image_data, temp_filename=None, convert_format=None, quality=90, thumbnail_size=None):
+    """
+    后处理一张已解码的图片 (image_data 字节，或文件 temp_filename)，在 ImagePostProcessor 的工作进程中运行。返回 (extension,
+    image_data, thumbnail_data): 检测到的格式的扩展名 (重新编码后为 convert_format 的扩展名)、重新编码后的字节 (保留下载的字节时为
+    None)，以及同一格式、不超过 thumbnail_size 像素的缩略图 (未设置 thumbnail_size 时为 None)。
+    """
+    decode = convert_format or thumbnail_size
+    if image_data is None:
+        with open(temp_filename, "rb") as f:
+            image_data = f.read() if decode else f.read(16) #  只检测格式时只需要魔数
+    extension = sniff_image_extension(image_data)
+    converted_data = thumbnail_data = None
+    if decode:
+        image = Image.open(io.BytesIO(image_data))
+        if convert_format and "." + convert_format != extension:
+            extension = "." + convert_format
+            converted_data = encode_image(image, extension, quality)
+        if thumbnail_size:
+            image.thumbnail((thumbnail_size, thumbnail_size))
+            thumbnail_data = encode_image(image, extension, quality)
+    return extension, converted_data, thumbnail_data
+
+
+class ImagePostProcessor:
+    """
+    位于下载工作线程和 FileWriter 之间的后处理阶段。每张图片按照根据魔数检测到的真实格式以相应的扩展名保存，可选择重新编码为
+    convert_format ('jpg'、'png' 或 'webp'，质量为 quality)，并在图片旁边的 thumbnails 子文件夹中生成 thumbnail_size 像素的缩略图。
+    重新编码和缩略图需要 Pillow，在 processes 个工作进程 (默认: 每个 CPU 核心一个) 的进程池中运行，直接处理下载器刚解码的字节，
+    而不是再次读取已保存的文件，并利用下载线程闲置的 CPU 核心。工作进程无法导入本脚本时 (例如用 importlib 加载时) 或进程池损坏时，
+    改为在写入线程中后处理图片。
+    """
+    def __init__(self, convert_format=None, quality=90, thumbnail_size=None, processes=None):
+        if convert_format and "." + convert_format not in IMAGE_FORMATS:
+            raise ValueError(f"未知的图片格式: {convert_format}")
+        if (convert_format or thumbnail_size) and Image is None:
+            raise RuntimeError("重新编码图片和生成缩略图需要 Pillow，请先安装: pip install Pillow")
+        self.convert_format = convert_format
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.lock = threading.Lock()
+        #  只检测格式时只读取几个字节，由写入线程完成，不需要进程池
+        self.executor = self._create_pool(processes) if convert_format or thumbnail_size else None
+
+    def _create_pool(self, processes):
+        try:
+            pickle.dumps(post_process_image) #  工作进程按模块名导入本脚本来找到该函数
+        except (pickle.PicklingError, AttributeError, TypeError):
+            print("后处理工作进程无法导入本脚本，改为在写入线程中后处理图片。")
+            return None
+        #  工作进程从一个全新的进程启动，fork 一个下载线程正在运行的进程可能会死锁
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(start_method))
+
+    def _stop_pool(self, error):
+        with self.lock:
+            if self.executor is None:
+                return
+            executor, self.executor = self.executor, None
+        print(f"后处理工作进程出错 ({error!r})，改为在写入线程中后处理图片。")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, image_data=None, temp_filename=None):
+        """
+        在工作进程中开始后处理图片并返回其 Future，没有进程池时返回 None
+        """
+        executor = self.executor
+        if executor is None:
+            return None
+        try:
+            return executor.submit(post_process_image, image_data, temp_filename, self.convert_format, self.quality, self.thumbnail_size)
+        except RuntimeError: #  进程池在此期间损坏或已停止，process() 会在写入线程中处理
+            return None
+
+    def process(self, image_data=None, temp_filename=None, future=None):
+        """
+        返回 post_process_image 的 (extension, image_data, thumbnail_data)，有 submit() 的 Future 时从中取得。
+        进程池本身出错不算图片失败，此时在调用线程中处理该图片。
+        """
+        if future:
+            try:
+                return future.result()
+            except (BrokenExecutor, pickle.PicklingError, CancelledError) as e:
+                self._stop_pool(e)
+        return post_process_image(image_data, temp_filename, self.convert_format, self.quality, self.thumbnail_size)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
 
-                except Exception as e:
-                    print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+
+def build_post_processor(detect_format=False, convert_format=None, quality=90, thumbnail_size=None, processes=None):
+    """
+    设置了 detect_format、convert_format 或 thumbnail_size 时返回 ImagePostProcessor，否则返回 None (此时每张图片按下载的原样保存为 .jpg)
+    """
+    if not detect_format and not convert_format and not thumbnail_size:
+        return None
+    return ImagePostProcessor(convert_format, quality, thumbnail_size, processes)
+
+
+class FileWriter:
+    """
+    下载流水线的写入阶段。下载工作线程通过 submit() 交出解码后的图片，写入线程先写入名称唯一的临时 ".part" 文件，再用 os.replace
+    移动到最终位置，因此中断的运行不会在最终文件名下留下不完整的图片。fsync=True 时每个文件在计为已保存之前都会刷新到磁盘，
+    一整批文件重命名后，其所在文件夹只同步一次。writer_threads=0 时直接在调用线程中写入。
+    dedup=True 时，SHA-256 与之前保存过的图片相同的图片会硬链接到那张图片，而不是再写入一份。
+    传入 prompt_index (PromptIndex) 时，每批写好的文件的提示词在一个事务中写入该索引，prompt_files=False 时不再在每张图片旁边写 .txt 文件。
+    传入 shard_writer (ArchiveShardWriter) 时，文件被追加到它的 tar 分片中，而不是保存为单独的文件 (此时 dedup 不起作用)。
+    传入 object_store (S3ObjectStore) 时，文件改为上传到该存储，写入线程即上传线程。传入 post_processor (ImagePostProcessor) 时，
+    每张图片在 submit() 时交给它处理，写入线程随后按它返回的扩展名、字节和缩略图保存图片。
+    """
+    def __init__(self, writer_threads=2, fsync=False, fsync_batch_size=32, queue_size=None, dedup=False, prompt_index=None, prompt_files=True,
+                 shard_writer=None, object_store=None, post_processor=None):
+        self.writer_threads = writer_threads
+        self.fsync = fsync
+        self.fsync_batch_size = fsync_batch_size
+        self.queue = queue.Queue(maxsize=queue_size or max(1, writer_threads) * 8) #  磁盘跟不上时下载工作线程会在此阻塞
+        self.threads = []
+        self.created_folders = set() #  本次运行中已创建的文件夹，这样每个日期文件夹只调用一次 os.makedirs，而不是每张图片一次
+        self.folder_lock = threading.Lock()
+        self.dedup = dedup
+        self.image_filenames_by_sha256 = {}
+        self.deduplicated_count = 0
+        self.dedup_lock = threading.Lock()
+        self.prompt_index = prompt_index
+        self.prompt_files = prompt_files
+        self.shard_writer = shard_writer
+        self.object_store = object_store
+        self.post_processor = post_processor
+        self.stream_temp_folder = tempfile.gettempdir() if object_store else None #  流式上传的图片解码到这里，见 MediaStreamDecoder
+
+    def ensure_folder(self, folder):
+        if self.object_store:
+            return #  不向本地磁盘写入任何内容，文件夹只用于构成对象键
+        if folder not in self.created_folders:
+            with self.folder_lock:
+                if folder not in self.created_folders:
+                    os.makedirs(folder, exist_ok=True)
+                    self.created_folders.add(folder)
+
+    def add_saved_images(self, saved_images, output_folder):
+        """
+        用之前运行保存的图片的 (media_key, create_time, sha256, extension) 记录初始化去重索引。旧版本的记录没有扩展名，
+        此时按 IMAGE_FORMATS 的每个扩展名查找图片。
+        """
+        with self.dedup_lock:
+            for media_key, create_time, sha256, extension in saved_images:
+                if sha256 in self.image_filenames_by_sha256:
+                    continue
+                base_filename = os.path.join(media_folder(output_folder, create_time), media_key)
+                if extension:
+                    self.image_filenames_by_sha256[sha256] = base_filename + extension
+                    continue
+                image_filename = next((base_filename + image_extension for image_extension in IMAGE_FORMATS if os.path.exists(base_filename + image_extension)), None)
+                if image_filename:
+                    self.image_filenames_by_sha256[sha256] = image_filename
+
+    def start(self):
+        for _ in range(self.writer_threads):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        """
+        等待所有已提交的文件写入完成，然后停止写入线程并关闭当前分片
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.shard_writer:
+            self.shard_writer.close()
+        if self.post_processor:
+            self.post_processor.close()
+
+    def submit(self, media_key, image_filename, prompt_filename, prompt_text, result, on_complete,
+               image_data=None, temp_filename=None, create_time=None):
+        """
+        把图片 (image_data 字节，或已经写好的 temp_filename) 和提示词加入写入队列。
+        两个文件都到位后 on_complete 收到 result，写入失败时收到失败的结果。
+        """
+        job = {'media_key': media_key, 'image_filename': image_filename, 'prompt_filename': prompt_filename, 'prompt_text': prompt_text,
+               'result': result, 'on_complete': on_complete, 'image_data': image_data, 'temp_filename': temp_filename,
+               'create_time': create_time, 'thumbnail_data': None,
+               #  立即在工作进程中开始，写入线程从队列中取出任务时再等待其完成
+               'post_processing': self.post_processor.submit(image_data, temp_filename) if self.post_processor else None}
+        if self.threads:
+            self.queue.put(job)
+        else:
+            self._write_batch([job])
+
+    def _run(self):
+        stop = False
+        while not stop:
+            job = self.queue.get()
+            if job is None:
+                break
+            jobs = [job]
+            while len(jobs) < self.fsync_batch_size: #  顺便取出队列中已有的任务，最多一批
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            self._write_batch(jobs)
+
+    def _write_batch(self, jobs):
+        results = []
+        for job in jobs:
+            write_start_time = time.perf_counter()
+            failed_result = self._post_process(job) if self.post_processor else None
+            if failed_result:
+                result = failed_result
+            elif self.shard_writer:
+                result = self._add_to_shard(job)
+            elif self.object_store:
+                result = self._upload(job)
             else:
-                print(f"  -> 下载 media.fetchMedia 失败，响应中缺少 encodedImage for {media_key}")
+                result = self._write(job)
+            if result['success']: #  由状态数据库保存，这样去重和跳过检测能知道已保存文件的扩展名
+                result['extension'] = os.path.splitext(job['image_filename'])[1]
+            result['timings']['write'] = time.perf_counter() - write_start_time
+            results.append(result)
+        if self.shard_writer:
+            try:
+                self.shard_writer.flush()
+            except OSError as e:
+                print(f"  -> 写入归档分片 {self.shard_writer.shard_filename} 失败: {e}")
+                results = [download_result(False, error=f"save failed: {e}") if result['success'] else result for result in results]
+        elif self.fsync and not self.object_store:
+            folders = {os.path.dirname(job['image_filename']) for job, result in zip(jobs, results) if result['success']}
+            for folder in folders:
+                try:
+                    fsync_folder(folder)
+                except OSError as e:
+                    print(f"  -> 警告: 同步文件夹失败 {folder}: {e}")
+        if self.prompt_index:
+            self._index_prompts(jobs, results) #  在 on_complete 之前写入，这样图片只有在提示词进入索引后才算下载完成
+        for job, result in zip(jobs, results):
+            job['on_complete'](result)
+
+    def _index_prompts(self, jobs, results):
+        rows = [(job['media_key'], job['create_time'], job['image_filename'], result['byte_size'], job['prompt_text'])
+                for job, result in zip(jobs, results) if result['success'] and job['prompt_text']]
+        if not rows:
+            return
+        try:
+            self.prompt_index.add_prompts(rows)
+        except sqlite3.Error as e:
+            print(f"  -> {len(rows)} 条提示词写入提示词索引失败: {e}")
+            if not self.prompt_files: #  提示词没有保存在别处，这些图片稍后重新下载
+                for index, (job, result) in enumerate(zip(jobs, results)):
+                    if result['success'] and job['prompt_text']:
+                        results[index] = download_result(False, error=f"prompt index failed: {e}")
+
+    def _post_process(self, job):
+        """
+        把后处理得到的扩展名、重新编码后的字节和缩略图应用到 job，失败时返回失败的结果
+        """
+        try:
+            extension, image_data, job['thumbnail_data'] = self.post_processor.process(job['image_data'], job['temp_filename'], job['post_processing'])
+        except Exception as e:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+            print(f"  -> 后处理图片 {job['media_key']} 失败: {e}")
+            return download_result(False, error=f"post-processing failed: {e}")
+        job['image_filename'] = os.path.splitext(job['image_filename'])[0] + extension
+        if image_data is not None: #  已重新编码，不保存下载的字节
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+            job['image_data'], job['temp_filename'] = image_data, None
+        return None
+
+    def _add_to_shard(self, job):
+        media_key = job['media_key']
+        if not job['prompt_text']:
+            print(f"  -> 警告: 未在响应中找到提示词 for {media_key}")
+        try: #  提示词索引随之指向分片内的图片
+            job['image_filename'] = self.shard_writer.add(media_key, job['create_time'], job['prompt_text'] if self.prompt_files else None,
+                                                          image_data=job['image_data'], temp_filename=job['temp_filename'], sha256=job['result']['sha256'],
+                                                          extension=os.path.splitext(job['image_filename'])[1], thumbnail_data=job['thumbnail_data'])
+        except Exception as e:
+            print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        finally:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+        return job['result']
+
+    def _upload(self, job):
+        media_key = job['media_key']
+        try: #  与单独的文件一样，先上传提示词
+            if not job['prompt_text']:
+                print(f"  -> 警告: 未在响应中找到提示词 for {media_key}")
+            elif self.prompt_files:
+                self.object_store.upload(job['prompt_filename'], job['prompt_text'].encode('utf-8'))
+            if job['thumbnail_data']:
+                self.object_store.upload(thumbnail_file_path(job['image_filename']), job['thumbnail_data'])
+            job['image_filename'] = self.object_store.upload(job['image_filename'], job['image_data'], job['temp_filename']) #  供提示词索引使用
+        except Exception as e:
+            print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+            return download_result(False, error=f"upload failed: {e}")
+        finally:
+            if job['temp_filename'] and os.path.exists(job['temp_filename']):
+                os.remove(job['temp_filename'])
+        return job['result']
+
+    def _write_temp_file(self, filename, data):
+        temp_filename = unique_temp_filename(filename)
+        with open(temp_filename, "xb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return temp_filename
+
+    def _write(self, job):
+        media_key = job['media_key']
+        temp_filename = job['temp_filename']
+        prompt_temp_filename = thumbnail_temp_filename = None
+        try:
+            link_filename = self._link_duplicate(job) if self.dedup else None
+            if link_filename:
+                if temp_filename:
+                    os.remove(temp_filename) #  不再需要流式写入的副本
+                temp_filename = link_filename
+            elif job['image_data'] is not None:
+                temp_filename = self._write_temp_file(job['image_filename'], job['image_data'])
+            elif self.fsync:
+                with open(temp_filename, "rb+") as f:
+                    os.fsync(f.fileno())
+            #  先把提示词移动到最终位置，这样已存在的图片旁边总有对应的提示词
+            if not job['prompt_text']:
+                print(f"  -> 警告: 未在响应中找到提示词 for {media_key}")
+            elif self.prompt_files:
+                prompt_temp_filename = self._write_temp_file(job['prompt_filename'], job['prompt_text'].encode('utf-8'))
+                os.replace(prompt_temp_filename, job['prompt_filename'])
+            if job['thumbnail_data']: #  同样在图片之前，这样 skip_existing 不会跳过没有缩略图的图片
+                thumbnail_filename = thumbnail_file_path(job['image_filename'])
+                self.ensure_folder(os.path.dirname(thumbnail_filename))
+                thumbnail_temp_filename = self._write_temp_file(thumbnail_filename, job['thumbnail_data'])
+                os.replace(thumbnail_temp_filename, thumbnail_filename)
+            os.replace(temp_filename, job['image_filename'])
+            if link_filename and os.path.lexists(link_filename): #  两个名称已链接到同一文件时 rename() 不做任何事
+                os.remove(link_filename)
+            if self.dedup and not link_filename:
+                with self.dedup_lock:
+                    self.image_filenames_by_sha256[job['result']['sha256']] = job['image_filename']
+        except Exception as e:
+            for filename in (temp_filename, prompt_temp_filename, thumbnail_temp_filename):
+                if filename and os.path.exists(filename):
+                    os.remove(filename)
+            print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        return job['result']
+
+    def _link_duplicate(self, job):
+        """
+        把已保存的相同 SHA-256 图片硬链接到图片旁边的临时文件，返回其文件名，没有时返回 None
+        """
+        with self.dedup_lock:
+            existing_filename = self.image_filenames_by_sha256.get(job['result']['sha256'])
+        if not existing_filename or existing_filename == job['image_filename']:
+            return None
+        link_filename = unique_temp_filename(job['image_filename'], ".link.part")
+        try:
+            os.link(existing_filename, link_filename)
+        except OSError:
+            return None #  原图已不存在或文件系统不支持硬链接，改为写入普通副本
+        with self.dedup_lock:
+            self.deduplicated_count += 1
+        return link_filename
+
+
+class ArchiveShardWriter:
+    """
+    把保存的图片和提示词追加到 output_folder 中滚动的未压缩 tar 分片 (imagefx-00001.tar、imagefx-00002.tar ...) 中，而不是保存为
+    单独的文件，这样大型图库只有少数几个大文件，列出和复制时都是顺序的批量 I/O。当前分片达到 max_bytes 或 max_files 张图片时，
+    以及每次运行时，都会开始一个新分片 (之后不会再往旧分片追加)。分片内的文件保留 <日期>/<mediaKey>.jpg 的名字，
+    <分片>.index.jsonl 列出每张图片和提示词的偏移量和大小，用于随机读取 (见 read_shard_image)。
+    """
+    SHARD_NAME_PATTERN = re.compile(r"imagefx-(\d+)\.tar$")
+
+    def __init__(self, output_folder, max_bytes=None, max_files=None, fsync=False):
+        self.output_folder = output_folder
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fsync = fsync
+        self.lock = threading.Lock() #  所有写入线程都追加到同一个分片
+        self.tar = None
+        self.shard_filename = None
+        self.shard_file_count = 0
+        self.index_file = None
+        self.pending_index_lines = [] #  在 flush() 时写入，晚于它们指向的成员
+        os.makedirs(output_folder, exist_ok=True)
+        shard_numbers = [int(match.group(1)) for match in map(self.SHARD_NAME_PATTERN.match, os.listdir(output_folder)) if match]
+        self.next_shard_number = max(shard_numbers, default=0) + 1
+
+    def add(self, media_key, create_time, prompt_text=None, image_data=None, temp_filename=None, sha256=None, extension=".jpg",
+            thumbnail_data=None):
+        """
+        把图片 (image_data 字节，或文件 temp_filename)、提示词及缩略图 (thumbnail_data 字节，放在 <日期>/thumbnails 中) 追加到当前分片，
+        返回图片在分片内的路径 (<分片>/<日期>/<mediaKey>.jpg)
+        """
+        image_name = os.path.join(media_folder("", create_time), f"{media_key}{extension}").replace(os.sep, "/")
+        with self.lock:
+            if (self.tar is None or (self.max_bytes and self.tar.offset >= self.max_bytes)
+                    or (self.max_files and self.shard_file_count >= self.max_files)):
+                self._open_next_shard()
+            entry = {'media_key': media_key, 'create_time': create_time, 'name': image_name, 'sha256': sha256}
+            start_offset = self.tar.offset
+            try:
+                if prompt_text: #  与单独的文件一样，先写提示词
+                    prompt_data = prompt_text.encode('utf-8')
+                    entry['prompt_offset'], entry['prompt_size'] = self._add_member(os.path.splitext(image_name)[0] + ".txt", io.BytesIO(prompt_data), len(prompt_data))
+                if thumbnail_data:
+                    thumbnail_name = thumbnail_file_path(image_name).replace(os.sep, "/")
+                    entry['thumbnail_offset'], entry['thumbnail_size'] = self._add_member(thumbnail_name, io.BytesIO(thumbnail_data), len(thumbnail_data))
+                if image_data is not None:
+                    entry['offset'], entry['size'] = self._add_member(image_name, io.BytesIO(image_data), len(image_data))
+                else:
+                    with open(temp_filename, 'rb') as f:
+                        entry['offset'], entry['size'] = self._add_member(image_name, f, os.fstat(f.fileno()).st_size)
+            except Exception: #  丢弃写了一半的成员，使分片仍是有效的 tar 文件
+                self.tar.fileobj.seek(start_offset)
+                self.tar.fileobj.truncate()
+                self.tar.offset = start_offset
+                raise
+            self.pending_index_lines.append(json.dumps(entry) + "\n")
+            self.shard_file_count += 1
+            return os.path.join(self.shard_filename, image_name)
+
+    def _add_member(self, name, fileobj, size):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time()) #  浮点数会给每个成员加一个 pax 头
+        self.tar.addfile(tarinfo, fileobj)
+        return self.tar.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE, size #  数据结束于当前偏移量，并补齐到整块
+
+    def _open_next_shard(self):
+        self._close_shard()
+        self.shard_filename = os.path.join(self.output_folder, f"imagefx-{self.next_shard_number:05d}.tar")
+        self.next_shard_number += 1
+        self.tar = tarfile.open(self.shard_filename, "w")
+        self.index_file = open(self.shard_filename + ".index.jsonl", 'w', encoding='utf-8')
+        self.shard_file_count = 0
+
+    def flush(self):
+        """
+        刷新目前已添加的成员 (fsync=True 时同步到磁盘)，然后写入它们的索引行，这样索引中不会列出尚未保存的图片
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.tar is None:
+            return
+        self.tar.fileobj.flush()
+        if self.fsync:
+            os.fsync(self.tar.fileobj.fileno())
+        self.index_file.writelines(self.pending_index_lines)
+        self.pending_index_lines = []
+        self.index_file.flush()
+        if self.fsync:
+            os.fsync(self.index_file.fileno())
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self._flush()
+        self.tar.close() #  写入归档结束块
+        self.index_file.close()
+        self.tar = None
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+
+class S3ObjectStore:
+    """
+    把保存的图片和提示词上传到兼容 S3 的存储桶 (AWS S3、MinIO 等)，而不是写入本地磁盘，需要 boto3。root 之下的路径成为 url
+    (s3://bucket/prefix) 的前缀之下的对象键，因此存储桶与输出文件夹有相同的 <日期>/<mediaKey>.jpg 结构。所有上传线程共用一个带连接池的
+    客户端；大于 multipart_size 兆字节的对象以分段上传的方式上传，同时上传多个分段。凭据取自常用的 AWS 环境变量或配置文件。
+    """
+    PART_CONCURRENCY = 4 #  一个分段上传同时发送的分段数
+
+    def __init__(self, url, root, endpoint_url=None, multipart_size=8, upload_threads=2):
+        if boto3 is None:
+            raise RuntimeError("S3 输出需要 boto3，请先安装: pip install boto3")
+        match = re.match(r"s3://([^/]+)/?(.*)$", url)
+        if not match:
+            raise ValueError(f"不是 s3://bucket/prefix 形式的 URL: {url}")
+        self.bucket = match.group(1)
+        self.prefix = match.group(2).strip("/")
+        self.root = root
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, config=BotoConfig(
+            max_pool_connections=max(10, upload_threads * self.PART_CONCURRENCY), #  为每个正在上传的分段保留长连接
+            retries={'max_attempts': 10, 'mode': 'adaptive'}
+        ))
+        part_size = max(int(multipart_size * 1e6), 5 * 1024 * 1024) #  S3 不接受小于 5 MiB 的分段
+        self.transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=self.PART_CONCURRENCY)
+
+    def _key(self, filename):
+        relative_path = os.path.relpath(filename, self.root).replace(os.sep, "/")
+        return "/".join(part for part in (self.prefix, relative_path) if part and part != ".")
+
+    def folder_url(self, folder):
+        return f"s3://{self.bucket}/{self._key(folder)}"
+
+    def upload(self, filename, data=None, source_filename=None):
+        """
+        把 data (字节) 或本地文件 source_filename 上传为本地路径 filename 对应的对象，返回其 s3:// URL
+        """
+        key = self._key(filename)
+        extension = os.path.splitext(filename)[1]
+        extra_args = {'ContentType': IMAGE_FORMATS[extension][1] if extension in IMAGE_FORMATS else 'text/plain; charset=utf-8'}
+        if data is not None:
+            self.client.upload_fileobj(io.BytesIO(data), self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        else:
+            self.client.upload_file(source_filename, self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        return f"s3://{self.bucket}/{key}"
+
+    def list_media_keys(self, folder, extension=None, thumbnails=False):
+        """
+        返回上传到 folder 及其日期文件夹中的图片的 mediaKey，extension 和 thumbnails 的筛选与 index_downloaded_media_keys 相同
+        """
+        folder_key = self._key(folder)
+        prefix = folder_key + "/" if folder_key else ""
+        image_names, thumbnail_names = {}, set()
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                name = item['Key'][len(prefix):]
+                media_key = image_media_key(name.rsplit("/", 1)[-1])
+                if not media_key:
+                    continue
+                if name.startswith(THUMBNAIL_FOLDER_NAME + "/") or f"/{THUMBNAIL_FOLDER_NAME}/" in name:
+                    thumbnail_names.add(name.replace(THUMBNAIL_FOLDER_NAME + "/", "", 1))
+                elif name.count("/") <= 1 and not name.startswith(PREVIEW_FOLDER_NAME + "/") and (not extension or name.endswith(extension)):
+                    image_names[name] = media_key
+        return {media_key for name, media_key in image_names.items() if not thumbnails or name in thumbnail_names}
+
+
+def build_shard_writer(output_folder, shard_size=None, shard_max_files=None, fsync=False):
+    """
+    返回分片大小为 shard_size 兆字节和/或 shard_max_files 张图片的 ArchiveShardWriter，两者都未设置时返回 None
+    """
+    if not shard_size and not shard_max_files:
+        return None
+    return ArchiveShardWriter(output_folder, shard_size * 1e6 if shard_size else None, shard_max_files, fsync)
+
+
+def read_shard_index(shard_filename):
+    """
+    按 mediaKey 返回归档分片的索引条目，不完整的最后一行 (来自被中断的运行) 会被忽略
+    """
+    entries = {}
+    index_filename = shard_filename + ".index.jsonl"
+    if not os.path.exists(index_filename):
+        return entries
+    with open(index_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['media_key']] = entry
+    return entries
+
+
+def read_shard_image(shard_filename, media_key):
+    """
+    直接从归档分片中的偏移量读取 mediaKey 的图片和提示词，返回 (image_data, prompt_text)，分片中没有该 mediaKey 时返回 None
+    """
+    entry = read_shard_index(shard_filename).get(media_key)
+    if entry is None:
+        return None
+    prompt_text = None
+    with open(shard_filename, 'rb') as f:
+        f.seek(entry['offset'])
+        image_data = f.read(entry['size'])
+        if 'prompt_offset' in entry:
+            f.seek(entry['prompt_offset'])
+            prompt_text = f.read(entry['prompt_size']).decode('utf-8')
+    return image_data, prompt_text
+
+
+def save_media_response(media_key, response_json, output_folder="imagefx_images", create_time=None, writer=None, on_complete=None):
+    """
+    从 media.fetchMedia 响应中取出图片和提示词，交给 writer 按日期保存到子文件夹，
+    on_complete 接收下载结果
+    """
+    try:
+        result_data_json_result = response_json['result']['data']['json']['result']
+        encoded_image = result_data_json_result['image']['encodedImage']
+        prompt_text = result_data_json_result.get('image').get('prompt')
+    except (KeyError, TypeError, AttributeError) as e:
+        print(f"  -> 解析 media.fetchMedia 响应失败 {media_key}: {e!r}")
+        on_complete(download_result(False, error=f"invalid response: {e!r}"))
+        return
+
+    if encoded_image:
+        try:
+            decode_start_time = time.perf_counter()
+            image_data = base64.b64decode(encoded_image)
+            sha256 = hashlib.sha256(image_data).hexdigest()
+            decode_seconds = time.perf_counter() - decode_start_time
+            image_filename, prompt_filename = media_file_paths(media_key, output_folder, create_time, writer)
+        except Exception as e:
+            print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+            on_complete(download_result(False, error=f"save failed: {e}"))
+            return
+        result = download_result(True, byte_size=len(image_data), sha256=sha256)
+        result['timings']['decode'] = decode_seconds
+        writer.submit(media_key, image_filename, prompt_filename, prompt_text, result, on_complete, image_data=image_data, create_time=create_time)
+    else:
+        print(f"  -> 下载 media.fetchMedia 失败，响应中缺少 encodedImage for {media_key}")
+        on_complete(download_result(False, error="encodedImage missing"))
+
+
+class MediaStreamDecoder:
+    """
+    增量解析分块传入的 media.fetchMedia 响应体。base64 编码的 encodedImage 值被逐块解码并直接写入 image_filename
+    旁边名称唯一的临时文件 (图片不保存在本地时写入 temp_folder)，其余内容 (提示词等) 作为一个很小的 JSON 骨架保留，
+    因此内存占用只取决于分块大小，而不是图片的多份拷贝。
+    """
+    ENCODED_IMAGE_PATTERN = re.compile(rb'"encodedImage"\s*:\s*"')
+
+    def __init__(self, image_filename, temp_folder=None):
+        self.image_filename = image_filename
+        if temp_folder: #  只从这里上传然后删除，mkstemp 的私有权限正合适
+            file_descriptor, self.temp_filename = tempfile.mkstemp(suffix=".part", prefix=os.path.basename(image_filename) + ".", dir=temp_folder)
+            self.file = os.fdopen(file_descriptor, "wb")
+        else: #  名称唯一，因此同一图片的并发流不会写入同一个文件
+            self.temp_filename = unique_temp_filename(image_filename)
+            self.file = open(self.temp_filename, "xb")
+        self.skeleton = bytearray() #  去掉 encodedImage 值之后的响应
+        self.pending_base64 = b"" #  尚未凑满 4 个字符一组的剩余 base64 字符
+        self.in_encoded_image = False
+        self.found_encoded_image = False
+        self.byte_size = 0
+        self.sha256 = hashlib.sha256()
+        self.decode_seconds = 0.0 #  解析和解码所用的时间，不含等待网络的时间
+
+    def feed(self, data):
+        decode_start_time = time.perf_counter()
+        self._feed(data)
+        self.decode_seconds += time.perf_counter() - decode_start_time
+
+    def _feed(self, data):
+        while data:
+            if self.in_encoded_image:
+                end = data.find(b'"')
+                encoded_chunk = data if end == -1 else data[:end]
+                self._decode(encoded_chunk.replace(b"\\", b"")) #  JSON 可能把 "/" 转义为 "\/"
+                if end == -1:
+                    return
+                self.in_encoded_image = False
+                data = data[end:] #  结束引号放回骨架中
+            else:
+                search_start = max(0, len(self.skeleton) - 64) #  键名可能被分在两个分块中
+                self.skeleton += data
+                if self.found_encoded_image:
+                    return
+                match = self.ENCODED_IMAGE_PATTERN.search(self.skeleton, search_start)
+                if match is None:
+                    return
+                self.found_encoded_image = True
+                self.in_encoded_image = True
+                data = bytes(self.skeleton[match.end():])
+                del self.skeleton[match.end():]
+
+    def _decode(self, encoded_chunk):
+        encoded_data = self.pending_base64 + encoded_chunk
+        usable_length = len(encoded_data) - len(encoded_data) % 4
+        self.pending_base64 = encoded_data[usable_length:]
+        if usable_length:
+            self._write(base64.b64decode(encoded_data[:usable_length]))
+
+    def _write(self, image_data):
+        self.file.write(image_data)
+        self.sha256.update(image_data)
+        self.byte_size += len(image_data)
+
+    def finish(self):
+        """
+        写出剩余的 base64 字符，并返回解析后的 JSON 骨架 (其中 encodedImage 为空字符串)
+        """
+        if self.pending_base64:
+            decode_start_time = time.perf_counter()
+            self._write(base64.b64decode(self.pending_base64 + b"=" * (-len(self.pending_base64) % 4)))
+            self.decode_seconds += time.perf_counter() - decode_start_time
+            self.pending_base64 = b""
+        self.file.close()
+        return json.loads(self.skeleton)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+
+def finish_media_stream(media_key, decoder, prompt_filename, writer, on_complete, create_time=None):
+    """
+    完成 MediaStreamDecoder，把图片和提示词交给 writer 保存，on_complete 接收下载结果
+    """
+    try:
+        response_json = decoder.finish()
+        prompt_text = response_json['result']['data']['json']['result'].get('image').get('prompt')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        decoder.abort()
+        print(f"  -> 解析 media.fetchMedia 响应失败 {media_key}: {e!r}")
+        on_complete(download_result(False, error=f"invalid response: {e!r}"))
+        return
+
+    if not decoder.byte_size:
+        decoder.abort()
+        print(f"  -> 下载 media.fetchMedia 失败，响应中缺少 encodedImage for {media_key}")
+        on_complete(download_result(False, error="encodedImage missing"))
+        return
+
+    result = download_result(True, byte_size=decoder.byte_size, sha256=decoder.sha256.hexdigest())
+    result['timings']['decode'] = decoder.decode_seconds
+    writer.submit(media_key, decoder.image_filename, prompt_filename, prompt_text, result, on_complete, temp_filename=decoder.temp_filename,
+                  create_time=create_time)
+
+
+def stream_media_response(media_key, response, output_folder="imagefx_images", create_time=None, writer=None, on_complete=None):
+    """
+    使用 MediaStreamDecoder 和 writer 保存流式 (stream=True) 的 media.fetchMedia 响应，on_complete 接收下载结果
+    """
+    decoder = None
+    try:
+        image_filename, prompt_filename = media_file_paths(media_key, output_folder, create_time, writer)
+        decoder = MediaStreamDecoder(image_filename, writer.stream_temp_folder if writer else None)
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            decoder.feed(chunk)
+    except requests.exceptions.RequestException:
+        if decoder:
+            decoder.abort()
+        raise
+    except Exception as e:
+        if decoder:
+            decoder.abort()
+        print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+        on_complete(download_result(False, error=f"save failed: {e}"))
+        return
+    finally:
+        response.close()
+    finish_media_stream(media_key, decoder, prompt_filename, writer, on_complete, create_time)
+
+
+def download_image_and_prompt(media_key, cookies, output_folder="imagefx_images", create_time=None,
+                                    total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                                    on_thread_complete=None, session=None, streaming=False, rate_controller=None, writer=None, image_size=None): # 修改: on_thread_complete 接收下载结果
+    """
+    使用 mediaKey 下载原图和提示词，并按日期保存到子文件夹 (修改后版本)
+    如果传入了 session (例如 BatchDownloader 的连接池 session)，则复用它而不是新建一个。
+    streaming=True 时响应被逐块解码并直接写入文件，而不是整体加载到内存中。
+    文件由 writer (FileWriter) 保存，没有传入时在调用线程中原子写入。
+    image_size=(height, width) 时请求缩放后的图片而不是原图。
+    文件保存后 on_thread_complete 接收下载结果 {'success', 'byte_size', 'sha256', 'error'}，
+    如果 writer 有写入线程，则在写入线程中调用。
+    """
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+        session.mount("https://", HTTPAdapter(max_retries=retries))
+    if writer is None:
+        writer = FileWriter(writer_threads=0)
+    latency = None
+
+    def on_complete(result):
+        if latency is not None:
+            result['timings']['http'] = latency
+        if on_thread_complete:
+            on_thread_complete(result)
+
+    try:
+        response = session.get(FETCH_MEDIA_API_URL, params=fetch_media_params(media_key, *(image_size or ())), cookies=cookies, timeout=30, stream=streaming)
+        response.encoding = 'utf-8'
+        #  重试过的响应已由 ControlledRetry 报告，而且其耗时包含了退避等待时间
+        retry_history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+        latency = None if retry_history else response.elapsed.total_seconds()
+        if rate_controller:
+            rate_controller.record_response(response.status_code, latency, parse_retry_after(response.headers.get('Retry-After')))
+
+        if is_auth_failure(response.status_code, response.url):
+            response.close()
+            on_complete(download_result(False, error=f"authentication failed: HTTP {response.status_code}", auth_failed=True))
+        elif response.status_code == 200:
+            if streaming:
+                stream_media_response(media_key, response, output_folder, create_time, writer, on_complete)
+            else:
+                save_media_response(media_key, response.json(), output_folder, create_time, writer, on_complete)
 
         else:
             print(f"  -> 下载 media.fetchMedia 失败，状态码: {response.status_code}")
             print(response.text)
+            on_complete(download_result(False, error=f"HTTP {response.status_code}"))
 
     except requests.exceptions.RequestException as e:
         print(f"  -> 下载 media.fetchMedia 请求失败 (mediaKey: {media_key}): {e}")
+        on_complete(download_result(False, error=f"request failed: {e}"))
+
+
+def download_media_batch(items, cookies, output_folder="imagefx_images", on_item_complete=None, session=None, rate_controller=None,
+                         writer=None, image_size=None):
+    """
+    用一个 tRPC 批量请求下载多张图片，请求中每个 item 对应一个 media.fetchMedia 调用，响应是按相同顺序排列的结果数组。
+    on_item_complete(item, result) 接收批量中每张图片的下载结果。返回在批量中调用失败、需要逐张下载的 item，请求本身失败时返回
+    所有 item，服务器不接受批量请求时返回 None。
+    响应整体解析 (不是流式的)，因此会同时在内存中保存批量中的所有图片。
+    """
+    if session is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))))
+    if writer is None:
+        writer = FileWriter(writer_threads=0)
+    try:
+        response = session.get(fetch_media_batch_url(len(items)), params=fetch_media_batch_params([item.media_key for item in items], *(image_size or ())),
+                               cookies=cookies, timeout=30)
+        retry_history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+        latency = None if retry_history else response.elapsed.total_seconds() #  整个批量请求的往返时间
+        if rate_controller:
+            rate_controller.record_response(response.status_code, latency, parse_retry_after(response.headers.get('Retry-After')))
+        if is_auth_failure(response.status_code, response.url):
+            for item in items:
+                on_item_complete(item, download_result(False, error=f"authentication failed: HTTP {response.status_code}", auth_failed=True))
+            return []
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = None
+    except requests.exceptions.RequestException as e:
+        print(f"  -> media.fetchMedia 批量请求失败 ({len(items)} 张图片): {e}")
+        return items
+
+    if not isinstance(response_json, list) or len(response_json) != len(items):
+        print(f"  -> media.fetchMedia 批量请求失败，状态码: {response.status_code}")
+        return None if response.status_code in BATCH_UNSUPPORTED_STATUS_CODES else items
+    fallback_items = []
+    for item, item_json in zip(items, response_json):
+        if not isinstance(item_json, dict) or 'result' not in item_json: #  这个调用的 tRPC 错误
+            fallback_items.append(item)
+            continue
+
+        def on_complete(result, item=item):
+            if latency is not None:
+                result['timings']['http'] = latency
+            on_item_complete(item, result)
+
+        save_media_response(item.media_key, item_json, output_folder, item.create_time, writer, on_complete)
+    if fallback_items:
+        print(f"  -> 批量请求中 {len(items)} 张图片有 {len(fallback_items)} 张失败，改为逐张下载。")
+    return fallback_items
+
+
+def print_deduplicated_count(writer):
+    if writer.deduplicated_count:
+        print(f"{writer.deduplicated_count} 张图片与已保存的图片完全相同，已使用硬链接而没有再保存一份。")
 
+
+def index_downloaded_media_keys(output_folder, extension=None, thumbnails=False):
+    """
+    用一次 os.scandir 遍历各日期文件夹，收集 output_folder 中已保存图片的 mediaKey，包括 output_folder 中归档分片里的图片。
+    传入 extension (见 converted_extension) 时只计入以该扩展名保存的图片，传入 thumbnails 时只计入有缩略图的图片，
+    这样在使用 --convert-format 或 --thumbnail-size 之前保存的图片会重新下载并后处理。
+    """
+    media_keys = set()
+    if not os.path.isdir(output_folder):
+        return media_keys
+    thumbnail_names = {} #  文件夹: 其缩略图子文件夹中的文件名，每个文件夹只列出一次
+
+    def saved_media_key(folder, name):
+        media_key = image_media_key(name)
+        if not media_key or (extension and not name.endswith(extension)):
+            return None
+        if thumbnails:
+            if folder not in thumbnail_names:
+                thumbnail_folder = os.path.join(folder, THUMBNAIL_FOLDER_NAME)
+                thumbnail_names[folder] = set(os.listdir(thumbnail_folder)) if os.path.isdir(thumbnail_folder) else set()
+            if name not in thumbnail_names[folder]:
+                return None
+        return media_key
+
+    with os.scandir(output_folder) as entries:
+        for entry in entries:
+            if entry.name == THUMBNAIL_FOLDER_NAME: #  没有 create_time 的图片的缩略图
+                continue
+            if entry.is_dir():
+                with os.scandir(entry.path) as date_folder_entries:
+                    for date_folder_entry in date_folder_entries:
+                        media_key = saved_media_key(entry.path, date_folder_entry.name)
+                        if media_key:
+                            media_keys.add(media_key)
+            elif image_media_key(entry.name): #  没有 create_time 的图片直接保存在 output_folder 中
+                media_key = saved_media_key(output_folder, entry.name)
+                if media_key:
+                    media_keys.add(media_key)
+            elif entry.name.endswith(".tar.index.jsonl"):
+                media_keys.update(media_key for media_key, index_entry in read_shard_index(entry.path[:-len(".index.jsonl")]).items()
+                                  if (not extension or index_entry['name'].endswith(extension))
+                                  and (not thumbnails or 'thumbnail_offset' in index_entry))
+    return media_keys
+
+
+def known_downloaded_media_keys(output_folder, state_store=None, object_store=None, extension=None, thumbnails=False):
+    """
+    返回已下载图片的 mediaKey，即增量抓取遇到时停止的已知图片: state_store 中记录为下载完成的图片，没有状态数据库时为
+    output_folder 中已保存的图片 (或已上传到 object_store 的图片)。
+    extension 和 thumbnails 与 index_downloaded_media_keys 中相同，状态数据库只记录扩展名。
+    """
+    if state_store:
+        return state_store.get_done_media_keys(extension)
+    if object_store:
+        return object_store.list_media_keys(output_folder, extension, thumbnails)
+    return index_downloaded_media_keys(output_folder, extension, thumbnails)
+
+
+def skip_downloaded_media_keys(media_keys_info, output_folder, object_store=None, extension=None, thumbnails=False):
+    if object_store:
+        existing_media_keys = object_store.list_media_keys(output_folder, extension, thumbnails)
+        output_folder = object_store.folder_url(output_folder)
+    else:
+        existing_media_keys = index_downloaded_media_keys(output_folder, extension, thumbnails)
+    print(f"在 '{output_folder}' 中找到 {len(existing_media_keys)} 张已保存的图片，将跳过它们。")
+    remaining_media_keys_info = (item for item in media_keys_info if item.media_key not in existing_media_keys)
+    return list(remaining_media_keys_info) if isinstance(media_keys_info, list) else remaining_media_keys_info #  列表保持可计数，用于显示进度
+
+
+def ask_preview_size():
+    preview_size_input = input("是否先下载所有图片的小预览图，再下载原图 (分级模式)？ \n"
+                               "预览图保存在 '" + PREVIEW_FOLDER_NAME + "' 子文件夹中，只需少量流量就能很快得到可浏览的图库。\n"
+                               "请输入预览图尺寸 (像素，例如 256)，留空则只下载原图: ").strip()
+    return int(preview_size_input) if preview_size_input.isdigit() else None
+
+
+def download_with_previews(downloader, media_keys_info, preview_size=None):
+    """
+    分级下载: 指定 preview_size 时，先把每张图片 preview_size 像素的预览图下载到预览子文件夹，
+    再按相同顺序 (从新到旧) 补全原图。返回下载的原图数量。
+    """
+    if not preview_size:
+        return downloader.download_media_keys(media_keys_info)
+    media_keys_info = list(media_keys_info) #  两轮下载使用同一个列表
+    preview_downloader = copy.copy(downloader)
+    preview_downloader.output_folder = os.path.join(downloader.output_folder, PREVIEW_FOLDER_NAME)
+    preview_downloader.image_size = (preview_size, preview_size)
+    preview_downloader.state_store = None #  下载状态只记录原图
+    preview_downloader.skip_existing = True #  不再重复获取之前运行已下载的预览图
+    preview_downloader.success_count = 0
+    preview_downloader.failure_count = 0
+    preview_downloader.failed_keys_file = None #  报告只列出原图
+    preview_downloader.prompt_index = None #  提示词索引同样只列出原图
+    print(f"分级模式: 先下载 {len(media_keys_info)} 张图片的 {preview_size} 像素预览图...")
+    preview_downloader.download_media_keys(media_keys_info)
+    print("预览图下载完成，开始下载原图...")
+    return downloader.download_media_keys(media_keys_info)
+
+
+def create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store=None, auth_monitor=None,
+                      prompt_index=None):
+    """
+    询问使用哪种下载引擎，并创建对应的下载器
+    """
+    skip_existing_input = input("是否跳过输出文件夹中已存在的图片？ (yes/no，默认: no): ").lower()
+    skip_existing = skip_existing_input in ['yes', 'y']
+    fsync_input = input("是否用 fsync 把每个保存的文件刷新到磁盘？ (更慢，但断电时不会丢失已保存的图片) (yes/no，默认: no): ").lower()
+    fsync = fsync_input in ['yes', 'y']
+    dedup_input = input("是否把与已保存图片完全相同的图片硬链接到已有文件，而不是再保存一份 (去重)？ (yes/no，默认: no): ").lower()
+    dedup = dedup_input in ['yes', 'y']
+    adaptive_input = input("是否根据服务器响应自动调整同时下载数量 (自适应速率控制)？ \n"
+                           "线程数上限 (或 async 引擎的进行中请求上限) 将作为上限，遇到 429/503 或响应变慢时会自动降低并发 (yes/no，默认: no): ").lower()
+    adaptive = adaptive_input in ['yes', 'y']
+    engine_input = input("请选择下载引擎: 'threads' 或 'async' (async 需要 aiohttp，适合数百个并发请求) (默认: threads): ").strip().lower()
+    engine = 'async' if engine_input == 'async' else 'threads'
+    max_concurrency = 100
+    if engine == 'async' and aiohttp is not None:
+        max_concurrency_input = input(f"请输入同时进行中的请求数量上限 (默认: {max_concurrency}): ")
+        if max_concurrency_input.isdigit():
+            max_concurrency = int(max_concurrency_input)
+    return build_downloader(
+        cookies, output_folder,
+        engine=engine,
+        max_threads=max_threads,
+        max_concurrency=max_concurrency,
+        adaptive=adaptive,
+        total_retries=total_retries, backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        state_store=state_store,
+        skip_existing=skip_existing,
+        fsync=fsync,
+        dedup=dedup,
+        failed_keys_file="failed_media_keys.jsonl",
+        auth_monitor=auth_monitor,
+        prompt_index=prompt_index
+    )
+
+
+def build_downloader(cookies, output_folder, engine='threads', max_threads=10, max_concurrency=100, adaptive=False,
+                     total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), state_store=None,
+                     skip_existing=False, fsync=False, dedup=False, writer_threads=2, shared_limiter=None, max_attempts=3, retry_delay=10,
+                     failed_keys_file=None, auth_monitor=None, batch_size=1, prompt_index=None, prompt_files=True, shard_size=None,
+                     shard_max_files=None, s3_url=None, s3_endpoint_url=None, s3_multipart_size=8, detect_format=False, convert_format=None,
+                     image_quality=90, thumbnail_size=None, post_processes=None):
+    """
+    不询问任何问题，直接创建指定引擎 ('threads' 或 'async') 的下载器。batch_size > 1 时每个 tRPC 批量请求获取这么多张图片
+    (仅限 threads 引擎，async 引擎靠并发来掩盖往返时间)。
+    传入 s3_url (s3://bucket/prefix) 时，图片和提示词上传到该存储桶，而不是保存到 output_folder (见 S3ObjectStore)。
+    detect_format、convert_format、image_quality、thumbnail_size 和 post_processes 设置图片的后处理 (见 ImagePostProcessor)。
+    """
+    object_store = S3ObjectStore(s3_url, output_folder, s3_endpoint_url, s3_multipart_size, writer_threads) if s3_url else None
+    if engine == 'async':
+        if aiohttp is None:
+            print("未安装 aiohttp，将使用多线程下载引擎。可通过 pip install aiohttp 安装")
+        else:
+            if batch_size > 1: #  load_options 会拒绝这种组合，直接调用的代码只会收到警告
+                print(f"async 引擎不使用批量请求，忽略 batch_size {batch_size}。")
+            return AsyncBatchDownloader(
+                cookies, output_folder,
+                total_retries=total_retries, backoff_factor=backoff_factor,
+                status_forcelist=status_forcelist,
+                max_concurrency=max_concurrency,
+                state_store=state_store,
+                skip_existing=skip_existing,
+                fsync=fsync,
+                dedup=dedup,
+                writer_threads=writer_threads,
+                rate_controller=AdaptiveRateController(max_concurrency) if adaptive else None,
+                shared_limiter=shared_limiter,
+                max_attempts=max_attempts,
+                retry_delay=retry_delay,
+                failed_keys_file=failed_keys_file,
+                auth_monitor=auth_monitor,
+                prompt_index=prompt_index,
+                prompt_files=prompt_files,
+                shard_size=shard_size,
+                shard_max_files=shard_max_files,
+                object_store=object_store,
+                detect_format=detect_format,
+                convert_format=convert_format,
+                image_quality=image_quality,
+                thumbnail_size=thumbnail_size,
+                post_processes=post_processes
+            )
+    return BatchDownloader(
+        cookies, output_folder,
+        total_retries=total_retries, backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        max_threads=max_threads,
+        state_store=state_store,
+        skip_existing=skip_existing,
+        fsync=fsync,
+        dedup=dedup,
+        writer_threads=writer_threads,
+        rate_controller=AdaptiveRateController(max_threads) if adaptive else None,
+        shared_limiter=shared_limiter,
+        max_attempts=max_attempts,
+        retry_delay=retry_delay,
+        failed_keys_file=failed_keys_file,
+        auth_monitor=auth_monitor,
+        batch_size=batch_size,
+        prompt_index=prompt_index,
+        prompt_files=prompt_files,
+        shard_size=shard_size,
+        shard_max_files=shard_max_files,
+        object_store=object_store,
+        detect_format=detect_format,
+        convert_format=convert_format,
+        image_quality=image_quality,
+        thumbnail_size=thumbnail_size,
+        post_processes=post_processes
+    )
+
+
+class MediaKeyInfo:
+    """
+    一张抓取到的图片，使用 __slots__ 记录而不是字典，使很长的历史记录也只占用很少的内存
+    """
+    __slots__ = ('media_key', 'create_time')
+
+    def __init__(self, media_key, create_time=None):
+        self.media_key = media_key
+        self.create_time = create_time
+
+    def __repr__(self):
+        return f"MediaKeyInfo({self.media_key!r}, {self.create_time!r})"
+
+    def to_dict(self):
+        return {'media_key': self.media_key, 'create_time': self.create_time}
+
+
+def iter_crawl_result(crawl_result_file):
+    """
+    按抓取顺序逐条读取抓取结果文件中的 MediaKeyInfo 记录。既能读取 JSON Lines 抓取日志，也能读取旧版本写入的
+    JSON 数组；不完整的最后一行 (抓取被中断时留下) 会被忽略。
+    """
+    if not os.path.exists(crawl_result_file):
+        return
+    with open(crawl_result_file, 'r', encoding='utf-8') as f:
+        if f.read(1) == "[":
+            f.seek(0)
+            for item in json.load(f):
+                yield MediaKeyInfo(item['media_key'], item.get('create_time'))
+            return
+        f.seek(0)
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'media_key' in entry: #  检查点行只包含游标
+                yield MediaKeyInfo(entry['media_key'], entry.get('create_time'))
+
+
+def crawl_resume_point(crawl_result_file):
+    """
+    如果 crawl_result_file 中的上一次抓取提前停止 (页面请求失败、程序被停止或达到 max_keys)，返回其最后一个检查点的
+    (cursor, crawled_count, after)，抓取已结束或没有检查点时返回 None。
+    after 是 max_keys 在 cursor 所在页面中途停止抓取时最后取到的 mediaKey，否则为 None。
+    """
+    if not os.path.exists(crawl_result_file):
+        return None
+    checkpoint = None
+    with open(crawl_result_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('{"cursor"'): #  只解析检查点行
+                try:
+                    checkpoint = json.loads(line)
+                except ValueError:
+                    pass
+    if not checkpoint or not (checkpoint.get('cursor') or checkpoint.get('after')):
+        return None
+    return checkpoint['cursor'], checkpoint.get('crawled') or 0, checkpoint.get('after')
+
+
+class CrawlLog:
+    """
+    只追加的 JSON Lines 抓取结果文件，在抓取过程中逐页写入: 每张图片一行紧凑的 {"media_key", "create_time"}，
+    然后是一行 {"cursor", "crawled"} 检查点，记录抓取继续所用的 nextPageToken (抓取结束后为 "") 和目前已抓取的链接数量，
+    max_keys 在 cursor 所在页面中途停止抓取时还记录 "after" (最后取到的 mediaKey)。抓取被中断时最多丢失正在写入的那一页。
+    已在日志中的 mediaKey 不会再次写入 (增量同步会再次抓取仍未下载或失败的图片)。
+    append=False 时替换之前的内容，但要等到收到第一页时才替换。
+    """
+    def __init__(self, crawl_result_file, append=True):
+        self.crawl_result_file = crawl_result_file
+        self.append = append
+        self.file = None
+        self.written_count = 0
+        self.media_keys = set() #  日志中的 mediaKey，在追加第一页前从已有文件中读取
+
+    def append_page(self, page, cursor, crawled_count=None, after=None):
+        if self.file is None:
+            if self.append:
+                self._repair()
+                self.media_keys.update(item.media_key for item in iter_crawl_result(self.crawl_result_file))
+            self.file = open(self.crawl_result_file, 'a' if self.append else 'w', encoding='utf-8')
+        page = [item for item in page if item.media_key not in self.media_keys]
+        self.media_keys.update(item.media_key for item in page)
+        lines = [json.dumps(item.to_dict(), ensure_ascii=False, separators=(",", ":")) for item in page]
+        checkpoint = {'cursor': cursor, 'crawled': crawled_count}
+        if after:
+            checkpoint['after'] = after
+        lines.append(json.dumps(checkpoint, separators=(",", ":")))
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush() #  每页只写入并刷新一次，使该页和它的检查点一起落盘
+        self.written_count += len(page)
+
+    def _repair(self):
+        #  把旧版本的 JSON 数组转换为 JSON Lines，并截掉不完整的最后一行，使追加从新的一行开始
+        if not os.path.exists(self.crawl_result_file):
+            return
+        with open(self.crawl_result_file, 'rb+') as f:
+            is_json_array = f.read(1) == b"["
+            size = f.seek(0, os.SEEK_END)
+            if not is_json_array and size:
+                f.seek(max(0, size - 65536))
+                tail = f.read()
+                if not tail.endswith(b"\n"):
+                    f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+        if is_json_array:
+            temp_filename = self.crawl_result_file + ".part"
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                for item in iter_crawl_result(self.crawl_result_file):
+                    f.write(json.dumps(item.to_dict(), ensure_ascii=False, separators=(",", ":")) + "\n")
+            os.replace(temp_filename, self.crawl_result_file)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.written_count:
+            print(f"成功将 {self.written_count} 张抓取到的图片链接保存到文件 '{self.crawl_result_file}'。")
+
+
+#  --- 库 API: crawl()、download() 和 sync() 不会询问任何问题并返回结果，供脚本和定时任务使用 ---
+
+DOWNLOADER_OPTION_NAMES = ('engine', 'max_threads', 'max_concurrency', 'adaptive', 'total_retries', 'backoff_factor', 'status_forcelist',
+                           'skip_existing', 'fsync', 'dedup', 'writer_threads', 'max_attempts', 'retry_delay', 'failed_keys_file',
+                           'batch_size', 'prompt_files', 'shard_size', 'shard_max_files', 's3_url', 's3_endpoint_url', 's3_multipart_size',
+                           'detect_format', 'convert_format', 'image_quality', 'thumbnail_size', 'post_processes')
+RETRY_OPTION_NAMES = ('total_retries', 'backoff_factor', 'status_forcelist')
+REPORT_OPTION_NAMES = ('metrics_file', 'metrics_interval', 'progress_bar', 'prometheus_port')
+AUTH_OPTION_NAMES = ('cookie_file', 'auth_wait_time')
+SYNC_OPTION_NAMES = ('output_folder', 'crawl_result_file', 'state_db_file', 'incremental', 'streaming', 'max_keys', 'page_size', 'page_sleep_time',
+                     'stop_after_known', 'preview_size', 'resume_crawl', 'prompt_index_file')
+
+
+def crawl(cookie, max_keys=None, page_size=100, page_sleep_time=1, known_media_keys=None, stop_after_known=12,
+          total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), crawl_result_file=None, resume_crawl=False,
+          cookie_file=None, auth_wait_time=3600):
+    """
+    抓取 cookie 对应账号的图片历史记录，返回 MediaKeyInfo 记录列表，按从新到旧排列。
+    传入 known_media_keys (例如 known_downloaded_media_keys()) 时会跳过这些 mediaKey，连续遇到 stop_after_known 个时停止抓取。
+    传入 crawl_result_file 时，链接还会逐页写入该文件 (替换其原有内容)。resume_crawl 为真时，从该文件中提前停止的抓取
+    (被中断或因 max_keys 停止) 的最后一个检查点继续抓取，只返回新抓取的链接。
+    cookie 过期时，抓取最多等待 auth_wait_time 秒，直到 cookie_file 中有新的 cookie (见 AuthMonitor)。
+    """
+    resume_point = crawl_resume_point(crawl_result_file) if crawl_result_file and resume_crawl else None
+    cookies = {'Cookie': cookie}
+    media_keys_crawler = MediaKeyCrawler(
+        cookies, max_keys,
+        total_retries=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+        page_sleep_time=page_sleep_time,
+        page_size=page_size,
+        known_media_keys=known_media_keys,
+        stop_after_known=stop_after_known,
+        crawl_log=CrawlLog(crawl_result_file, append=bool(resume_point)) if crawl_result_file else None,
+        resume_point=resume_point,
+        auth_monitor=AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time)
+    )
+    try:
+        return media_keys_crawler.get_all_media_keys_info()
     finally:
-        if on_thread_complete:
-            on_thread_complete(success) # 修改: 将下载结果传递给回调函数
+        if media_keys_crawler.crawl_log:
+            media_keys_crawler.crawl_log.close()
+
+
+def download(cookie, media_keys_info, output_folder="imagefx_images", state_db_file="download_state.db", resume=True, preview_size=None,
+             prompt_index_file="prompt_index.db", cookie_file=None, auth_wait_time=3600, **downloader_options):
+    """
+    把 media_keys_info (MediaKeyInfo 记录，例如来自 iter_crawl_result()，按需逐条读取) 中的图片下载到 output_folder。resume 为真时跳过 state_db_file 中记录为已下载的图片
+    (state_db_file=None 时不使用状态数据库)。downloader_options 会传给 build_downloader，
+    MetricsReporter 的选项 (metrics_file、metrics_interval、progress_bar、prometheus_port) 除外。提示词同时写入可搜索的
+    提示词索引 prompt_index_file (见 PromptIndex，None 时不使用)。
+    cookie 过期时，下载最多暂停 auth_wait_time 秒，直到 cookie_file 中有新的 cookie (见 AuthMonitor)。
+    返回 {'downloaded', 'failed', 'skipped', 'seconds'}。
+    """
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    report_options = {name: downloader_options.pop(name) for name in REPORT_OPTION_NAMES if name in downloader_options}
+    state_store = DownloadStateStore(state_db_file) if state_db_file else None
+    prompt_index = PromptIndex(prompt_index_file) if prompt_index_file else None
+    skipped_count = 0
+    reporter = None
+    try:
+        if state_store and resume:
+            done_media_keys = state_store.get_done_media_keys(converted_extension(downloader_options.get('convert_format')))
+
+            def pending_media_keys_info(media_keys_info=media_keys_info):
+                nonlocal skipped_count
+                for item in media_keys_info:
+                    if item.media_key in done_media_keys:
+                        skipped_count += 1
+                    else:
+                        yield item
+
+            media_keys_info = pending_media_keys_info()
+        cookies = {'Cookie': cookie}
+        downloader = build_downloader(cookies, output_folder, state_store=state_store, prompt_index=prompt_index,
+                                      auth_monitor=AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time), **downloader_options)
+        reporter = MetricsReporter(downloader.metrics, **report_options)
+        reporter.start()
+        download_with_previews(downloader, media_keys_info, preview_size)
+    finally:
+        if reporter:
+            reporter.stop()
+        if state_store:
+            state_store.close()
+        if prompt_index:
+            prompt_index.close()
+    return {'downloaded': downloader.success_count, 'failed': downloader.failure_count, 'skipped': skipped_count,
+            'seconds': time.time() - start_time}
+
+
+def sync(cookie, output_folder="imagefx_images", crawl_result_file="media_keys_crawl_result.json", state_db_file="download_state.db",
+         incremental=True, streaming=True, max_keys=None, page_size=100, page_sleep_time=1, stop_after_known=12, preview_size=None,
+         resume_crawl=True, prompt_index_file="prompt_index.db", cookie_file=None, auth_wait_time=3600, **downloader_options):
+    """
+    抓取历史记录并下载新图片，同时把新链接逐页追加到 crawl_result_file。incremental 为真时，state_db_file 中记录为下载完成的
+    图片被视为已知图片，抓取到它们时停止，否则替换该文件。之前的运行已加入队列但未下载完成 (pending 或 failed) 的图片会重新下载。streaming 为真时边抓取边下载 (不与 preview_size 同时使用，
+    分级下载需要先得到完整列表)。resume_crawl 为真时，提前停止的抓取 (被中断或因 max_keys 停止) 从最后一个检查点继续，而不是从头开始
+    (这之后新增的图片由下一次增量同步获取)。prompt_index_file、cookie_file、auth_wait_time 和 downloader_options 的处理方式与 download() 相同。
+    返回 {'crawled', 'downloaded', 'failed', 'seconds'}。
+    """
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    report_options = {name: downloader_options.pop(name) for name in REPORT_OPTION_NAMES if name in downloader_options}
+    checkpoint = crawl_resume_point(crawl_result_file) if resume_crawl or incremental else None
+    resume_point = checkpoint if resume_crawl else None
+    crawl_log = CrawlLog(crawl_result_file, append=incremental or bool(resume_point))
+    cookies = {'Cookie': cookie} #  抓取器和下载器共用，重新加载的 cookie 两者都会使用
+    auth_monitor = AuthMonitor(cookies, cookie_file, wait_time=auth_wait_time)
+    state_store = DownloadStateStore(state_db_file) if state_db_file else None
+    prompt_index = PromptIndex(prompt_index_file) if prompt_index_file else None
+    reporter = None
+    try:
+        downloader = build_downloader(cookies, output_folder, state_store=state_store, prompt_index=prompt_index, auth_monitor=auth_monitor,
+                                      **downloader_options)
+        known_media_keys = known_downloaded_media_keys(output_folder, state_store, downloader.object_store, converted_extension(downloader.convert_format),
+                                                       bool(downloader.thumbnail_size)) if incremental else None
+        media_keys_crawler = MediaKeyCrawler(
+            cookies, max_keys,
+            page_sleep_time=page_sleep_time,
+            page_size=page_size,
+            known_media_keys=known_media_keys,
+            stop_after_known=stop_after_known,
+            crawl_log=crawl_log,
+            resume_point=resume_point,
+            pending_checkpoint=None if resume_crawl else checkpoint, #  之后 resume_crawl 为真的运行仍可继续它
+            auth_monitor=auth_monitor,
+            **{name: downloader_options[name] for name in RETRY_OPTION_NAMES if name in downloader_options}
+        )
+        #  之前的运行未下载完成的图片 (失败或运行被中断)，在新图片之后下载
+        retry_items = state_store.get_unfinished_media_keys_info() if state_store else []
+        retry_media_keys = {item.media_key for item in retry_items}
+        if retry_items:
+            print(f"之前的运行未下载完成的 {len(retry_items)} 张图片已重新加入队列。")
+        reporter = MetricsReporter(downloader.metrics, **report_options)
+        reporter.start()
+        if streaming and not preview_size:
+            media_keys_crawler.rate_controller = downloader.rate_controller
+            new_items = (item for item in media_keys_crawler.iter_media_keys_info() if item.media_key not in retry_media_keys)
+            downloader.download_media_keys(itertools.chain(new_items, retry_items))
+        else:
+            media_keys_info = [item for item in media_keys_crawler.get_all_media_keys_info() if item.media_key not in retry_media_keys] + retry_items
+            if media_keys_info:
+                download_with_previews(downloader, media_keys_info, preview_size)
+    finally:
+        if reporter:
+            reporter.stop()
+        if state_store:
+            state_store.close()
+        if prompt_index:
+            prompt_index.close()
+        crawl_log.close()
+    return {'crawled': crawl_log.written_count, 'downloaded': downloader.success_count, 'failed': downloader.failure_count,
+            'seconds': time.time() - start_time}
+
+
+def sync_accounts(accounts, max_total_concurrency=None, max_bandwidth=None):
+    """
+    同时同步多个账号，整个备份所需的时间约等于最大的那个账号。每个账号是一个 sync() 参数的字典 (cookie、output_folder 等，
+    以及 max_threads、adaptive 等下载选项，即该账号自己的限制)，可另加 name。max_total_concurrency 限制所有账号合计的
+    并发请求数，max_bandwidth 限制它们合计每秒保存的兆字节数。
+    返回 {'accounts': {name: sync() 的结果，或 {'error': ...}}, 'downloaded', 'failed', 'failed_accounts', 'seconds'}。
+    """
+    start_time = time.time()
+    shared_limiter = SharedLimiter(max_total_concurrency, max_bandwidth * 1e6 if max_bandwidth else None)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(accounts))) as executor:
+        futures = {}
+        for index, account in enumerate(accounts):
+            account = dict(account)
+            name = account.pop('name', None) or account.get('output_folder') or f"account{index + 1}"
+            print(f"账号 '{name}': 开始同步到 '{account.get('output_folder', 'imagefx_images')}'。")
+            futures[name] = executor.submit(sync, shared_limiter=shared_limiter, **account)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e: #  一个账号失败 (例如 Cookie 过期) 不会影响其他账号
+                print(f"账号 '{name}' 同步失败: {e!r}")
+                results[name] = {'error': repr(e)}
+    for name, result in results.items():
+        if 'error' not in result:
+            print(f"账号 '{name}': 抓取了 {result['crawled']} 个新链接，下载了 {result['downloaded']} 张图片，失败 {result['failed']} 张。")
+    return {
+        'accounts': results,
+        'downloaded': sum(result.get('downloaded', 0) for result in results.values()),
+        'failed': sum(result.get('failed', 0) for result in results.values()),
+        'failed_accounts': sum('error' in result for result in results.values()),
+        'seconds': time.time() - start_time,
+    }
+
+
+def index_prompt_files(output_folder="imagefx_images", prompt_index_file="prompt_index.db", crawl_result_file=None):
+    """
+    把 output_folder 中有提示词 .txt 文件、但还不在 prompt_index_file 中的图片 (例如旧版本保存的图片) 加入提示词索引，
+    创建时间取自 crawl_result_file。返回加入的提示词数量。
+    """
+    create_times = {item.media_key: item.create_time for item in iter_crawl_result(crawl_result_file)} if crawl_result_file else {}
+    prompt_index = PromptIndex(prompt_index_file)
+    added_count = 0
+    try:
+        indexed_media_keys = prompt_index.get_media_keys()
+        folders = []
+        if os.path.isdir(output_folder):
+            with os.scandir(output_folder) as entries: #  日期文件夹，不包括预览图
+                folders = [output_folder] + [entry.path for entry in entries if entry.is_dir() and entry.name != PREVIEW_FOLDER_NAME]
+        rows = []
+        for folder in folders:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    media_key = image_media_key(entry.name)
+                    if not media_key or media_key in indexed_media_keys:
+                        continue
+                    try:
+                        with open(os.path.join(folder, f"{media_key}.txt"), 'r', encoding='utf-8') as f:
+                            prompt_text = f.read()
+                    except OSError: #  这张图片旁边没有提示词文件
+                        continue
+                    rows.append((media_key, create_times.get(media_key), entry.path, entry.stat().st_size, prompt_text))
+                    if len(rows) >= 500:
+                        prompt_index.add_prompts(rows)
+                        added_count += len(rows)
+                        rows = []
+        if rows:
+            prompt_index.add_prompts(rows)
+            added_count += len(rows)
+    finally:
+        prompt_index.close()
+    return added_count
+
+
+def search_prompts(query, prompt_index_file="prompt_index.db", max_results=100):
+    """
+    返回 prompt_index_file 中提示词包含 query 中每个词的图片，最新的在前 (见 PromptIndex.search)
+    """
+    prompt_index = PromptIndex(prompt_index_file)
+    try:
+        return prompt_index.search(query, max_results)
+    finally:
+        prompt_index.close()
+
+
+#  --- 命令行: python "ImageFX downloader - zh.py" {crawl,download,sync,index,search} [选项]，不带参数时使用交互式提问 ---
+
+DEFAULT_OPTIONS = {
+    'cookie': None,
+    'cookie_file': None,
+    'auth_wait_time': 3600,
+    'output_folder': "imagefx_images",
+    'crawl_result_file': "media_keys_crawl_result.json",
+    'state_db_file': "download_state.db",
+    'prompt_index_file': "prompt_index.db",
+    'max_keys': None,
+    'total_retries': 10,
+    'backoff_factor': 1,
+    'status_forcelist': (429, 500, 502, 503, 504),
+    'page_sleep_time': 1,
+    'page_size': 100,
+    'stop_after_known': 12,
+    'incremental': True,
+    'streaming': True,
+    'resume': True,
+    'resume_crawl': True,
+    'preview_size': None,
+    'engine': 'threads',
+    'max_threads': 10,
+    'max_concurrency': 100,
+    'writer_threads': 2,
+    'adaptive': False,
+    'skip_existing': False,
+    'fsync': False,
+    'dedup': False,
+    'max_attempts': 3,
+    'retry_delay': 10,
+    'failed_keys_file': "failed_media_keys.jsonl",
+    'batch_size': 1,
+    'prompt_files': True,
+    'shard_size': None,
+    'shard_max_files': None,
+    's3_url': None,
+    's3_endpoint_url': None,
+    's3_multipart_size': 8,
+    'detect_format': False,
+    'convert_format': None,
+    'image_quality': 90,
+    'thumbnail_size': None,
+    'post_processes': None,
+    'json': False,
+    'progress_bar': False,
+    'metrics_file': None,
+    'metrics_interval': 10,
+    'prometheus_port': None,
+    'accounts': None,
+    'max_total_concurrency': None,
+    'max_bandwidth': None,
+    'query': None,
+    'max_results': 100,
+}
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'on'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'no', 'n', 'off', ''):
+        return False
+    raise ValueError(f"不是 yes/no 值: {value!r}")
+
+
+def parse_status_codes(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(int(code) for code in value)
+
+
+OPTION_TYPES = {
+    'cookie': str, 'cookie_file': str, 'output_folder': str, 'crawl_result_file': str, 'state_db_file': str, 'engine': str,
+    'prompt_index_file': str, 'query': str, 'max_results': int, 'shard_size': float, 'shard_max_files': int,
+    's3_url': str, 's3_endpoint_url': str, 's3_multipart_size': float, 'convert_format': str, 'image_quality': int, 'thumbnail_size': int,
+    'post_processes': int,
+    'max_keys': int, 'total_retries': int, 'page_size': int, 'stop_after_known': int, 'preview_size': int,
+    'max_threads': int, 'max_concurrency': int, 'writer_threads': int, 'max_attempts': int, 'batch_size': int,
+    'backoff_factor': float, 'page_sleep_time': float, 'retry_delay': float, 'failed_keys_file': str, 'auth_wait_time': float,
+    'status_forcelist': parse_status_codes,
+    'incremental': parse_bool, 'streaming': parse_bool, 'resume': parse_bool, 'resume_crawl': parse_bool, 'adaptive': parse_bool, 'skip_existing': parse_bool,
+    'fsync': parse_bool, 'dedup': parse_bool, 'prompt_files': parse_bool, 'detect_format': parse_bool, 'json': parse_bool,
+    'progress_bar': parse_bool, 'metrics_file': str, 'metrics_interval': float, 'prometheus_port': int,
+    'accounts': str, 'max_total_concurrency': int, 'max_bandwidth': float,
+}
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="无需交互即可下载你的 Google ImageFX 图片和提示词。每个选项也可以在 JSON 配置文件 (--config) 中设置，或通过 IMAGEFX_<选项> 环境变量设置，例如 IMAGEFX_COOKIE、IMAGEFX_MAX_THREADS。优先级: 命令行 > 环境变量 > 配置文件 > 默认值。",
+        argument_default=argparse.SUPPRESS #  只有实际给出的选项才会覆盖环境变量和配置文件
+    )
+    parser.add_argument("command", choices=['crawl', 'download', 'sync', 'index', 'search'],
+                        help="crawl: 把链接保存到抓取结果文件; download: 下载抓取结果文件中的链接; sync: 抓取新图片并下载; "
+                             "index: 把输出文件夹中的提示词 .txt 文件加入提示词索引; search: 列出提示词包含 QUERY 中每个词的图片")
+    parser.add_argument("query", nargs='*', help="search: 要查找的词，例如 红色 狐狸")
+    parser.add_argument("--config", help="包含选项的 JSON 文件，键名与长选项名相同，使用下划线 (例如 max_threads)")
+    parser.add_argument("--cookie", help="labs.google 的 Cookie 字符串 (建议使用 --cookie-file 或 IMAGEFX_COOKIE，命令行对其他用户可见)")
+    parser.add_argument("--cookie-file", help="包含 Cookie 字符串的文件，运行过程中 cookie 过期时会重新读取")
+    parser.add_argument("--auth-wait-time", type=float, help="运行过程中 cookie 过期时，等待 --cookie-file 中出现新 cookie 的秒数 (默认: 3600)")
+    parser.add_argument("--output-folder", help="默认: imagefx_images")
+    parser.add_argument("--crawl-result-file", help="JSON Lines 抓取日志，默认: media_keys_crawl_result.json (文件名沿用旧版本的 JSON 数组格式)")
+    parser.add_argument("--state-db-file", help="下载状态数据库，默认: download_state.db")
+    parser.add_argument("--prompt-index-file", help="可搜索的提示词 SQLite 数据库，默认: prompt_index.db ('' 表示不使用)")
+    parser.add_argument("--prompt-files", action=argparse.BooleanOptionalAction, help="同时把每条提示词保存为图片旁边的 .txt 文件 (默认: 开)")
+    parser.add_argument("--max-results", type=int, help="search: 最多列出的图片数，0 表示全部 (默认: 100)")
+    parser.add_argument("--max-keys", type=int, help="一次运行最多抓取的链接数量，下一次运行继续该抓取 (见 --resume-crawl)")
+    parser.add_argument("--total-retries", type=int, help="默认: 10")
+    parser.add_argument("--backoff-factor", type=float, help="默认: 1")
+    parser.add_argument("--status-forcelist", type=parse_status_codes, help="需要重试的状态码，默认: 429,500,502,503,504")
+    parser.add_argument("--page-sleep-time", type=float, help="抓取时两页之间的秒数，默认: 1")
+    parser.add_argument("--page-size", type=int, help="每页链接数量，不被接受时自动减半，默认: 100")
+    parser.add_argument("--stop-after-known", type=int, help="增量同步连续遇到这么多张已知图片时停止，默认: 12")
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, help="sync: 只抓取比已下载的图片更新的图片 (默认: 开)")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, help="sync: 边抓取边下载 (默认: 开)")
+    parser.add_argument("--resume", action=argparse.BooleanOptionalAction, help="download: 跳过状态数据库中记录为已下载的图片 (默认: 开)")
+    parser.add_argument("--resume-crawl", action=argparse.BooleanOptionalAction, help="crawl/sync: 从最后保存的页面继续被中断的抓取 (默认: 开)")
+    parser.add_argument("--preview-size", type=int, help="分级模式: 先下载这么多像素的预览图，再下载原图")
+    parser.add_argument("--engine", choices=['threads', 'async'], help="下载引擎，默认: threads")
+    parser.add_argument("--max-threads", type=int, help="threads 引擎的下载线程数，默认: 10")
+    parser.add_argument("--max-concurrency", type=int, help="async 引擎同时进行中的请求数，默认: 100")
+    parser.add_argument("--writer-threads", type=int, help="文件写入线程数，默认: 2")
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, help="自适应速率控制 (默认: 关)")
+    parser.add_argument("--skip-existing", action=argparse.BooleanOptionalAction, help="跳过输出文件夹中已存在的图片 (默认: 关)")
+    parser.add_argument("--fsync", action=argparse.BooleanOptionalAction, help="对每个保存的文件执行 fsync (默认: 关)")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, help="相同的图片使用硬链接 (默认: 关)")
+    parser.add_argument("--batch-size", type=int, help="threads 引擎: 每个 tRPC 批量请求获取的图片数 (默认: 1，不使用批量请求；不能与 --engine async 同时使用)")
+    parser.add_argument("--shard-size", type=float, help="把图片和提示词追加到每个这么多兆字节的滚动 tar 分片中 (每个分片带一个 .index.jsonl 偏移量索引)，而不是保存为单独的文件 (默认: 关)")
+    parser.add_argument("--shard-max-files", type=int, help="每个 tar 分片存放这么多张图片后开始新分片 (同样会开启分片)")
+    parser.add_argument("--s3-url", help="把图片和提示词上传到这个兼容 S3 的存储桶，而不是保存到输出文件夹，例如 s3://backup/imagefx (需要 boto3，凭据取自 AWS_* 环境变量)")
+    parser.add_argument("--s3-endpoint-url", help="AWS 以外的兼容 S3 服务器的地址，例如 MinIO 的 http://127.0.0.1:9000")
+    parser.add_argument("--s3-multipart-size", type=float, help="大于这么多兆字节的对象按这个大小分段上传 (默认: 8)")
+    parser.add_argument("--detect-format", action=argparse.BooleanOptionalAction, help="按每张图片的真实格式 (根据开头的字节检测为 .jpg、.png、.webp 或 .gif) 的扩展名保存，而不是一律保存为 .jpg (默认: 关)")
+    parser.add_argument("--convert-format", choices=['jpg', 'png', 'webp'], help="保存前把图片重新编码为这种格式 (需要 Pillow，同样会开启 --detect-format)")
+    parser.add_argument("--image-quality", type=int, help="--convert-format 和缩略图的质量，1-100 (默认: 90)")
+    parser.add_argument("--thumbnail-size", type=int, help="同时在每张图片旁边的 thumbnails 子文件夹中保存不超过这么多像素的缩略图 (需要 Pillow)")
+    parser.add_argument("--post-processes", type=int, help="重新编码图片和生成缩略图的工作进程数 (默认: 每个 CPU 核心一个)")
+    parser.add_argument("--max-attempts", type=int, help="每张图片的尝试次数，失败的图片排到队列末尾重试 (默认: 3)")
+    parser.add_argument("--retry-delay", type=float, help="失败图片第一次延迟重试前等待的秒数，之后每次加倍 (默认: 10)")
+    parser.add_argument("--failed-keys-file", help="最终失败的图片的报告，默认: failed_media_keys.jsonl")
+    parser.add_argument("--json", action=argparse.BooleanOptionalAction, help="最后以一行 JSON 打印结果")
+    parser.add_argument("--progress-bar", action=argparse.BooleanOptionalAction, help="显示带预计剩余时间的进度条，代替定期打印的进度 (默认: 关)")
+    parser.add_argument("--metrics-file", help="每隔 --metrics-interval 秒向此文件追加一行 JSON 指标 (吞吐量、各阶段延迟、队列深度、重试次数)，'-' 表示控制台")
+    parser.add_argument("--metrics-interval", type=float, help="默认: 10")
+    parser.add_argument("--prometheus-port", type=int, help="在 http://127.0.0.1:PORT/metrics 为 Prometheus 提供指标")
+    parser.add_argument("--accounts", help='sync: 同时同步此 JSON 文件中的所有账号，例如 [{"name": "work", "cookie_file": "work.txt", "max_threads": 4}]')
+    parser.add_argument("--max-total-concurrency", type=int, help="--accounts: 所有账号合计的并发请求数 (默认: 不限制)")
+    parser.add_argument("--max-bandwidth", type=float, help="--accounts: 所有账号合计每秒保存的兆字节数 (默认: 不限制)")
+    return parser
+
+
+def check_optional_dependencies(options):
+    """
+    选项需要未安装的可选包时抛出 ValueError，并给出要安装的包
+    """
+    if (options.get('convert_format') or options.get('thumbnail_size')) and Image is None:
+        raise ValueError("convert_format 和 thumbnail_size 需要 Pillow，请先安装: pip install Pillow")
+    if options.get('s3_url') and boto3 is None:
+        raise ValueError("s3_url 需要 boto3，请先安装: pip install boto3")
+
+
+def check_option_conflicts(options):
+    """
+    选项中包含不能同时使用的设置时抛出 ValueError
+    """
+    if options.get('s3_url') and (options.get('shard_size') or options.get('shard_max_files')):
+        raise ValueError("归档分片写入输出文件夹，不能与 s3_url 同时使用")
+    if options.get('engine') == 'async' and (options.get('batch_size') or 1) > 1:
+        raise ValueError("batch_size 只适用于 threads 引擎，async 引擎不使用批量请求")
+
+
+def load_options(args, environ=None):
+    """
+    合并选项: 命令行参数 > IMAGEFX_* 环境变量 > 配置文件 > DEFAULT_OPTIONS
+    """
+    environ = os.environ if environ is None else environ
+    options = dict(DEFAULT_OPTIONS)
+    config_file = args.pop('config', None) or environ.get('IMAGEFX_CONFIG')
+    if config_file:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            options.update({name.replace('-', '_'): value for name, value in json.load(f).items()})
+    for name, option_type in OPTION_TYPES.items():
+        value = environ.get('IMAGEFX_' + name.upper())
+        if value is not None:
+            options[name] = option_type(value)
+    options.update(args)
+    for name, option_type in OPTION_TYPES.items():
+        if options.get(name) is not None:
+            options[name] = option_type(options[name])
+    unknown_options = set(options) - set(DEFAULT_OPTIONS)
+    if unknown_options:
+        raise ValueError(f"未知的选项: {', '.join(sorted(unknown_options))}")
+    check_option_conflicts(options)
+    check_optional_dependencies(options)
+    if options['cookie_file'] and not options['cookie']:
+        options['cookie'] = read_cookie_file(options['cookie_file'])
+    return options
+
+
+def load_accounts(accounts_file, options):
+    """
+    读取 accounts_file 中的账号配置: 一个 JSON 列表，每个对象的键与配置文件相同，可另加 name。
+    账号未设置的选项取自 options (指标报告选项除外，它们只对设置了它们的账号生效)。输出文件夹默认为
+    <output_folder>/<name>，相对路径的抓取结果文件、状态数据库、提示词索引和失败报告放在该账号的输出文件夹中。
+    """
+    with open(accounts_file, 'r', encoding='utf-8') as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, list) or not profiles:
+        raise ValueError(f"{accounts_file} 必须包含一个账号配置列表")
+    account_option_names = ('cookie', 'auth_wait_time') + SYNC_OPTION_NAMES + DOWNLOADER_OPTION_NAMES
+    accounts = []
+    for index, profile in enumerate(profiles):
+        profile = {name.replace('-', '_'): value for name, value in profile.items()}
+        unknown_options = set(profile) - set(account_option_names + REPORT_OPTION_NAMES) - {'name', 'cookie_file'}
+        if unknown_options:
+            raise ValueError(f"账号 {index + 1} 中有未知选项: {', '.join(sorted(unknown_options))}")
+        for name, option_type in OPTION_TYPES.items():
+            if profile.get(name) is not None:
+                profile[name] = option_type(profile[name])
+        cookie_file = profile.pop('cookie_file', None)
+        if cookie_file and not profile.get('cookie'):
+            profile['cookie'] = read_cookie_file(cookie_file)
+        name = str(profile.pop('name', None) or os.path.basename(os.path.normpath(profile.get('output_folder') or "")) or f"account{index + 1}")
+        account = {option: options[option] for option in account_option_names}
+        account.update(profile)
+        account['cookie_file'] = cookie_file if profile.get('cookie') else options['cookie_file'] #  该账号的 cookie 来自的文件，cookie 过期时重新读取
+        if not account['cookie']:
+            raise ValueError(f"账号 '{name}' 没有 cookie 或 cookie_file")
+        account['output_folder'] = profile.get('output_folder') or os.path.join(options['output_folder'], name)
+        if account['s3_url'] and not profile.get('s3_url'): #  各账号共用存储桶，每个账号使用自己的前缀
+            account['s3_url'] = account['s3_url'].rstrip("/") + "/" + name
+        account['crawl_result_file'] = os.path.join(account['output_folder'], account['crawl_result_file'])
+        if account['state_db_file']:
+            account['state_db_file'] = os.path.join(account['output_folder'], account['state_db_file'])
+        if account['prompt_index_file']:
+            account['prompt_index_file'] = os.path.join(account['output_folder'], account['prompt_index_file'])
+        if account['failed_keys_file']:
+            account['failed_keys_file'] = os.path.join(account['output_folder'], account['failed_keys_file'])
+        if any(other['name'] == name for other in accounts):
+            raise ValueError(f"有多个账号名为 '{name}'")
+        check_option_conflicts(account)
+        check_optional_dependencies(account)
+        accounts.append(dict(account, name=name))
+    return accounts
+
+
+def run_command_line(argv):
+    """
+    不经交互运行 crawl/download/sync/index/search 命令，返回退出码 (有图片失败时为 1，选项无效时为 2)
+    """
+    args = vars(build_argument_parser().parse_intermixed_args(argv))
+    command = args.pop('command')
+    if 'query' in args:
+        args['query'] = " ".join(args['query']) #  词可以作为多个参数给出
+    try:
+        options = load_options(args)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"选项无效: {e}")
+        return 2
+    if options['accounts'] and command != 'sync':
+        print("--accounts 只能与 sync 命令一起使用。")
+        return 2
+    if command in ('crawl', 'download', 'sync') and not options['cookie'] and not options['accounts']:
+        print("需要 Cookie 字符串: 请使用 --cookie-file、--cookie 或 IMAGEFX_COOKIE 环境变量。")
+        return 2
+    downloader_options = {name: options[name] for name in DOWNLOADER_OPTION_NAMES + REPORT_OPTION_NAMES}
+    auth_options = {name: options[name] for name in AUTH_OPTION_NAMES}
+
+    if command == 'index':
+        start_time = time.time()
+        result = {'indexed': index_prompt_files(options['output_folder'], options['prompt_index_file'], options['crawl_result_file']),
+                  'seconds': time.time() - start_time}
+        print(f"已把 '{options['output_folder']}' 中的 {result['indexed']} 条提示词加入提示词索引 '{options['prompt_index_file']}'。")
+    elif command == 'search':
+        if not options['prompt_index_file'] or not os.path.exists(options['prompt_index_file']):
+            print(f"未找到提示词索引 '{options['prompt_index_file']}'。它由 download 和 sync 写入，之前保存的图片可用 index 命令加入。")
+            return 2
+        start_time = time.time()
+        matches = search_prompts(options['query'] or "", options['prompt_index_file'], options['max_results'])
+        for match in matches: #  每行一个图片路径，方便通过管道交给其他命令
+            print(json.dumps(match, ensure_ascii=False) if options['json'] else match['image_path'])
+        result = {'matches': len(matches), 'seconds': time.time() - start_time}
+    elif command == 'crawl':
+        start_time = time.time()
+        media_keys_info = crawl(options['cookie'], options['max_keys'], page_size=options['page_size'], page_sleep_time=options['page_sleep_time'],
+                                crawl_result_file=options['crawl_result_file'], resume_crawl=options['resume_crawl'], **auth_options,
+                                **{name: options[name] for name in RETRY_OPTION_NAMES})
+        result = {'crawled': len(media_keys_info), 'seconds': time.time() - start_time}
+    elif command == 'download':
+        media_keys_info = iter_crawl_result(options['crawl_result_file'])
+        first_item = next(media_keys_info, None) #  文件的其余部分在下载过程中读取
+        if first_item is None:
+            print(f"'{options['crawl_result_file']}' 中没有链接，请先运行 crawl 或 sync 命令。")
+            return 2
+        result = download(options['cookie'], itertools.chain([first_item], media_keys_info), options['output_folder'], options['state_db_file'],
+                          resume=options['resume'], preview_size=options['preview_size'], prompt_index_file=options['prompt_index_file'],
+                          **auth_options, **downloader_options)
+    elif options['accounts']:
+        try:
+            accounts = load_accounts(options['accounts'], options)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"选项无效: {e}")
+            return 2
+        result = sync_accounts(accounts, options['max_total_concurrency'], options['max_bandwidth'])
+    else:
+        result = sync(options['cookie'], options['output_folder'], options['crawl_result_file'], options['state_db_file'],
+                      incremental=options['incremental'], streaming=options['streaming'], max_keys=options['max_keys'],
+                      page_size=options['page_size'], page_sleep_time=options['page_sleep_time'],
+                      stop_after_known=options['stop_after_known'], preview_size=options['preview_size'], resume_crawl=options['resume_crawl'],
+                      prompt_index_file=options['prompt_index_file'], **auth_options, **downloader_options)
+
+    if options['json']:
+        print(json.dumps(result))
+    return 1 if result.get('failed') or result.get('failed_accounts') else 0
 
 
 def main():
     """
-    主函数： 获取 mediaKey 列表并批量多线程下载图片和提示词 (最终多线程版本 - 移除边抓边下模式)
+    不带命令行参数时使用交互式提问，否则无需交互地运行给定的命令
+    """
+    if len(sys.argv) == 1:
+        interactive_main()
+    else:
+        sys.exit(run_command_line(sys.argv[1:]))
+
+
+def interactive_main():
+    """
+    主函数： 获取 mediaKey 列表并多线程下载图片和提示词，有两种模式:
+    先抓取，确认后再下载整个列表 (默认)；或流式模式，在抓取链接的同时下载
     """
     output_folder = "imagefx_images"
     os.makedirs(output_folder, exist_ok=True)
     crawl_result_file = "media_keys_crawl_result.json"
+    state_db_file = "download_state.db"
+    state_store = DownloadStateStore(state_db_file)
+    prompt_index = PromptIndex("prompt_index.db") #  可用以下命令搜索: python "ImageFX downloader - zh.py" search 关键词
 
     total_retries = 10
     backoff_factor = 1
     status_forcelist = (429, 500, 502, 503, 504)
     page_sleep_time = 1
+    page_size = 100
     max_keys = None
     max_threads = 10
+    stop_after_known = 12
 
     load_from_file_prompt = input("是否加载已保存的抓取结果并直接进入批量下载模式？  \n"
                                   "如果您是第一次运行那么应该选择no (yes/no，默认: no): ").lower()
@@ -96,8 +2590,7 @@ def main():
         media_keys_info = []
         if os.path.exists(crawl_result_file):
             try:
-                with open(crawl_result_file, 'r', encoding='utf-8') as f:
-                    media_keys_info = json.load(f)
+                media_keys_info = list(iter_crawl_result(crawl_result_file))
                 print(f"成功从文件 '{crawl_result_file}' 加载了 {len(media_keys_info)} 张图片链接。")
                 if media_keys_info:
                     cookie_string = input("请粘贴您的 Cookie 字符串 \n"
@@ -109,6 +2602,7 @@ def main():
                         print("Cookie 字符串不能为空，请重新运行程序并输入 Cookie。")
                         return
                     cookies = {'Cookie': cookie_string}
+                    auth_monitor = AuthMonitor(cookies, prompt=True) #  运行过程中 cookie 过期时请用户粘贴新的 cookie
                     print("")
                     print("********************")
                     print("")
@@ -122,21 +2616,29 @@ def main():
                     print("********************")
                     print("")
 
+                    done_media_keys = state_store.get_done_media_keys()
+                    if done_media_keys:
+                        resume_input = input(f"根据 '{state_db_file}'，已经下载过 {len(done_media_keys)} 张图片。是否只下载尚未完成或下载失败的图片 (断点续传)？ (yes/no，默认: yes): ").lower()
+                        if resume_input not in ['no', 'n']:
+                            media_keys_info = [item for item in media_keys_info if item.media_key not in done_media_keys]
+                            print(f"剩余 {len(media_keys_info)} 张图片待下载。")
+                        print("")
+                        print("********************")
+                        print("")
+
                     print("开始批量下载图片...")
-                    downloader = BatchDownloader(
-                        cookies, output_folder,
-                        total_retries=total_retries, backoff_factor=backoff_factor,
-                        status_forcelist=status_forcelist,
-                        max_threads=max_threads
-                    )
+                    downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+                    preview_size = ask_preview_size()
                     start_time = time.time()
-                    downloaded_count = downloader.download_media_keys(media_keys_info)
+                    downloaded_count = download_with_previews(downloader, media_keys_info, preview_size)
                     end_time = time.time()
                     duration = end_time - start_time
 
                     print(f"\n下载任务完成！")
                     print(f"共下载 {downloaded_count} 张图片，保存在 '{output_folder}' 文件夹中。")
                     print(f"总耗时: {duration:.2f} 秒")
+                    state_store.close()
+                    prompt_index.close()
                     return
 
                 else:
@@ -160,6 +2662,7 @@ def main():
         print("Cookie 字符串不能为空，请重新运行程序并输入 Cookie。")
         return
     cookies = {'Cookie': cookie_string}
+    auth_monitor = AuthMonitor(cookies, prompt=True) #  运行过程中 cookie 过期时请用户粘贴新的 cookie
     print("")
     print("********************")
     print("")
@@ -227,8 +2730,19 @@ def main():
                                   "   -  如果抓取速度过快导致错误，可以适当增加延时，例如设置为 '2' 或 '3'。\n"
                                   "   -  通常情况下，默认值 '1' 秒即可。\n"
                                   f"请输入页面请求延时(秒) (默认: {page_sleep_time}): ")
-    if page_sleep_time_input.isdigit():
-        page_sleep_time = int(page_sleep_time_input)
+    if page_sleep_time_input:
+        page_sleep_time = float(page_sleep_time_input)
+    print("")
+    print("********************")
+    print("")
+
+
+    page_size_input = input(f"请输入每页请求的图片链接数量 (默认: {page_size}) \n"
+                            "**作用:**  每页越大，抓取全部历史记录所需的请求越少，处理当前页的同时会请求下一页。\n"
+                            "**注意:**  如果服务器不接受该数量，会自动减半，直到被接受为止。\n"
+                            f"请输入每页图片链接数量 (默认: {page_size}): ")
+    if page_size_input.isdigit():
+        page_size = int(page_size_input)
     print("")
     print("********************")
     print("")
@@ -249,45 +2763,92 @@ def main():
     print("********************")
     print("")
 
+    streaming_mode_input = input("是否边抓取链接边下载图片 (流式模式)？ \n"
+                                 "**作用:**  抓取到第一页链接后立即开始下载，而不是等全部抓取完成，图片库较大时可以节省大量时间。\n"
+                                 "**注意:**  流式模式下开始下载前不会再询问确认。\n"
+                                 "是否使用流式模式？ (yes/no，默认: no): ").lower()
+    streaming_mode = streaming_mode_input in ['yes', 'y']
+    print("")
+    print("********************")
+    print("")
+
+    incremental_sync_input = input("是否只抓取上次运行之后生成的图片 (增量同步)？ \n"
+                                   f"**作用:**  将 '{state_db_file}' 中记录为下载完成的图片作为已知图片索引。历史记录按从新到旧返回，"
+                                   f"因此连续遇到 {stop_after_known} 张已知图片后就停止抓取，只下载新图片。\n"
+                                   "**设置建议:**\n"
+                                   "    - 第一次完整运行之后，定期备份时选择 'yes'。\n"
+                                   "    - 第一次运行或想要重新抓取全部图片时选择 'no'。\n"
+                                   "是否使用增量同步？ (yes/no，默认: no): ").lower()
+    incremental_sync = incremental_sync_input in ['yes', 'y']
+    known_media_keys = set()
+    if incremental_sync:
+        known_media_keys = state_store.get_done_media_keys()
+        print(f"从 '{state_db_file}' 加载了 {len(known_media_keys)} 张已下载的图片。")
+    print("")
+    print("********************")
+    print("")
+
+    resume_point = crawl_resume_point(crawl_result_file)
+    pending_checkpoint = None
+    if resume_point:
+        resume_crawl_input = input(f"上一次抓取在抓取了 {resume_point[1]} 个链接后提前停止。是否从最后保存的页面继续，而不是从头开始？"
+                                   "这之后新增的图片会由下一次增量同步获取。 (yes/no，默认: yes): ").lower()
+        if resume_crawl_input in ['no', 'n']:
+            pending_checkpoint = resume_point if incremental_sync else None #  链接会保留，因此之后仍可继续它
+            resume_point = None
+        print("")
+        print("********************")
+        print("")
+
     downloaded_count = 0
     start_time = time.time()
 
-    #  ---  以下代码块移除了关于 download_threshold 的判断，始终执行先抓后下模式  ---
-    print(f"\n---  将始终采用先抓取链接再批量下载模式  ---")
-
-    print("开始抓取图片链接和创建时间...")
     media_keys_crawler = MediaKeyCrawler(
         cookies, max_keys,
         total_retries=total_retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
-        page_sleep_time=page_sleep_time
+        page_sleep_time=page_sleep_time,
+        page_size=page_size,
+        known_media_keys=known_media_keys,
+        stop_after_known=stop_after_known,
+        resume_point=resume_point,
+        pending_checkpoint=pending_checkpoint,
+        auth_monitor=auth_monitor,
+        crawl_log=CrawlLog(crawl_result_file, append=incremental_sync or bool(resume_point)) #  逐页写入，抓取被中断时已抓取的链接也会保留
     )
-    media_keys_info = media_keys_crawler.get_all_media_keys_info()
+    if streaming_mode:
+        print(f"\n---  流式模式: 边抓取链接边下载图片  ---")
+        downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+        media_keys_crawler.rate_controller = downloader.rate_controller #  抓取同时进行，因此也要遵守限流
+
+        #  下载器边下载边从生成器中取链接，有界队列满时抓取会暂停
+        downloaded_count = downloader.download_media_keys(media_keys_crawler.iter_media_keys_info())
+        media_keys_crawler.crawl_log.close()
+        if not media_keys_crawler.crawl_log.written_count and known_media_keys:
+            print("自上次运行以来没有新图片。")
+        elif not media_keys_crawler.crawl_log.written_count:
+            print("链接抓取失败，请检查错误信息。未开始下载。")
+    else:
+        #  ---  以下代码块移除了关于 download_threshold 的判断，始终执行先抓后下模式  ---
+        print(f"\n---  将始终采用先抓取链接再批量下载模式  ---")
 
-    if media_keys_info:
-        try:
-            with open(crawl_result_file, 'w', encoding='utf-8') as f:
-                json.dump(media_keys_info, f, ensure_ascii=False, indent=4)
-            print(f"成功将抓取结果保存到文件 '{crawl_result_file}'。")
-        except Exception as e:
-            print(f"保存抓取结果到文件失败: {e}")
+        print("开始抓取图片链接和创建时间...")
+        media_keys_info = media_keys_crawler.get_all_media_keys_info()
+        media_keys_crawler.crawl_log.close()
 
         if media_keys_info:
             user_confirmation = input(f"链接抓取完成，共抓取到 {len(media_keys_info)} 张图片链接。是否开始下载图片？ (yes/no，默认: no): ")
             if user_confirmation.lower() in ['yes', 'y']:
                 print("开始批量下载图片...")
-                downloader = BatchDownloader(
-                    cookies, output_folder,
-                    total_retries=total_retries, backoff_factor=backoff_factor,
-                    status_forcelist=status_forcelist,
-                    max_threads=max_threads,
-                )
-                downloaded_count = downloader.download_media_keys(media_keys_info)
+                downloader = create_downloader(cookies, output_folder, total_retries, backoff_factor, status_forcelist, max_threads, state_store, auth_monitor, prompt_index)
+                downloaded_count = download_with_previews(downloader, media_keys_info, ask_preview_size())
             else:
                 print("用户取消下载。")
+        elif known_media_keys:
+            print("自上次运行以来没有新图片。")
         else:
             print("链接抓取失败，请检查错误信息。未开始下载。")
 
-    # ---  移除 else 分支，只保留先抓后下模式的代码结束  ---
+        # ---  移除 else 分支，只保留先抓后下模式的代码结束  ---
 
 
     end_time = time.time()
@@ -296,129 +2857,830 @@ def main():
     print(f"\n下载任务完成！")
     print(f"共下载 {downloaded_count} 张图片，保存在 '{output_folder}' 文件夹中。")
     print(f"总耗时: {duration:.2f} 秒")
+    state_store.close()
+    prompt_index.close()
 
 
 class MediaKeyCrawler:
-    def __init__(self, cookies, max_keys=None, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), page_sleep_time=1):
+    def __init__(self, cookies, max_keys=None, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), page_sleep_time=1,
+                 known_media_keys=None, stop_after_known=12, rate_controller=None, page_size=100, prefetch=True, crawl_log=None, resume_point=None,
+                 pending_checkpoint=None, auth_monitor=None):
         self.cookies = cookies
         self.max_keys = max_keys
         self.total_retries = total_retries
         self.backoff_factor = backoff_factor
         self.status_forcelist = status_forcelist
         self.page_sleep_time = page_sleep_time
+        self.known_media_keys = known_media_keys or set() #  已下载的 mediaKey 会被跳过，连续遇到 stop_after_known 个时结束抓取
+        self.stop_after_known = stop_after_known
+        self.rate_controller = rate_controller
+        self.page_size = page_size #  服务器不接受时自动减半，直到被接受为止
+        self.crawl_log = crawl_log #  可选的 CrawlLog，每页抓取后立即写入
+        self.resume_point = resume_point #  来自 crawl_resume_point() 的 (cursor, crawled_count, after)，用于继续被中断的抓取
+        self.pending_checkpoint = pending_checkpoint #  本次不继续的之前抓取的检查点，本次抓取在已知图片处停止时保留它
+        self.prefetch = prefetch #  在处理当前页的同时请求下一页
+        self.auth_monitor = auth_monitor #  可选的 AuthMonitor，加载新的 cookie 后重新请求该页
         self.session = requests.Session()
         retries = Retry(total=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist)
         self.session.mount("https://", HTTPAdapter(max_retries=retries))
 
     def get_all_media_keys_info(self):
         media_keys_info = []
-        media_keys_count = 0
-        next_page_token = ""
-        has_next_page = True
+        for page in self.iter_media_keys_pages():
+            media_keys_info.extend(page)
+        return media_keys_info
 
-        while has_next_page:
-            api_url = "https://labs.google/fx/api/trpc/media.fetchUserHistory"
-            params = {
-                "input": '{"json":{"cursor":"' + next_page_token + '","limit":12, "type":"IMAGE_FX"},"meta":{"values":{}}}'
-            }
+    def iter_media_keys_info(self):
+        for page in self.iter_media_keys_pages():
+            yield from page
+
+    def fetch_page(self, cursor, delay=0):
+        """
+        等待 delay 秒后请求一页 media.fetchUserHistory，返回响应，请求失败时返回 None
+        """
+        if delay:
+            time.sleep(delay)
+        if self.rate_controller:
+            self.rate_controller.wait_if_paused()
+        params = fetch_user_history_params(cursor, self.page_size)
+        while True:
+            cookie = self.cookies['Cookie']
             try:
-                response = self.session.get(api_url, params=params, cookies=self.cookies, timeout=30)
+                response = self.session.get(FETCH_USER_HISTORY_API_URL, params=params, cookies={'Cookie': cookie}, timeout=30)
+                if self.rate_controller: #  不报告延迟，因为与下载是不同的接口
+                    self.rate_controller.record_response(response.status_code, retry_after=parse_retry_after(response.headers.get('Retry-After')))
             except requests.exceptions.RequestException as e:
                 print(f"Error fetching media.fetchUserHistory in MediaKeyCrawler: {e}")
-                has_next_page = False
-                break
+                return None
+            if not (self.auth_monitor and is_auth_failure(response.status_code, response.url) and self.auth_monitor.report_rejected(cookie)):
+                return response
+            self.auth_monitor.wait_until_valid()
+
+    def report_interruption(self):
+        if self.crawl_log and (self.crawl_log.written_count or self.resume_point):
+            print(f"抓取提前停止，下次运行时会从 '{self.crawl_log.crawl_result_file}' 中最后保存的页面继续。")
+
+    def fetch_first_page(self):
+        """
+        请求第一页，服务器拒绝时把 page_size 减半 (limit 过大时 tRPC 会返回校验错误)，
+        这样之后的抓取都使用接口接受的最大页面大小
+        """
+        while True:
+            response = self.fetch_page(self.resume_point[0] if self.resume_point else "")
+            if response is None or response.status_code not in (400, 413, 422) or self.page_size <= MIN_PAGE_SIZE:
+                return response
+            page_size = max(MIN_PAGE_SIZE, self.page_size // 2)
+            print(f"服务器不接受页面大小 {self.page_size} (状态码 {response.status_code})，改为尝试 {page_size}。")
+            self.page_size = page_size
+
+    def iter_media_keys_pages(self):
+        """
+        按页产出抓取到的 mediaKey 信息的生成器，这样可以在抓取结束前就开始下载。
+        开启 prefetch 时，当前页解析完且未停止爬取就在后台请求下一页，这样页面延时和网络往返时间
+        与调用方处理当前页的时间重叠。
+        """
+        media_keys_count = self.resume_point[1] if self.resume_point else 0 #  检查点也计入被中断的抓取已抓取的链接
+        run_count = 0 #  max_keys 限制本次运行的链接数，下一次运行从停止的地方继续
+        known_run = 0
+        has_next_page = True
+        cursor, skip_until = (self.resume_point[0], self.resume_point[2]) if self.resume_point else ("", None)
+        if self.resume_point:
+            print(f"从 {media_keys_count} 个链接之后继续被中断的抓取。")
+
+        with ThreadPoolExecutor(max_workers=1) as prefetch_executor:
+            response = self.fetch_first_page()
+            while has_next_page:
+                if response is None:
+                    self.report_interruption()
+                    break
+                if response.status_code != 200 or is_auth_failure(response.status_code, response.url):
+                    print(f"获取 media.fetchUserHistory 失败，状态码: {response.status_code}")
+                    print(response.text)
+                    self.report_interruption()
+                    break
+
+                page = []
+                stop_checkpoint = None # (cursor, crawled_count, after) to continue from when this page stops the crawl early
+                try:
+                    response_json = response.json()
+                except ValueError as e: #  截断或不是 JSON 的响应 (例如错误页面) 与请求失败一样中断爬取
+                    print(f"解析 media.fetchUserHistory 响应失败: {e}")
+                    self.report_interruption()
+                    break
+                try:
+                    history_result = response_json['result']['data']['json']['result']
+                except (KeyError, TypeError):
+                    history_result = {}
+                next_page_token = history_result.get('nextPageToken', "")
 
-            if response.status_code == 200:
-                response_json = response.json()
-                if 'result' in response_json and 'data' in response_json['result'] and 'json' in response_json['result']['data'] and \
-                   'result' in response_json['result']['data']['json'] and 'userWorkflows' in response_json['result']['data']['json']['result']:
-                    user_workflows = response_json['result']['data']['json']['result']['userWorkflows']
+                if 'userWorkflows' in history_result:
+                    user_workflows = history_result['userWorkflows']
+
+                    if skip_until:
+                        page_media_keys = [workflow['name'] for workflow in user_workflows]
+                        if skip_until in page_media_keys: #  上一次运行因 max_keys 在该页的这个 mediaKey 之后停止
+                            user_workflows = user_workflows[page_media_keys.index(skip_until) + 1:]
+                        skip_until = None
 
                     if user_workflows:
-                        for workflow in user_workflows:
+                        for index, workflow in enumerate(user_workflows):
                             media_key = workflow['name']
                             create_time = workflow['createTime']
-                            media_keys_info.append({'media_key': media_key, 'create_time': create_time})
+                            if media_key in self.known_media_keys:
+                                known_run += 1
+                                if known_run >= self.stop_after_known:
+                                    has_next_page = False
+                                    stop_checkpoint = self.pending_checkpoint
+                                    print(f"连续遇到 {known_run} 张已下载过的图片，停止获取更多 mediaKey。")
+                                    break
+                                continue
+                            known_run = 0
+                            page.append(MediaKeyInfo(media_key, create_time))
                             media_keys_count += 1
+                            run_count += 1
 
-                            if self.max_keys and media_keys_count >= self.max_keys:
+                            if self.max_keys and run_count >= self.max_keys:
                                 has_next_page = False
+                                if index + 1 < len(user_workflows):
+                                    stop_checkpoint = (cursor, media_keys_count, media_key)
+                                elif next_page_token:
+                                    stop_checkpoint = (next_page_token, media_keys_count, None)
                                 print(f"已达到最大抓取链接数量 {self.max_keys}，停止获取更多 mediaKey。")
                                 break
                     else:
                         print("警告: 响应中 userWorkflows 为空，但包含 nextPageToken，继续尝试下一页。")
-                elif 'result' in response_json and 'data' in response_json['result'] and 'json' in response_json['result']['data'] and \
-                     'result' in response_json['result']['data']['json'] and 'nextPageToken' in response_json['result']['data']['json']['result']:
+                elif 'nextPageToken' in history_result:
                     print("警告: 响应中缺少 userWorkflows，但包含 nextPageToken，继续尝试下一页。")
                 else:
                     print("警告: 响应格式异常，可能缺少 userWorkflows 或 nextPageToken。")
                     has_next_page = False
 
+                next_response = None
+                if has_next_page and next_page_token and self.prefetch: #  只在这一页没有停止爬取时请求，已停止的爬取不应再请求下一页
+                    next_response = prefetch_executor.submit(self.fetch_page, next_page_token, self.page_sleep_time)
+
+                if self.crawl_log:
+                    if has_next_page:
+                        self.crawl_log.append_page(page, next_page_token, media_keys_count)
+                    else:
+                        self.crawl_log.append_page(page, *(stop_checkpoint or ("", media_keys_count)))
+                if page:
+                    yield page
+
                 if not has_next_page:
                     break
 
-                next_page_token = response_json['result']['data']['json']['result'].get('nextPageToken', "")
                 has_next_page = bool(next_page_token)
-                if has_next_page and (not self.max_keys or media_keys_count < self.max_keys):
+                if has_next_page:
                     print(f"已抓取 {media_keys_count} 张图片链接, 剩余页面: {has_next_page}")
-                    time.sleep(self.page_sleep_time)
-
-            else:
-                print(f"获取 media.fetchUserHistory 失败，状态码: {response.status_code}")
-                print(response.text)
-                has_next_page = False
-
-        return media_keys_info
+                    cursor = next_page_token
+                    response = next_response.result() if next_response else self.fetch_page(next_page_token, self.page_sleep_time)
 
 
 class BatchDownloader:
-    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_threads=10):
+    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_threads=10, state_store=None, skip_existing=False, streaming=True,
+                 rate_controller=None, writer_threads=2, fsync=False, dedup=False, image_size=None, metrics=None, shared_limiter=None,
+                 max_attempts=3, retry_delay=10, failed_keys_file=None, auth_monitor=None, batch_size=1, prompt_index=None, prompt_files=True,
+                 shard_size=None, shard_max_files=None, object_store=None, detect_format=False, convert_format=None, image_quality=90,
+                 thumbnail_size=None, post_processes=None):
         self.cookies = cookies
         self.output_folder = output_folder
         self.total_retries = total_retries
         self.backoff_factor = backoff_factor
         self.status_forcelist = status_forcelist
         self.max_threads = max_threads
-        self.active_threads_count = 0
-        self.threads = []
+        self.state_store = state_store
+        self.skip_existing = skip_existing
+        self.streaming = streaming #  逐块解码响应以降低内存占用
+        self.rate_controller = rate_controller #  可选的 AdaptiveRateController，此时 max_threads 为上限
+        self.writer_threads = writer_threads #  FileWriter 的写入线程数，这样磁盘 I/O 慢时不会拖住下载工作线程
+        self.fsync = fsync
+        self.dedup = dedup #  相同的图片使用硬链接，而不是再写入一次
+        self.image_size = image_size #  请求的图片尺寸 (height, width)，None 表示原图
+        self.shared_limiter = shared_limiter #  可选的 SharedLimiter，在自身的限制之后应用
+        self.max_attempts = max_attempts #  失败的图片排到队列末尾重试，见 RetryScheduler
+        self.retry_delay = retry_delay
+        self.failed_keys_file = failed_keys_file #  最终失败的图片的报告，None 表示不写报告
+        self.auth_monitor = auth_monitor #  可选的 AuthMonitor，cookie 过期期间暂停工作线程
+        self.batch_size = batch_size #  每个 tRPC 批量请求的图片数，从已排队的图片中取
+        self.prompt_index = prompt_index #  可选的 PromptIndex，FileWriter 把提示词写入其中
+        self.shard_size = shard_size #  每个 tar 分片的兆字节数，见 ArchiveShardWriter (与 shard_max_files 都为 None 时保存为单独的文件)
+        self.shard_max_files = shard_max_files
+        self.object_store = object_store #  可选的 S3ObjectStore，文件上传到其中而不是保存到 output_folder
+        self.detect_format = detect_format #  后处理选项，见 ImagePostProcessor
+        self.convert_format = convert_format
+        self.image_quality = image_quality
+        self.thumbnail_size = thumbnail_size
+        self.post_processes = post_processes
+        self.prompt_files = prompt_files #  同时把每条提示词保存为图片旁边的 .txt 文件
+        self.retry_scheduler = None
+        self.metrics = metrics or DownloadMetrics() #  与 download_with_previews 的预览阶段共用
         self.success_count = 0 #  BatchDownloader 内置成功计数器
+        self.failure_count = 0
+        self.lock = threading.Lock() #  保护 success_count，它会被所有工作线程更新
+        #  所有工作线程共享同一个长连接池，大小保证每个工作线程都能持有自己的连接
+        self.session = requests.Session()
+        retries = ControlledRetry(total=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                                  rate_controller=self.rate_controller, metrics=self.metrics)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.max_threads, max_retries=retries))
 
     def download_media_keys(self, media_keys_info):
-        downloaded_count = 0
-        for index, item in enumerate(media_keys_info): #  使用 enumerate 获取索引
-            media_key = item['media_key']
-            create_time = item['create_time']
-
-            while self.active_threads_count >= self.max_threads:
-                time.sleep(0.1)
-                self.threads = [t for t in self.threads if t.is_alive()]
-                self.active_threads_count = len(self.threads)
-
-            thread = threading.Thread(
-                target=download_image_and_prompt,
-                args=(media_key, self.cookies, self.output_folder, create_time),
-                kwargs={'on_thread_complete': lambda result, mk=media_key: self.update_thread_completion(result, mk)} # 修改: lambda 接收 result 和 media_key
-            )
-            self.threads.append(thread)
-            thread.start()
-            self.active_threads_count += 1
-
-        for thread in self.threads:
-            thread.join()
+        if self.skip_existing:
+            media_keys_info = skip_downloaded_media_keys(media_keys_info, self.output_folder, self.object_store,
+                                                         converted_extension(self.convert_format), bool(self.thumbnail_size))
+        if isinstance(media_keys_info, list):
+            self.metrics.add_total(len(media_keys_info)) #  流式抓取时未知，预计剩余时间此时按已排队的图片计算
+        #  固定数量的工作线程从有界队列中取任务，而不是每张图片启动一个线程
+        task_queue = queue.Queue(maxsize=self.max_threads * self.batch_size * 2)
+        self.retry_scheduler = RetryScheduler(self.max_attempts, self.retry_delay)
+        writer = FileWriter(self.writer_threads, fsync=self.fsync, dedup=self.dedup, prompt_index=self.prompt_index, prompt_files=self.prompt_files,
+                            shard_writer=build_shard_writer(self.output_folder, self.shard_size, self.shard_max_files, self.fsync),
+                            object_store=self.object_store,
+                            post_processor=build_post_processor(self.detect_format, self.convert_format, self.image_quality, self.thumbnail_size,
+                                                                self.post_processes))
+        if self.dedup and self.state_store:
+            writer.add_saved_images(self.state_store.get_saved_images(), self.output_folder)
+        writer.start()
+        self.metrics.set_gauge('download_queue_depth', task_queue.qsize)
+        self.metrics.set_gauge('writer_queue_depth', writer.queue.qsize)
+        if self.rate_controller:
+            self.metrics.set_gauge('concurrency_limit', lambda: round(self.rate_controller.limit, 2))
+        workers = []
+        for _ in range(self.max_threads):
+            worker = threading.Thread(target=self._worker, args=(task_queue, writer), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        for item in media_keys_info:
+            if self.state_store:
+                self.state_store.mark_pending(item)
+            self.metrics.record_queued()
+            self.retry_scheduler.start()
+            task_queue.put(item) #  队列满时阻塞等待，无需轮询
+            for retry_item in iter(self.retry_scheduler.pop_due, None):
+                task_queue.put(retry_item)
+        while True:
+            retry_item = self.retry_scheduler.wait_for_retry() #  只剩下重试，所有图片处理完毕后为 None
+            if retry_item is None:
+                break
+            task_queue.put(retry_item)
+        for _ in workers:
+            task_queue.put(None) #  每个工作线程一个结束信号
+
+        for worker in workers:
+            worker.join()
+        writer.close() #  等待仍在写入队列中的文件
+        print_deduplicated_count(writer)
+        if self.failed_keys_file:
+            write_failed_keys_report(self.failed_keys_file, self.retry_scheduler.failed_items,
+                                     self.retry_scheduler.succeeded_media_keys, self.state_store)
 
         #  下载完成后，打印最终成功下载总数
         print(f"\n批量下载完成，成功下载 {self.success_count} 张图片。") # 最终总结
         return self.success_count # 返回成功下载数量
 
-
-    def update_thread_completion(self, result, media_key): # 修改: 接收 result 和 media_key
-        self.active_threads_count -= 1
-        if result:
-            self.success_count += 1 #  成功时增加计数
-            if self.success_count % 10 == 0: #  每成功下载 10 张打印一次
-                print(f"已成功下载 {self.success_count} 张图片...") #  批量成功提示
+    def _worker(self, task_queue, writer):
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            items = [item]
+            while len(items) < self.batch_size: #  只取已排队的图片，从不等待凑满批量
+                try:
+                    item = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    task_queue.put(None) #  处理完这个批量后再次取到结束信号
+                    break
+                items.append(item)
+            if len(items) > 1:
+                items = self._download_batch(items, writer) #  剩下需要逐张下载的图片
+            for item in items:
+                self._download_one(item, writer)
+
+    def _download_one(self, item, writer):
+        media_key = item.media_key
+        if self.auth_monitor and not self.auth_monitor.wait_until_valid():
+            self.update_thread_completion(download_result(False, error="cookie expired", auth_failed=True), item)
+            return
+        if self.rate_controller:
+            self.rate_controller.acquire()
+        if self.shared_limiter:
+            self.shared_limiter.acquire()
+        cookies = dict(self.cookies) #  发送的 cookie，只有在此期间没有加载更新的 cookie 时才报告拒绝
+        try:
+            download_image_and_prompt(
+                media_key, cookies, self.output_folder, item.create_time,
+                total_retries=self.total_retries, backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                on_thread_complete=lambda result, item=item, cookie=cookies['Cookie']: self.update_thread_completion(result, item, cookie),
+                session=self.session, streaming=self.streaming, rate_controller=self.rate_controller, writer=writer,
+                image_size=self.image_size
+            )
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                self.rate_controller.release()
+
+    def _download_batch(self, items, writer):
+        if self.auth_monitor and not self.auth_monitor.wait_until_valid():
+            return items #  由 _download_one 逐张跳过
+        if self.rate_controller:
+            self.rate_controller.acquire()
+        if self.shared_limiter:
+            self.shared_limiter.acquire()
+        cookies = dict(self.cookies)
+        try:
+            fallback_items = download_media_batch(
+                items, cookies, self.output_folder,
+                on_item_complete=lambda item, result: self.update_thread_completion(result, item, cookies['Cookie']),
+                session=self.session, rate_controller=self.rate_controller, writer=writer, image_size=self.image_size
+            )
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                self.rate_controller.release()
+        if fallback_items is None:
+            with self.lock:
+                if self.batch_size > 1:
+                    self.batch_size = 1
+                    print("服务器不接受 tRPC 批量请求，改为每个请求下载一张图片。")
+            fallback_items = items
+        return fallback_items
+
+    def update_thread_completion(self, result, item, cookie=None): # 接收下载的 result、MediaKeyInfo 和 cookie
+        media_key = item.media_key
+        if self.state_store:
+            self.state_store.record_result(media_key, result)
+        if result['auth_failed'] and self.auth_monitor:
+            if self.auth_monitor.report_rejected(cookie):
+                self.metrics.record_retry('auth')
+                self.retry_scheduler.requeue(item) #  加载新的 cookie 后重新下载
+                return
+            if not self.auth_monitor.gave_up:
+                result['auth_failed'] = False #  cookie 仍然有效，只有这张图片被拒绝，像其他失败的图片一样重试
+        if not result['success'] and not result['auth_failed']: #  用被拒绝的 cookie 重试还会失败
+            delay = self.retry_scheduler.schedule_retry(item)
+            if delay is not None:
+                self.metrics.record_retry('deferred')
+                print(f"  -> 图片 {media_key}.jpg 下载失败 ({result['error']})，{delay:g} 秒后重试。")
+                return
+        self.metrics.record_result(result)
+        if self.shared_limiter and result['success']:
+            self.shared_limiter.record_bytes(result['byte_size'])
+        if result['success']:
+            with self.lock:
+                self.success_count += 1 #  成功时增加计数
+                success_count = self.success_count
+            if success_count % 10 == 0 and not self.metrics.show_progress_bar: #  每成功下载 10 张打印一次
+                print(f"已成功下载 {success_count} 张图片...") #  批量成功提示
         else:
+            with self.lock:
+                self.failure_count += 1
             print(f"  -> 图片 {media_key}.jpg 下载失败.") #  失败时打印具体 media_key
+        self.retry_scheduler.finish(item, result) #  放在最后，这样投递方看到下载结束时计数已经完整
+
+
+class AsyncBatchDownloader:
+    """
+    在单个 asyncio 事件循环上下载图片 (需要 aiohttp)，用信号量限制同时进行中的请求数量。
+    JSON 解析和 base64 解码交给线程池执行，文件由 FileWriter 的写入线程保存，都不会阻塞事件循环。
+    """
+    def __init__(self, cookies, output_folder, total_retries=10, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), max_concurrency=100, executor_workers=None, state_store=None, skip_existing=False, streaming=True,
+                 rate_controller=None, writer_threads=2, fsync=False, dedup=False, image_size=None, metrics=None, shared_limiter=None,
+                 max_attempts=3, retry_delay=10, failed_keys_file=None, auth_monitor=None, prompt_index=None, prompt_files=True,
+                 shard_size=None, shard_max_files=None, object_store=None, detect_format=False, convert_format=None, image_quality=90,
+                 thumbnail_size=None, post_processes=None):
+        if aiohttp is None:
+            raise RuntimeError("asyncio 下载引擎需要 aiohttp，请先安装: pip install aiohttp")
+        self.cookies = cookies
+        self.output_folder = output_folder
+        self.total_retries = total_retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.max_concurrency = max_concurrency
+        self.executor_workers = executor_workers
+        self.state_store = state_store
+        self.skip_existing = skip_existing
+        self.streaming = streaming
+        self.rate_controller = rate_controller
+        self.rate_condition = None
+        self.writer_threads = writer_threads
+        self.fsync = fsync
+        self.dedup = dedup
+        self.image_size = image_size
+        self.shared_limiter = shared_limiter
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.failed_keys_file = failed_keys_file
+        self.auth_monitor = auth_monitor
+        self.prompt_index = prompt_index
+        self.prompt_files = prompt_files
+        self.shard_size = shard_size
+        self.shard_max_files = shard_max_files
+        self.object_store = object_store
+        self.detect_format = detect_format
+        self.convert_format = convert_format
+        self.image_quality = image_quality
+        self.thumbnail_size = thumbnail_size
+        self.post_processes = post_processes
+        self.retry_scheduler = None
+        self.metrics = metrics or DownloadMetrics()
+        self.writer = None
+        self.success_count = 0
+        self.failure_count = 0
+
+    def download_media_keys(self, media_keys_info):
+        if self.skip_existing:
+            media_keys_info = skip_downloaded_media_keys(media_keys_info, self.output_folder, self.object_store,
+                                                         converted_extension(self.convert_format), bool(self.thumbnail_size))
+        if isinstance(media_keys_info, list):
+            self.metrics.add_total(len(media_keys_info))
+        asyncio.run(self._download_all(media_keys_info))
+        print(f"\n批量下载完成，成功下载 {self.success_count} 张图片。")
+        return self.success_count
+
+    async def _download_all(self, media_keys_info):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.rate_condition = asyncio.Condition()
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency) #  长连接在请求之间复用
+        timeout = aiohttp.ClientTimeout(total=30)
+        tasks = set()
+        self.retry_scheduler = RetryScheduler(self.max_attempts, self.retry_delay)
+        self.writer = FileWriter(self.writer_threads, fsync=self.fsync, dedup=self.dedup, prompt_index=self.prompt_index,
+                                 prompt_files=self.prompt_files,
+                                 shard_writer=build_shard_writer(self.output_folder, self.shard_size, self.shard_max_files, self.fsync),
+                                 object_store=self.object_store,
+                                 post_processor=build_post_processor(self.detect_format, self.convert_format, self.image_quality,
+                                                                     self.thumbnail_size, self.post_processes))
+        if self.dedup and self.state_store:
+            self.writer.add_saved_images(self.state_store.get_saved_images(), self.output_folder)
+        self.writer.start()
+        self.metrics.set_gauge('requests_in_flight', lambda: len(tasks))
+        self.metrics.set_gauge('writer_queue_depth', self.writer.queue.qsize)
+        if self.rate_controller:
+            self.metrics.set_gauge('concurrency_limit', lambda: round(self.rate_controller.limit, 2))
+        with ThreadPoolExecutor(max_workers=self.executor_workers) as executor:
+            #  cookie 随每个请求发送，这样重新加载的 cookie 会立即生效
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                loop = asyncio.get_running_loop()
+                media_keys_iter = iter(media_keys_info)
+                input_finished = False
+                while True:
+                    item = self.retry_scheduler.pop_due()
+                    if item is None and not input_finished:
+                        #  流式抓取获取下一页时 next() 可能阻塞，因此放到事件循环之外执行
+                        item = await loop.run_in_executor(None, next, media_keys_iter, None)
+                        if item is None:
+                            input_finished = True
+                        else:
+                            if self.state_store:
+                                self.state_store.mark_pending(item)
+                            self.metrics.record_queued()
+                            self.retry_scheduler.start()
+                    while item is None and input_finished and not self.retry_scheduler.is_finished():
+                        #  只剩下重试，可能还会失败的下载在这个事件循环中完成
+                        await asyncio.sleep(min(0.1, self.retry_scheduler.seconds_until_due() or 0.1))
+                        item = self.retry_scheduler.pop_due()
+                    if item is None:
+                        break
+                    if self.auth_monitor and self.auth_monitor.is_paused():
+                        await loop.run_in_executor(None, self.auth_monitor.wait_until_valid) #  cookie 过期期间不发起新的请求
+                    if self.auth_monitor and self.auth_monitor.gave_up:
+                        self._record_result(item, download_result(False, error="cookie expired", auth_failed=True))
+                        continue
+                    await semaphore.acquire() #  进行中的请求达到 max_concurrency 时在此等待
+                    if self.rate_controller:
+                        await self._acquire_rate_slot()
+                    if self.shared_limiter:
+                        await self._acquire_shared_slot()
+                    task = asyncio.create_task(self._download_one(session, executor, item))
+                    task.add_done_callback(lambda _: semaphore.release())
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.close)
+        print_deduplicated_count(self.writer)
+        if self.failed_keys_file:
+            write_failed_keys_report(self.failed_keys_file, self.retry_scheduler.failed_items,
+                                     self.retry_scheduler.succeeded_media_keys, self.state_store)
+
+    async def _acquire_rate_slot(self):
+        async with self.rate_condition:
+            while not self.rate_controller.try_acquire():
+                try:
+                    #  有请求完成或 Retry-After 暂停结束时被唤醒
+                    await asyncio.wait_for(self.rate_condition.wait(), timeout=self.rate_controller.pause_remaining() or None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _acquire_shared_slot(self):
+        #  其他账号在别的线程中释放名额，所以这里轮询而不是等待条件变量
+        while not self.shared_limiter.try_acquire():
+            await asyncio.sleep(max(0.01, self.shared_limiter.wait_time()))
+
+    async def _release_rate_slot(self):
+        self.rate_controller.release()
+        async with self.rate_condition:
+            self.rate_condition.notify_all()
+
+    async def _download_one(self, session, executor, item):
+        try:
+            await self._download_one_with_retries(session, executor, item)
+        finally:
+            if self.shared_limiter:
+                self.shared_limiter.release()
+            if self.rate_controller:
+                await self._release_rate_slot()
+
+    async def _download_one_with_retries(self, session, executor, item):
+        media_key = item.media_key
+        result = download_result(False)
+        http_seconds = None
+        cookie = None
+        retry_after = None #  上一个被重试的响应的 Retry-After，至少等待这么久，与 urllib3 Retry 相同
+        for attempt in range(self.total_retries + 1):
+            if attempt:
+                delay = self.backoff_factor * (2 ** (attempt - 1)) #  与 urllib3 Retry 相同的退避公式
+                if self.rate_controller:
+                    delay = max(delay, self.rate_controller.pause_remaining())
+                await asyncio.sleep(max(delay, retry_after or 0))
+                retry_after = None
+            request_start_time = time.monotonic()
+            cookie = self.cookies['Cookie']
+            try:
+                async with session.get(FETCH_MEDIA_API_URL, params=fetch_media_params(media_key, *(self.image_size or ())), headers={'Cookie': cookie}) as response:
+                    http_seconds = time.monotonic() - request_start_time
+                    response_retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if self.rate_controller:
+                        self.rate_controller.record_response(response.status, http_seconds, response_retry_after)
+                    if is_auth_failure(response.status, response.url):
+                        result = download_result(False, error=f"authentication failed: HTTP {response.status}", auth_failed=True)
+                        break
+                    if response.status in self.status_forcelist and attempt < self.total_retries:
+                        if response.status in Retry.RETRY_AFTER_STATUS_CODES:
+                            retry_after = response_retry_after
+                        self.metrics.record_retry(response.status)
+                        continue
+                    status = response.status
+                    if status == 200 and self.streaming:
+                        result = await self._stream_and_save(executor, response, item)
+                        break
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt < self.total_retries:
+                    self.metrics.record_retry(type(e).__name__)
+                    continue
+                print(f"  -> 下载 media.fetchMedia 请求失败 (mediaKey: {media_key}): {e}")
+                result = download_result(False, error=f"request failed: {e!r}")
+                break
+
+            if status == 200:
+                loop = asyncio.get_running_loop()
+                saved, on_complete = self._saved_future(loop)
+                await loop.run_in_executor(executor, self._parse_and_save, media_key, item.create_time, body, on_complete)
+                result = await saved
+            else:
+                print(f"  -> 下载 media.fetchMedia 失败，状态码: {status}")
+                print(body.decode('utf-8', errors='replace'))
+                result = download_result(False, error=f"HTTP {status}")
+            break
+
+        if http_seconds is not None:
+            result['timings']['http'] = http_seconds #  最后一次尝试的耗时，不含退避等待
+        requeue = False
+        if result['auth_failed'] and self.auth_monitor: #  report_rejected() 用阻塞的请求确认拒绝，因此在事件循环之外运行
+            requeue = await asyncio.get_running_loop().run_in_executor(None, self.auth_monitor.report_rejected, cookie)
+        self._record_result(item, result, requeue)
+
+    def _record_result(self, item, result, requeue=False):
+        media_key = item.media_key
+        if self.state_store:
+            self.state_store.record_result(media_key, result)
+        if requeue:
+            self.metrics.record_retry('auth')
+            self.retry_scheduler.requeue(item)
+            return
+        if result['auth_failed'] and self.auth_monitor and not self.auth_monitor.gave_up:
+            result['auth_failed'] = False #  cookie 仍然有效，只有这张图片被拒绝
+        if not result['success'] and not result['auth_failed']:
+            delay = self.retry_scheduler.schedule_retry(item)
+            if delay is not None:
+                self.metrics.record_retry('deferred')
+                print(f"  -> 图片 {media_key}.jpg 下载失败 ({result['error']})，{delay:g} 秒后重试。")
+                return
+        self.metrics.record_result(result)
+        if self.shared_limiter and result['success']:
+            self.shared_limiter.record_bytes(result['byte_size'])
+        if result['success']:
+            self.success_count += 1 #  只在事件循环线程中修改，无需加锁
+            if self.success_count % 10 == 0 and not self.metrics.show_progress_bar:
+                print(f"已成功下载 {self.success_count} 张图片...")
+        else:
+            self.failure_count += 1
+            print(f"  -> 图片 {media_key}.jpg 下载失败.")
+        self.retry_scheduler.finish(item, result)
+
+    async def _stream_and_save(self, executor, response, item):
+        #  解码和写入逐块在线程池中执行，按顺序等待以保证分块的先后顺序
+        media_key = item.media_key
+        loop = asyncio.get_running_loop()
+        decoder = None
+        try:
+            image_filename, prompt_filename = await loop.run_in_executor(executor, media_file_paths, media_key, self.output_folder, item.create_time, self.writer)
+            decoder = await loop.run_in_executor(executor, MediaStreamDecoder, image_filename, self.writer.stream_temp_folder)
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await loop.run_in_executor(executor, decoder.feed, chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if decoder:
+                decoder.abort()
+            raise #  由 _download_one 重试
+        except Exception as e:
+            if decoder:
+                decoder.abort()
+            print(f"  -> 保存图片/提示词 {media_key} 失败: {e}")
+            return download_result(False, error=f"save failed: {e}")
+        saved, on_complete = self._saved_future(loop)
+        await loop.run_in_executor(executor, finish_media_stream, media_key, decoder, prompt_filename, self.writer, on_complete,
+                                   item.create_time)
+        return await saved
+
+    def _saved_future(self, loop):
+        #  写入器在自己的线程中报告结果，因此以线程安全的方式交回事件循环
+        saved = loop.create_future()
+        return saved, lambda result: loop.call_soon_threadsafe(saved.set_result, result)
+
+    def _parse_and_save(self, media_key, create_time, body, on_complete):
+        try:
+            response_json = json.loads(body)
+        except ValueError as e:
+            print(f"  -> 解析 media.fetchMedia 响应失败 {media_key}: {e!r}")
+            on_complete(download_result(False, error=f"invalid response: {e!r}"))
+            return
+        save_media_response(media_key, response_json, self.output_folder, create_time, self.writer, on_complete)
+
+
+class DownloadStateStore:
+    """
+    在本地 SQLite 数据库中记录每个 mediaKey 的下载状态 (状态 pending/done/failed、字节数、哈希、尝试次数和最后一次错误)，
+    这样中断的运行可以断点续传，而不需要重新下载全部图片。
+    """
+    def __init__(self, db_file="download_state.db"):
+        self.lock = threading.Lock() #  数据库连接由所有下载线程共享
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL") #  WAL 模式下提交时无需等待 fsync
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "media_key TEXT PRIMARY KEY, create_time TEXT, status TEXT NOT NULL DEFAULT 'pending', "
+                "byte_size INTEGER, sha256 TEXT, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, updated_at TEXT, extension TEXT)"
+            )
+            if 'extension' not in {row[1] for row in self.connection.execute("PRAGMA table_info(downloads)")}: #  旧版本的数据库
+                self.connection.execute("ALTER TABLE downloads ADD COLUMN extension TEXT")
+
+    def mark_pending(self, item):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO downloads (media_key, create_time, status, updated_at) VALUES (?, ?, 'pending', ?) "
+                "ON CONFLICT(media_key) DO UPDATE SET create_time = excluded.create_time, status = 'pending', updated_at = excluded.updated_at",
+                (item.media_key, item.create_time, datetime.now().isoformat())
+            )
+
+    def record_result(self, media_key, result):
+        with self.lock, self.connection:
+            if result['success']:
+                self.connection.execute(
+                    "UPDATE downloads SET status = 'done', byte_size = ?, sha256 = ?, extension = ?, attempts = attempts + 1, last_error = NULL, "
+                    "updated_at = ? WHERE media_key = ?",
+                    (result['byte_size'], result['sha256'], result.get('extension'), datetime.now().isoformat(), media_key)
+                )
+            else:
+                self.connection.execute(
+                    "UPDATE downloads SET status = 'failed', attempts = attempts + 1, last_error = ?, updated_at = ? WHERE media_key = ?",
+                    (result['error'], datetime.now().isoformat(), media_key)
+                )
+
+    def get_done_media_keys(self, extension=None):
+        """
+        传入 extension 时只返回以该扩展名保存的图片 (旧版本的记录算作 .jpg，它们只保存这一种扩展名)
+        """
+        with self.lock:
+            if extension:
+                rows = self.connection.execute(
+                    "SELECT media_key FROM downloads WHERE status = 'done' AND COALESCE(extension, '.jpg') = ?", (extension,)
+                )
+            else:
+                rows = self.connection.execute("SELECT media_key FROM downloads WHERE status = 'done'")
+            return {row[0] for row in rows}
+
+    def get_unfinished_media_keys_info(self):
+        """
+        返回已加入队列但尚未下载完成 (pending 或 failed) 的图片的 MediaKeyInfo 记录，按从新到旧排列
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT media_key, create_time FROM downloads WHERE status != 'done' ORDER BY create_time DESC"
+            ).fetchall()
+        return [MediaKeyInfo(media_key, create_time) for media_key, create_time in rows]
+
+    def get_saved_images(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT media_key, create_time, sha256, extension FROM downloads WHERE status = 'done' AND sha256 IS NOT NULL"
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class PromptIndex:
+    """
+    把已保存图片的提示词 (mediaKey、创建时间、图片路径、字节数和提示词) 保存在一个本地 SQLite 数据库中，并建立 FTS5 全文索引，
+    而不是每张图片一个小 .txt 文件。trigram 分词器能找到提示词的任意片段，适用于任何语言 (包括词之间没有空格的中文)；
+    没有 FTS5 时搜索会逐条扫描提示词。
+    """
+    def __init__(self, db_file="prompt_index.db"):
+        self.lock = threading.Lock() #  所有写入线程共用同一个连接
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                "id INTEGER PRIMARY KEY, media_key TEXT NOT NULL UNIQUE, create_time TEXT, image_path TEXT NOT NULL, byte_size INTEGER, prompt TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS prompts_create_time ON prompts (create_time)")
+            try:
+                self.connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(prompt, content='prompts', content_rowid='id', tokenize='trigram')"
+                )
+                self.full_text = True
+            except sqlite3.OperationalError: #  SQLite 早于 3.34 或编译时未包含 FTS5
+                self.full_text = False
+            if self.full_text: #  触发器让索引与 prompts 表保持一致
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_insert AFTER INSERT ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (rowid, prompt) VALUES (new.id, new.prompt); END"
+                )
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_delete AFTER DELETE ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END"
+                )
+                self.connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS prompts_update AFTER UPDATE ON prompts BEGIN "
+                    "INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); "
+                    "INSERT INTO prompts_fts (rowid, prompt) VALUES (new.id, new.prompt); END"
+                )
+
+    def add_prompts(self, rows):
+        """
+        在一个事务中添加或替换 (media_key, create_time, image_path, byte_size, prompt) 行
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO prompts (media_key, create_time, image_path, byte_size, prompt) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(media_key) DO UPDATE SET create_time = COALESCE(excluded.create_time, create_time), "
+                "image_path = excluded.image_path, byte_size = excluded.byte_size, prompt = excluded.prompt",
+                rows
+            )
+
+    def get_media_keys(self):
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT media_key FROM prompts")}
+
+    def search(self, query, max_results=100):
+        """
+        返回提示词包含 query 中每个词 (不区分大小写) 的图片，最新的在前，每张图片是一个含 media_key、create_time、image_path、
+        byte_size 和 prompt 键的 dict。3 个及以上字符的词在全文索引中查找，较短的词 (trigram 索引无法查找) 在这些结果中用 LIKE 匹配。
+        """
+        words = query.split()
+        full_text_words = [word for word in words if len(word) >= 3] if self.full_text else []
+        conditions = []
+        parameters = []
+        if full_text_words:
+            conditions.append("id IN (SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH ?)")
+            parameters.append(" ".join('"' + word.replace('"', '""') + '"' for word in full_text_words)) #  加引号，这样词不会被当作查询语法
+        for word in words:
+            if word not in full_text_words:
+                conditions.append("prompt LIKE ? ESCAPE '\\'")
+                parameters.append("%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        sql = "SELECT media_key, create_time, image_path, byte_size, prompt FROM prompts"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY create_time DESC LIMIT ?"
+        parameters.append(max_results if max_results else -1)
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [dict(zip(('media_key', 'create_time', 'image_path', 'byte_size', 'prompt'), row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
 
 
 if __name__ == "__main__":
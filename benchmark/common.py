@@ -0,0 +1,26 @@
+"""
+Shared helpers of the benchmark scripts: loading the downloader script as a module and pointing it at the mock server
+"""
+import importlib.util
+import os
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_downloader(base_url, language="en"):
+    """
+    Imports "ImageFX downloader - <language>.py" as a module, with its API URLs pointed at base_url (e.g. the mock server)
+    """
+    path = os.path.join(REPO_ROOT, f"ImageFX downloader - {language}.py")
+    spec = importlib.util.spec_from_file_location(f"imagefx_downloader_{language}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.FETCH_MEDIA_API_URL = base_url + "/fx/api/trpc/media.fetchMedia"
+    module.FETCH_USER_HISTORY_API_URL = base_url + "/fx/api/trpc/media.fetchUserHistory"
+    return module
+
+
+def use_plain_http(session):
+    # The script only mounts its retrying adapter for https://, the mock server speaks plain http
+    session.mount("http://", session.get_adapter("https://"))
@@ -0,0 +1,57 @@
+"""
+Measures how fast MediaKeyCrawler pages through media.fetchUserHistory, against the local mock server.
+Compares the old behaviour (12 links per page, no prefetch) with the default (largest accepted page size, prefetch).
+
+    python benchmark/crawl_benchmark.py --images 5000 --latency 0.05 --page-sleep 0.1 --consume-time 0.02
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from common import load_downloader, use_plain_http
+from mock_server import start_mock_server
+
+
+def run_crawl(downloader, server, page_size, prefetch, page_sleep_time, consume_time):
+    crawler = downloader.MediaKeyCrawler({'Cookie': 'mock'}, page_sleep_time=page_sleep_time, page_size=page_size, prefetch=prefetch)
+    use_plain_http(crawler.session)
+    server.reset_stats()
+    links = 0
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # The crawler prints a line per page
+        for page in crawler.iter_media_keys_pages():
+            links += len(page)
+            time.sleep(consume_time) # Stands in for the caller handing the page to the downloader
+    duration = time.perf_counter() - start_time
+    pages = server.request_counts.get("media.fetchUserHistory", 0)
+    return {'page_size': crawler.page_size, 'prefetch': prefetch, 'pages': pages, 'links': links, 'seconds': duration,
+            'pages_per_second': pages / duration, 'links_per_second': links / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MediaKeyCrawler benchmark against the local mock server")
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--max-page-size", type=int, default=100, help="largest page size the mock accepts")
+    parser.add_argument("--page-size", type=int, default=100, help="page size requested by the new crawler")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the mock adds to every response")
+    parser.add_argument("--page-sleep", type=float, default=0.1, help="page_sleep_time of the crawler")
+    parser.add_argument("--consume-time", type=float, default=0.02, help="seconds the caller spends on each page")
+    parser.add_argument("--language", default="en", choices=["en", "zh"])
+    args = parser.parse_args()
+
+    server = start_mock_server(images=args.images, max_page_size=args.max_page_size, latency=args.latency)
+    downloader = load_downloader(server.base_url, args.language)
+    print(f"{args.images} images, latency {args.latency}s, page sleep {args.page_sleep}s, caller {args.consume_time}s per page")
+    print(f"{'configuration':<28}{'page size':>10}{'requests':>10}{'links':>8}{'seconds':>10}{'pages/s':>10}{'links/s':>10}")
+    for name, page_size, prefetch in (("before (12, serial)", downloader.MIN_PAGE_SIZE, False),
+                                      ("page size only", args.page_size, False),
+                                      ("page size + prefetch", args.page_size, True)):
+        result = run_crawl(downloader, server, page_size, prefetch, args.page_sleep, args.consume_time)
+        print(f"{name:<28}{result['page_size']:>10}{result['pages']:>10}{result['links']:>8}{result['seconds']:>10.2f}"
+              f"{result['pages_per_second']:>10.1f}{result['links_per_second']:>10.1f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
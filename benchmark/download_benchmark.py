@@ -0,0 +1,157 @@
+"""
+End-to-end download throughput benchmark against the local mock server. Every download engine and concurrency level
+runs in its own subprocess, so peak RSS and CPU time are measured per configuration. Reports images/s, MB/s (decoded
+image bytes), p50/p99 of the fetchMedia request time seen by the server and of the time from queueing an image to
+having it saved, peak RSS and CPU seconds.
+
+    python benchmark/download_benchmark.py --images 300 --image-bytes 1500000 --latency 0.2 --jitter 0.1 --concurrency 4 16 64
+
+--batch-size N adds runs of the threads engine that fetch N images per tRPC batch request.
+"""
+import argparse
+import contextlib
+import io
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource # Not available on Windows, peak RSS and CPU time are then not reported
+except ImportError:
+    resource = None
+
+from common import load_downloader, use_plain_http
+from mock_server import start_mock_server
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LatencyRecorder:
+    """
+    Stands in for DownloadStateStore and records the time from queueing each image (mark_pending) to its result
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued_times = {}
+        self.latencies = []
+        self.byte_size = 0
+
+    def mark_pending(self, item):
+        with self.lock:
+            self.queued_times[item.media_key] = time.perf_counter()
+
+    def record_result(self, media_key, result):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - self.queued_times.pop(media_key))
+            if result['success']:
+                self.byte_size += result['byte_size']
+
+
+def run_worker(args):
+    """
+    Runs one configuration in this process and prints its measurements as a JSON line
+    """
+    downloader_module = load_downloader(args.base_url, args.language)
+    output_folder = tempfile.mkdtemp(prefix="imagefx_benchmark_")
+    recorder = LatencyRecorder()
+    with contextlib.redirect_stdout(io.StringIO()): # The downloader prints progress and a summary
+        crawler = downloader_module.MediaKeyCrawler({'Cookie': 'mock'}, page_sleep_time=0, page_size=args.page_size)
+        use_plain_http(crawler.session)
+        media_keys_info = crawler.get_all_media_keys_info()
+        options = dict(total_retries=args.retries, backoff_factor=args.backoff_factor, state_store=recorder,
+                       streaming=not args.no_streaming, writer_threads=args.writer_threads)
+        if args.engine == "async":
+            downloader = downloader_module.AsyncBatchDownloader({'Cookie': 'mock'}, output_folder, max_concurrency=args.concurrency, **options)
+        else:
+            downloader = downloader_module.BatchDownloader({'Cookie': 'mock'}, output_folder, max_threads=args.concurrency,
+                                                           batch_size=args.batch_size, **options)
+            use_plain_http(downloader.session)
+        cpu_start = time.process_time()
+        start_time = time.perf_counter()
+        downloaded_count = downloader.download_media_keys(media_keys_info)
+        duration = time.perf_counter() - start_time
+        cpu_seconds = time.process_time() - cpu_start
+    shutil.rmtree(output_folder, ignore_errors=True)
+    print(json.dumps({
+        'images': downloaded_count,
+        'seconds': duration,
+        'bytes': recorder.byte_size,
+        'image_p50': percentile(recorder.latencies, 0.5),
+        'image_p99': percentile(recorder.latencies, 0.99),
+        'cpu_seconds': cpu_seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None, # ru_maxrss is in KiB on Linux
+    }))
+
+
+def format_value(value, pattern):
+    return "n/a" if value is None else format(value, pattern)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download throughput benchmark against the local mock server")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--image-bytes", type=int, default=1000000, help="decoded size of every mock image")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the mock adds to every response")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many random seconds on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests the mock answers with 429")
+    parser.add_argument("--engines", nargs="+", default=["threads", "async"], choices=["threads", "async"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[4, 16, 64], help="max_threads / max_concurrency values to compare")
+    parser.add_argument("--writer-threads", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=1, help="also run the threads engine with tRPC batch requests of this many images")
+    parser.add_argument("--no-streaming", action="store_true", help="load every response into memory instead of streaming it")
+    parser.add_argument("--retries", type=int, default=10)
+    parser.add_argument("--backoff-factor", type=float, default=0.1)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--language", default="en", choices=["en", "zh"])
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--engine", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        args.concurrency = args.concurrency[0]
+        run_worker(args)
+        return
+
+    server = start_mock_server(images=args.images, latency=args.latency, jitter=args.jitter, image_bytes=args.image_bytes,
+                               error_rate=args.error_rate)
+    print(f"{args.images} images of {args.image_bytes / 1e6:.1f} MB, latency {args.latency}s + up to {args.jitter}s jitter, "
+          f"{args.error_rate:.0%} 429 responses")
+    print(f"{'engine':<9}{'conc.':>6}{'images':>8}{'requests':>10}{'images/s':>10}{'MB/s':>8}{'req p50':>9}{'req p99':>9}"
+          f"{'img p50':>9}{'img p99':>9}{'RSS MB':>8}{'CPU s':>7}")
+    configurations = [(engine, 1) for engine in args.engines]
+    if args.batch_size > 1:
+        configurations.append(("threads", args.batch_size))
+    for engine, batch_size in configurations:
+        label = engine if batch_size == 1 else f"batch{batch_size}"
+        for concurrency in args.concurrency:
+            server.reset_stats()
+            command = [sys.executable, __file__, "--worker", "--engine", engine, "--concurrency", str(concurrency), "--base-url", server.base_url,
+                       "--writer-threads", str(args.writer_threads), "--retries", str(args.retries), "--backoff-factor", str(args.backoff_factor),
+                       "--page-size", str(args.page_size), "--language", args.language, "--batch-size", str(batch_size)] + \
+                      (["--no-streaming"] if args.no_streaming else [])
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"{label:<9}{concurrency:>6}  failed:\n{completed.stderr}")
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            request_latencies = server.latencies.get("media.fetchMedia", [])
+            print(f"{label:<9}{concurrency:>6}{result['images']:>8}{server.request_counts.get('media.fetchMedia', 0):>10}"
+                  f"{result['images'] / result['seconds']:>10.1f}"
+                  f"{result['bytes'] / 1e6 / result['seconds']:>8.1f}"
+                  f"{format_value(percentile(request_latencies, 0.5), '.3f'):>9}{format_value(percentile(request_latencies, 0.99), '.3f'):>9}"
+                  f"{format_value(result['image_p50'], '.3f'):>9}{format_value(result['image_p99'], '.3f'):>9}"
+                  f"{format_value(result['peak_rss_mb'], '.0f'):>8}{result['cpu_seconds']:>7.1f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
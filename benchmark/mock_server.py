@@ -0,0 +1,186 @@
+"""
+Local stand-in for the ImageFX tRPC endpoints used by the downloader, so crawling and downloading can be measured
+without a Google account.
+
+    python benchmark/mock_server.py --port 8765 --images 5000 --image-bytes 1500000 --latency 0.05 --jitter 0.05 --error-rate 0.02
+
+Then point the script at http://127.0.0.1:8765 (see common.load_downloader).
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class MockImageFXServer(ThreadingHTTPServer):
+    """
+    Serves media.fetchUserHistory from a generated history of images, newest first like the real endpoint, and
+    media.fetchMedia with a random image of image_bytes bytes (the same one for every mediaKey).
+    A limit above max_page_size is rejected with a tRPC validation error. Every response is delayed by latency seconds
+    plus a random jitter of up to jitter seconds, and a share of error_rate of the requests is answered with 429 and
+    a Retry-After of retry_after seconds. With session_requests, every Cookie header is accepted for that many requests
+    and then answered with 401, like an expired session, until the client sends a new cookie. tRPC batch requests of
+    media.fetchMedia (?batch=1, one procedure per call in the path) are answered with an array of results, or rejected with
+    400 without batching. The time spent on every request is recorded per endpoint in latencies.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, images=1000, max_page_size=100, latency=0.0, jitter=0.0, image_bytes=1000000, error_rate=0.0, retry_after=1,
+                 session_requests=None, batching=True):
+        super().__init__(address, MockImageFXRequestHandler)
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.session_requests = session_requests
+        self.cookie_uses = {}
+        self.batching = batching
+        self.encoded_image = base64.b64encode(b"\xff\xd8\xff\xe0" + os.urandom(max(0, image_bytes - 4))).decode('ascii')
+        newest_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.media_keys_info = [
+            {'name': f"mock{images - 1 - i:08d}", 'createTime': (newest_time - timedelta(hours=6 * i)).isoformat().replace("+00:00", "Z")}
+            for i in range(images)
+        ]
+        self.request_counts = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def count_request(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def session_expired(self, cookie):
+        if not self.session_requests:
+            return False
+        with self.lock:
+            self.cookie_uses[cookie] = self.cookie_uses.get(cookie, 0) + 1
+            return self.cookie_uses[cookie] > self.session_requests
+
+    def record_latency(self, endpoint, seconds):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+
+    def reset_stats(self):
+        with self.lock:
+            self.request_counts = {}
+            self.latencies = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class MockImageFXRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        url = urlparse(self.path)
+        procedures = url.path.rsplit("/", 1)[-1].split(",")
+        endpoint = ",".join(sorted(set(procedures))) # A batch of fetchMedia calls is counted as one fetchMedia request
+        self.server.count_request(endpoint)
+        query = parse_qs(url.query)
+        batch = query.get('batch') == ['1']
+        try:
+            inputs = json.loads(query['input'][0])
+            input_jsons = [inputs[str(index)]['json'] for index in range(len(procedures))] if batch else [inputs['json']]
+        except (KeyError, IndexError, ValueError, TypeError):
+            self.send_json(400, trpc_error("BAD_REQUEST", "Invalid input"))
+            return
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.server.session_expired(self.headers.get("Cookie", "")):
+            self.send_json(401, trpc_error("UNAUTHORIZED", "Unauthorized"))
+        elif self.server.error_rate and random.random() < self.server.error_rate:
+            self.send_json(429, trpc_error("TOO_MANY_REQUESTS", "Too many requests"), {"Retry-After": str(self.server.retry_after)})
+        elif batch and not (self.server.batching and endpoint == "media.fetchMedia"):
+            self.send_json(400, trpc_error("BAD_REQUEST", "Batching is not enabled"))
+        elif endpoint == "media.fetchUserHistory":
+            self.fetch_user_history(input_jsons[0])
+        elif endpoint == "media.fetchMedia":
+            media_responses = [self.media_response(input_json) for input_json in input_jsons]
+            self.send_json(200, ("[" + ",".join(media_responses) + "]" if batch else media_responses[0]).encode('utf-8'))
+        else:
+            self.send_json(404, trpc_error("NOT_FOUND", f"No procedure found on path \"{endpoint}\""))
+        self.server.record_latency(endpoint, time.perf_counter() - start_time)
+
+    def fetch_user_history(self, input_json):
+        limit = input_json.get('limit', 12)
+        if limit > self.server.max_page_size:
+            self.send_json(400, trpc_error("BAD_REQUEST", f"Number must be less than or equal to {self.server.max_page_size}"))
+            return
+        start = int(input_json.get('cursor') or 0)
+        end = min(start + limit, len(self.server.media_keys_info))
+        result = {'userWorkflows': self.server.media_keys_info[start:end]}
+        if end < len(self.server.media_keys_info):
+            result['nextPageToken'] = str(end)
+        self.send_json(200, {'result': {'data': {'json': {'result': result}}}})
+
+    def media_response(self, input_json):
+        media_key = input_json.get('mediaKey', "")
+        # The image is spliced in as a string, running json.dumps over megabytes of base64 per request would slow the mock down
+        image_json = json.dumps({'mediaKey': media_key, 'prompt': f"A mock prompt for {media_key}", 'encodedImage': ""})
+        image_json = image_json[:-3] + '"' + self.server.encoded_image + '"}'
+        return '{"result":{"data":{"json":{"result":{"image":' + image_json + '}}}}}'
+
+    def send_json(self, status, body, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def trpc_error(code, message):
+    return {'error': {'json': {'message': message, 'code': -32600, 'data': {'code': code}}}}
+
+
+def start_mock_server(port=0, **options):
+    """
+    Starts a MockImageFXServer on 127.0.0.1 in a background thread and returns it, port=0 picks a free port
+    """
+    server = MockImageFXServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the ImageFX tRPC endpoints")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--images", type=int, default=1000, help="number of images in the mock history")
+    parser.add_argument("--max-page-size", type=int, default=100, help="largest fetchUserHistory limit that is accepted")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many random seconds added on top of the latency")
+    parser.add_argument("--image-bytes", type=int, default=1000000, help="size of the decoded image returned by fetchMedia")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with the 429 responses")
+    parser.add_argument("--no-batching", action="store_true", help="reject tRPC batch requests like a server without batching")
+    parser.add_argument("--session-requests", type=int, help="requests accepted per cookie before it is answered with 401 (default: no limit)")
+    args = parser.parse_args()
+    server = MockImageFXServer(("127.0.0.1", args.port), images=args.images, max_page_size=args.max_page_size, latency=args.latency,
+                               jitter=args.jitter, image_bytes=args.image_bytes, error_rate=args.error_rate, retry_after=args.retry_after,
+                               session_requests=args.session_requests, batching=not args.no_batching)
+    print(f"Mock ImageFX server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
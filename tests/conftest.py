@@ -0,0 +1,27 @@
+"""
+Loads the downloader scripts as modules for the tests, every test runs against the English and the Chinese script
+"""
+import importlib.util
+import os
+
+import pytest
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LANGUAGES = ("en", "zh")
+_modules = {}
+
+
+def load_downloader(language):
+    if language not in _modules:
+        path = os.path.join(REPO_ROOT, f"ImageFX downloader - {language}.py")
+        spec = importlib.util.spec_from_file_location(f"imagefx_downloader_{language}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[language] = module
+    return _modules[language]
+
+
+@pytest.fixture(params=LANGUAGES)
+def imagefx(request):
+    return load_downloader(request.param)
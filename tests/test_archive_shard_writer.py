@@ -0,0 +1,82 @@
+import os
+import tarfile
+
+
+CREATE_TIME = "2024-05-01T10:00:00Z"
+
+
+def image_bytes(number, size=700):
+    return bytes([number % 256]) * size # Not a multiple of the tar block size, so the padding is exercised
+
+
+def shard_files(folder):
+    return sorted(name for name in os.listdir(folder) if name.endswith(".tar"))
+
+
+def test_offsets_of_the_index_point_at_the_members(imagefx, tmp_path):
+    writer = imagefx.ArchiveShardWriter(str(tmp_path))
+    temp_filename = tmp_path / "streamed.part"
+    temp_filename.write_bytes(image_bytes(2, 1500))
+    first_path = writer.add("key1", CREATE_TIME, "a red fox", image_data=image_bytes(1), sha256="abc", thumbnail_data=b"thumb")
+    writer.add("key2", CREATE_TIME, "ein Fuchs ä", temp_filename=str(temp_filename), extension=".png")
+    writer.add("key3", CREATE_TIME, None, image_data=image_bytes(3))
+    writer.close()
+
+    shard_filename = str(tmp_path / "imagefx-00001.tar")
+    assert first_path.startswith(shard_filename)
+    assert imagefx.read_shard_image(shard_filename, "key1") == (image_bytes(1), "a red fox")
+    assert imagefx.read_shard_image(shard_filename, "key2") == (image_bytes(2, 1500), "ein Fuchs ä")
+    assert imagefx.read_shard_image(shard_filename, "key3") == (image_bytes(3), None)
+    assert imagefx.read_shard_image(shard_filename, "missing") is None
+
+    index = imagefx.read_shard_index(shard_filename)
+    assert index['key1']['sha256'] == "abc"
+    assert index['key2']['name'].endswith("/key2.png")
+    with open(shard_filename, 'rb') as f:
+        f.seek(index['key1']['thumbnail_offset'])
+        assert f.read(index['key1']['thumbnail_size']) == b"thumb"
+    with tarfile.open(shard_filename) as tar: # Still a valid tar file that other tools can list
+        names = tar.getnames()
+    assert index['key1']['name'] in names and index['key3']['name'] in names
+
+
+def test_rolls_over_after_max_files(imagefx, tmp_path):
+    writer = imagefx.ArchiveShardWriter(str(tmp_path), max_files=2)
+    for number in range(5):
+        writer.add(f"key{number}", CREATE_TIME, image_data=image_bytes(number))
+    writer.close()
+    assert shard_files(tmp_path) == ["imagefx-00001.tar", "imagefx-00002.tar", "imagefx-00003.tar"]
+    assert sorted(imagefx.read_shard_index(str(tmp_path / "imagefx-00003.tar"))) == ["key4"]
+    assert imagefx.read_shard_image(str(tmp_path / "imagefx-00002.tar"), "key3") == (image_bytes(3), None)
+
+
+def test_rolls_over_after_max_bytes(imagefx, tmp_path):
+    writer = imagefx.ArchiveShardWriter(str(tmp_path), max_bytes=3000)
+    for number in range(6):
+        writer.add(f"key{number}", CREATE_TIME, image_data=image_bytes(number, 1000))
+    writer.close()
+    shards = shard_files(tmp_path)
+    assert len(shards) > 1
+    found = {}
+    for shard in shards:
+        for media_key in imagefx.read_shard_index(str(tmp_path / shard)):
+            found[media_key] = imagefx.read_shard_image(str(tmp_path / shard), media_key)[0]
+    assert found == {f"key{number}": image_bytes(number, 1000) for number in range(6)}
+
+
+def test_every_run_starts_a_new_shard(imagefx, tmp_path):
+    for run in range(2):
+        writer = imagefx.ArchiveShardWriter(str(tmp_path))
+        writer.add(f"key{run}", CREATE_TIME, image_data=image_bytes(run))
+        writer.close()
+    assert shard_files(tmp_path) == ["imagefx-00001.tar", "imagefx-00002.tar"]
+
+
+def test_index_lists_only_flushed_members(imagefx, tmp_path):
+    writer = imagefx.ArchiveShardWriter(str(tmp_path))
+    writer.add("key1", CREATE_TIME, image_data=image_bytes(1))
+    shard_filename = str(tmp_path / "imagefx-00001.tar")
+    assert imagefx.read_shard_index(shard_filename) == {}
+    writer.flush()
+    assert list(imagefx.read_shard_index(shard_filename)) == ["key1"]
+    writer.close()
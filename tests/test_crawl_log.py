@@ -0,0 +1,107 @@
+import json
+
+
+def items(imagefx, *media_keys):
+    return [imagefx.MediaKeyInfo(media_key, f"2024-05-0{index + 1}T00:00:00Z") for index, media_key in enumerate(media_keys)]
+
+
+def crawled_keys(imagefx, crawl_result_file):
+    return [item.media_key for item in imagefx.iter_crawl_result(str(crawl_result_file))]
+
+
+def test_pages_and_checkpoints_are_written_as_json_lines(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a", "b"), "cursor1", 2)
+    crawl_log.append_page(items(imagefx, "c"), "cursor2", 3)
+    crawl_log.close()
+    lines = [json.loads(line) for line in crawl_result_file.read_text(encoding='utf-8').splitlines()]
+    assert lines[2] == {'cursor': "cursor1", 'crawled': 2}
+    assert crawled_keys(imagefx, crawl_result_file) == ["a", "b", "c"]
+    assert crawl_log.written_count == 3
+
+
+def test_resume_point_is_the_last_checkpoint(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a", "b"), "cursor1", 2)
+    crawl_log.append_page(items(imagefx, "c", "d"), "cursor2", 4)
+    crawl_log.close()
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) == ("cursor2", 4, None)
+
+
+def test_ended_crawl_has_no_resume_point(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a"), "cursor1", 1)
+    crawl_log.append_page(items(imagefx, "b"), "", 2)
+    crawl_log.close()
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) is None
+    assert imagefx.crawl_resume_point(str(tmp_path / "missing.json")) is None
+
+
+def test_page_cut_short_resumes_after_its_last_key(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a", "b"), "", 2, "b") # max_keys stopped the crawl inside the first page
+    crawl_log.close()
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) == ("", 2, "b")
+
+
+def test_incomplete_last_line_is_ignored_and_cut_off(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a"), "cursor1", 1)
+    crawl_log.close()
+    with open(crawl_result_file, 'a', encoding='utf-8') as f:
+        f.write('{"media_key":"b","crea') # The crawl was killed while writing
+    assert crawled_keys(imagefx, crawl_result_file) == ["a"]
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) == ("cursor1", 1, None)
+
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file))
+    crawl_log.append_page(items(imagefx, "c"), "cursor2", 2)
+    crawl_log.close()
+    assert crawled_keys(imagefx, crawl_result_file) == ["a", "c"]
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) == ("cursor2", 2, None)
+
+
+def test_legacy_json_array_is_read_and_converted(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_result_file.write_text(json.dumps([{'media_key': "old1", 'create_time': "t1"}, {'media_key': "old2"}]), encoding='utf-8')
+    assert crawled_keys(imagefx, crawl_result_file) == ["old1", "old2"]
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) is None
+
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file))
+    crawl_log.append_page(items(imagefx, "new1"), "cursor1", 1)
+    crawl_log.close()
+    assert not crawl_result_file.read_text(encoding='utf-8').startswith("[")
+    assert crawled_keys(imagefx, crawl_result_file) == ["old1", "old2", "new1"]
+    assert [item.create_time for item in imagefx.iter_crawl_result(str(crawl_result_file))][:2] == ["t1", None]
+
+
+def test_replacing_log_keeps_the_old_file_until_the_first_page(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a"), "", 1)
+    crawl_log.close()
+
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    assert crawled_keys(imagefx, crawl_result_file) == ["a"]
+    crawl_log.append_page(items(imagefx, "b"), "", 1)
+    crawl_log.close()
+    assert crawled_keys(imagefx, crawl_result_file) == ["b"]
+
+
+def test_logged_media_keys_are_not_written_again(imagefx, tmp_path):
+    crawl_result_file = tmp_path / "crawl.json"
+    crawl_log = imagefx.CrawlLog(str(crawl_result_file), append=False)
+    crawl_log.append_page(items(imagefx, "a", "b"), "cursor1", 2)
+    crawl_log.append_page(items(imagefx, "b", "c"), "", 3) # The history shifted between two pages
+    crawl_log.close()
+    for _ in range(3): # Incremental syncs crawl the pending and failed images again
+        crawl_log = imagefx.CrawlLog(str(crawl_result_file))
+        crawl_log.append_page(items(imagefx, "new", "a", "c"), "", 1)
+        crawl_log.close()
+    assert crawled_keys(imagefx, crawl_result_file) == ["a", "b", "c", "new"]
+    assert crawl_log.written_count == 0
+    assert imagefx.crawl_resume_point(str(crawl_result_file)) is None
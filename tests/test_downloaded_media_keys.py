@@ -0,0 +1,61 @@
+CREATE_TIME = "2024-05-01T10:00:00Z"
+
+
+def save_files(folder, *names):
+    for name in names:
+        path = folder / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"image")
+
+
+def test_every_saved_image_counts_without_post_processing(imagefx, tmp_path):
+    save_files(tmp_path, "2024-05-01/a.jpg", "2024-05-01/b.webp", "c.png", "2024-05-01/thumbnails/b.webp", "2024-05-01/d.jpg.1a2b.part")
+    assert imagefx.index_downloaded_media_keys(str(tmp_path)) == {"a", "b", "c"}
+
+
+def test_only_converted_images_count_with_convert_format(imagefx, tmp_path):
+    save_files(tmp_path, "2024-05-01/a.jpg", "2024-05-01/b.webp", "c.webp")
+    extension = imagefx.converted_extension("webp")
+    assert imagefx.index_downloaded_media_keys(str(tmp_path), extension) == {"b", "c"}
+    items = [imagefx.MediaKeyInfo(media_key, CREATE_TIME) for media_key in ("a", "b", "c", "d")]
+    remaining = imagefx.skip_downloaded_media_keys(items, str(tmp_path), extension=extension)
+    assert [item.media_key for item in remaining] == ["a", "d"] # a was saved before --convert-format was used
+
+
+def test_only_images_with_a_thumbnail_count_with_thumbnail_size(imagefx, tmp_path):
+    save_files(tmp_path, "2024-05-01/a.jpg", "2024-05-01/b.jpg", "2024-05-01/thumbnails/b.jpg", "c.jpg", "thumbnails/c.jpg", "d.jpg")
+    assert imagefx.index_downloaded_media_keys(str(tmp_path), thumbnails=True) == {"b", "c"}
+
+
+def test_shard_members_are_filtered_the_same_way(imagefx, tmp_path):
+    writer = imagefx.ArchiveShardWriter(str(tmp_path))
+    writer.add("a", CREATE_TIME, image_data=b"image")
+    writer.add("b", CREATE_TIME, image_data=b"image", extension=".webp")
+    writer.add("c", CREATE_TIME, image_data=b"image", extension=".webp", thumbnail_data=b"thumb")
+    writer.close()
+    assert imagefx.index_downloaded_media_keys(str(tmp_path)) == {"a", "b", "c"}
+    assert imagefx.index_downloaded_media_keys(str(tmp_path), ".webp") == {"b", "c"}
+    assert imagefx.index_downloaded_media_keys(str(tmp_path), ".webp", thumbnails=True) == {"c"}
+
+
+def test_state_store_knows_the_extension_of_the_done_images(imagefx, tmp_path):
+    state_store = imagefx.DownloadStateStore(str(tmp_path / "state.db"))
+    for media_key, extension in (("old", None), ("jpg", ".jpg"), ("webp", ".webp")):
+        state_store.mark_pending(imagefx.MediaKeyInfo(media_key, CREATE_TIME))
+        result = imagefx.download_result(True, byte_size=1, sha256=media_key)
+        result['extension'] = extension
+        state_store.record_result(media_key, result)
+    state_store.mark_pending(imagefx.MediaKeyInfo("pending", CREATE_TIME))
+    assert state_store.get_done_media_keys() == {"old", "jpg", "webp"}
+    assert state_store.get_done_media_keys(".jpg") == {"old", "jpg"} # Older versions saved every image as .jpg
+    assert state_store.get_done_media_keys(".webp") == {"webp"}
+    state_store.close()
+
+
+def test_writer_reports_the_extension_of_every_sink(imagefx, tmp_path):
+    results = []
+    writer = imagefx.FileWriter(writer_threads=0, shard_writer=imagefx.ArchiveShardWriter(str(tmp_path)))
+    writer.submit("a", str(tmp_path / "a.png"), str(tmp_path / "a.txt"), "a red fox", imagefx.download_result(True, byte_size=5),
+                  results.append, image_data=b"image", create_time=CREATE_TIME)
+    writer.close()
+    assert [result['extension'] for result in results] == [".png"]
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import threading
+
+
+def write_concurrently(imagefx, writer, folder, payloads, rounds=30):
+    """
+    Submits the same mediaKey from one thread per payload at the same time, returns the download results
+    """
+    results = []
+    barrier = threading.Barrier(len(payloads))
+    image_filename, prompt_filename = str(folder / "key.jpg"), str(folder / "key.txt")
+
+    def submit(payload):
+        for _ in range(rounds):
+            barrier.wait()
+            result = imagefx.download_result(True, byte_size=len(payload), sha256=hashlib.sha256(payload).hexdigest())
+            writer.submit("key", image_filename, prompt_filename, "a red fox", result, results.append, image_data=payload)
+
+    threads = [threading.Thread(target=submit, args=(payload,)) for payload in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    return results
+
+
+def test_same_key_written_from_two_threads_at_once(imagefx, tmp_path):
+    payloads = [b"a" * 200_000, b"b" * 200_000]
+    results = write_concurrently(imagefx, imagefx.FileWriter(writer_threads=0), tmp_path, payloads)
+    assert [result for result in results if not result['success']] == []
+    assert (tmp_path / "key.jpg").read_bytes() in payloads # Whole, never a mix of both or a half written file
+    assert (tmp_path / "key.txt").read_text(encoding='utf-8') == "a red fox"
+    assert sorted(os.listdir(tmp_path)) == ["key.jpg", "key.txt"] # No temporary file is left behind
+
+
+def test_same_key_with_dedup_links(imagefx, tmp_path):
+    payload = b"c" * 50_000
+    writer = imagefx.FileWriter(writer_threads=0, dedup=True)
+    writer.add_saved_images([("original", None, hashlib.sha256(payload).hexdigest(), ".jpg")], str(tmp_path))
+    (tmp_path / "original.jpg").write_bytes(payload)
+    results = write_concurrently(imagefx, writer, tmp_path, [payload, payload])
+    assert all(result['success'] for result in results)
+    assert (tmp_path / "key.jpg").read_bytes() == payload
+    assert sorted(os.listdir(tmp_path)) == ["key.jpg", "key.txt", "original.jpg"]
+
+
+def test_writer_threads_save_the_image_and_prompt(imagefx, tmp_path):
+    writer = imagefx.FileWriter(writer_threads=2, fsync=True)
+    writer.start()
+    results = []
+    for number in range(10):
+        payload = bytes([number]) * 1000
+        result = imagefx.download_result(True, byte_size=len(payload), sha256=hashlib.sha256(payload).hexdigest())
+        writer.submit(f"key{number}", str(tmp_path / f"key{number}.jpg"), str(tmp_path / f"key{number}.txt"), f"prompt {number}",
+                      result, results.append, image_data=payload)
+    writer.close()
+    assert len(results) == 10 and all(result['success'] for result in results)
+    assert (tmp_path / "key7.jpg").read_bytes() == bytes([7]) * 1000
+    assert (tmp_path / "key7.txt").read_text(encoding='utf-8') == "prompt 7"
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+def test_dedup_finds_images_saved_with_another_extension(imagefx, tmp_path):
+    payload, other_payload = b"d" * 1000, b"e" * 1000
+    state_store = imagefx.DownloadStateStore(str(tmp_path / "state.db"))
+    for media_key, data in (("converted", payload), ("legacy", other_payload)):
+        state_store.mark_pending(imagefx.MediaKeyInfo(media_key, "2024-05-01T10:00:00Z"))
+        result = imagefx.download_result(True, byte_size=len(data), sha256=hashlib.sha256(data).hexdigest())
+        result['extension'] = ".webp" if media_key == "converted" else None # Rows of older versions have no extension
+        state_store.record_result(media_key, result)
+    (tmp_path / "2024-05-01").mkdir()
+    (tmp_path / "2024-05-01" / "converted.webp").write_bytes(payload)
+    (tmp_path / "2024-05-01" / "legacy.png").write_bytes(other_payload)
+
+    writer = imagefx.FileWriter(writer_threads=0, dedup=True)
+    writer.add_saved_images(state_store.get_saved_images(), str(tmp_path))
+    state_store.close()
+    results = []
+    for media_key, data in (("new", payload), ("other", other_payload)):
+        result = imagefx.download_result(True, byte_size=len(data), sha256=hashlib.sha256(data).hexdigest())
+        writer.submit(media_key, str(tmp_path / f"{media_key}.webp"), str(tmp_path / f"{media_key}.txt"), "a red fox", result, results.append, image_data=data)
+    writer.close()
+    assert [result['extension'] for result in results] == [".webp", ".webp"]
+    assert writer.deduplicated_count == 2
+    assert os.path.samefile(tmp_path / "new.webp", tmp_path / "2024-05-01" / "converted.webp")
+    assert os.path.samefile(tmp_path / "other.webp", tmp_path / "2024-05-01" / "legacy.png")
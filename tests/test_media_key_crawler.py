@@ -0,0 +1,61 @@
+import json
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.url = "https://labs.google/fx/api/trpc/media.fetchUserHistory"
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def history_page(media_keys, next_page_token=""):
+    workflows = [{'name': media_key, 'createTime': "2024-05-01T00:00:00Z"} for media_key in media_keys]
+    return FakeResponse({'result': {'data': {'json': {'result': {'userWorkflows': workflows, 'nextPageToken': next_page_token}}}}})
+
+
+def crawler_with_pages(imagefx, pages, **options):
+    """
+    Creates a MediaKeyCrawler whose requests are answered from pages (cursor -> response), returns it and the requested cursors
+    """
+    crawler = imagefx.MediaKeyCrawler({'Cookie': "test"}, page_sleep_time=0, **options)
+    requested = []
+
+    def fetch_page(cursor, delay=0):
+        requested.append(cursor)
+        return pages[cursor]
+
+    crawler.fetch_page = fetch_page
+    return crawler, requested
+
+
+def test_pages_are_crawled_until_the_last_one(imagefx):
+    pages = {"": history_page(["a", "b"], "p2"), "p2": history_page(["c"])}
+    crawler, requested = crawler_with_pages(imagefx, pages)
+    assert [item.media_key for item in crawler.iter_media_keys_info()] == ["a", "b", "c"]
+    assert requested == ["", "p2"]
+
+
+def test_body_that_is_not_json_interrupts_the_crawl(imagefx, tmp_path):
+    crawl_log = imagefx.CrawlLog(str(tmp_path / "crawl.json"), append=False)
+    pages = {"": history_page(["a"], "p2"), "p2": FakeResponse("<html>Service Unavailable</html>")}
+    crawler, _ = crawler_with_pages(imagefx, pages, crawl_log=crawl_log)
+    assert [item.media_key for item in crawler.iter_media_keys_info()] == ["a"]
+    crawl_log.close()
+    assert imagefx.crawl_resume_point(str(tmp_path / "crawl.json")) == ("p2", 1, None) # The checkpoint is kept for the next run
+
+
+def test_no_page_is_prefetched_after_max_keys(imagefx):
+    pages = {"": history_page(["a", "b"], "p2"), "p2": history_page(["c"], "p3")}
+    crawler, requested = crawler_with_pages(imagefx, pages, max_keys=2)
+    assert [item.media_key for item in crawler.iter_media_keys_info()] == ["a", "b"]
+    assert requested == [""]
+
+
+def test_no_page_is_prefetched_after_a_run_of_known_images(imagefx):
+    pages = {"": history_page(["a", "b", "c"], "p2"), "p2": history_page(["d"])}
+    crawler, requested = crawler_with_pages(imagefx, pages, known_media_keys={"b", "c"}, stop_after_known=2)
+    assert [item.media_key for item in crawler.iter_media_keys_info()] == ["a"]
+    assert requested == [""]
@@ -0,0 +1,82 @@
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+
+IMAGE_DATA = bytes(range(256)) * 40 # Its base64 contains "+" and "/"
+
+
+def media_response_body(image_data=IMAGE_DATA, escape_slashes=True):
+    body = json.dumps({'result': {'data': {'json': {'result': {
+        'image': {'prompt': "a red fox", 'encodedImage': base64.b64encode(image_data).decode('ascii')}}}}}})
+    return body.replace("/", "\\/").encode('utf-8') if escape_slashes else body.encode('utf-8')
+
+
+def decode_in_chunks(imagefx, image_filename, body, chunk_size, temp_folder=None):
+    decoder = imagefx.MediaStreamDecoder(image_filename, temp_folder)
+    for start in range(0, len(body), chunk_size):
+        decoder.feed(body[start:start + chunk_size])
+    return decoder, decoder.finish()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 1000, 1 << 20])
+def test_decodes_the_image_at_any_chunk_boundary(imagefx, tmp_path, chunk_size):
+    decoder, response_json = decode_in_chunks(imagefx, str(tmp_path / "key.jpg"), media_response_body(), chunk_size)
+    with open(decoder.temp_filename, 'rb') as f:
+        assert f.read() == IMAGE_DATA
+    assert decoder.byte_size == len(IMAGE_DATA)
+    image = response_json['result']['data']['json']['result']['image']
+    assert image == {'prompt': "a red fox", 'encodedImage': ""}
+
+
+@pytest.mark.parametrize("escape_slashes", [True, False])
+def test_hashes_the_decoded_bytes(imagefx, tmp_path, escape_slashes):
+    decoder, _ = decode_in_chunks(imagefx, str(tmp_path / "key.jpg"), media_response_body(escape_slashes=escape_slashes), 13)
+    assert decoder.sha256.hexdigest() == hashlib.sha256(IMAGE_DATA).hexdigest()
+
+
+def test_unpadded_base64_is_completed(imagefx, tmp_path):
+    body = media_response_body(b"abcde").replace(b"=", b"")
+    decoder, _ = decode_in_chunks(imagefx, str(tmp_path / "key.jpg"), body, 4)
+    with open(decoder.temp_filename, 'rb') as f:
+        assert f.read() == b"abcde"
+
+
+def test_missing_encoded_image_decodes_nothing(imagefx, tmp_path):
+    body = json.dumps({'result': {'data': {'json': {'result': {'image': {'prompt': "p"}}}}}}).encode('utf-8')
+    decoder, response_json = decode_in_chunks(imagefx, str(tmp_path / "key.jpg"), body, 7)
+    assert decoder.byte_size == 0
+    assert response_json['result']['data']['json']['result']['image'] == {'prompt': "p"}
+
+
+def test_abort_removes_the_temp_file(imagefx, tmp_path):
+    decoder = imagefx.MediaStreamDecoder(str(tmp_path / "key.jpg"))
+    decoder.feed(media_response_body()[:100])
+    decoder.abort()
+    assert os.listdir(tmp_path) == []
+
+
+def test_temp_folder_holds_the_temp_file(imagefx, tmp_path):
+    image_folder, temp_folder = tmp_path / "images", tmp_path / "temp"
+    temp_folder.mkdir()
+    decoder, _ = decode_in_chunks(imagefx, str(image_folder / "key.jpg"), media_response_body(), 64, str(temp_folder))
+    assert os.path.dirname(decoder.temp_filename) == str(temp_folder)
+    assert not image_folder.exists()
+
+
+def test_concurrent_streams_of_one_image_use_their_own_temp_files(imagefx, tmp_path):
+    image_filename = str(tmp_path / "key.jpg")
+    decoders = [imagefx.MediaStreamDecoder(image_filename) for _ in range(2)]
+    assert decoders[0].temp_filename != decoders[1].temp_filename
+    assert all(os.path.dirname(decoder.temp_filename) == str(tmp_path) for decoder in decoders)
+    bodies = [media_response_body(b"first" * 1000), media_response_body(b"second" * 1000)]
+    for start in range(0, max(map(len, bodies)), 100): # Interleaved, as two download threads would feed them
+        for decoder, body in zip(decoders, bodies):
+            decoder.feed(body[start:start + 100])
+    for decoder, expected in zip(decoders, [b"first" * 1000, b"second" * 1000]):
+        decoder.finish()
+        with open(decoder.temp_filename, 'rb') as f:
+            assert f.read() == expected
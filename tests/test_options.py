@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+
+def write_config(tmp_path, **options):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(options), encoding='utf-8')
+    return str(config_file)
+
+
+def parse_args(imagefx, *argv):
+    return vars(imagefx.build_argument_parser().parse_intermixed_args(["sync", *argv]))
+
+
+def test_defaults_without_any_source(imagefx):
+    options = imagefx.load_options({}, environ={})
+    assert options['max_threads'] == imagefx.DEFAULT_OPTIONS['max_threads']
+    assert options['incremental'] is True
+
+
+def test_command_line_beats_environment_beats_config_file(imagefx, tmp_path):
+    config_file = write_config(tmp_path, **{'max-threads': 2, 'page_size': 50, 'retry_delay': 5, 'incremental': False})
+    environ = {'IMAGEFX_MAX_THREADS': "3", 'IMAGEFX_PAGE_SIZE': "60"}
+    args = parse_args(imagefx, "--config", config_file, "--max-threads", "4")
+    args.pop('command')
+    options = imagefx.load_options(args, environ=environ)
+    assert options['max_threads'] == 4 # Command line
+    assert options['page_size'] == 60 # Environment
+    assert options['retry_delay'] == 5 # Config file
+    assert options['incremental'] is False
+    assert options['max_attempts'] == imagefx.DEFAULT_OPTIONS['max_attempts']
+
+
+def test_unset_arguments_do_not_override_other_sources(imagefx):
+    args = parse_args(imagefx)
+    args.pop('command')
+    assert imagefx.load_options(args, environ={'IMAGEFX_MAX_THREADS': "3"})['max_threads'] == 3
+
+
+def test_config_file_from_the_environment(imagefx, tmp_path):
+    config_file = write_config(tmp_path, max_threads=7)
+    assert imagefx.load_options({}, environ={'IMAGEFX_CONFIG': config_file})['max_threads'] == 7
+
+
+def test_values_are_converted(imagefx):
+    options = imagefx.load_options({}, environ={'IMAGEFX_STATUS_FORCELIST': "429,503", 'IMAGEFX_FSYNC': "yes",
+                                                'IMAGEFX_BACKOFF_FACTOR': "0.5"})
+    assert options['status_forcelist'] == (429, 503)
+    assert options['fsync'] is True
+    assert options['backoff_factor'] == 0.5
+
+
+def test_invalid_values_are_rejected(imagefx, tmp_path):
+    with pytest.raises(ValueError):
+        imagefx.load_options({}, environ={'IMAGEFX_FSYNC': "maybe"})
+    with pytest.raises(ValueError, match="no_such_option"):
+        imagefx.load_options({}, environ={'IMAGEFX_CONFIG': write_config(tmp_path, no_such_option=1)})
+
+
+def test_batch_size_is_rejected_for_the_async_engine(imagefx):
+    with pytest.raises(ValueError, match="batch_size"):
+        imagefx.load_options({'engine': "async", 'batch_size': 8}, environ={})
+    assert imagefx.load_options({'engine': "async", 'batch_size': 1}, environ={})['batch_size'] == 1
+    assert imagefx.load_options({'engine': "threads", 'batch_size': 8}, environ={})['batch_size'] == 8
+
+
+def test_account_options_are_checked_too(imagefx, tmp_path):
+    accounts_file = tmp_path / "accounts.json"
+    accounts_file.write_text(json.dumps([{'name': "a", 'cookie': "x", 'engine': "async", 'batch_size': 8}]), encoding='utf-8')
+    with pytest.raises(ValueError, match="batch_size"):
+        imagefx.load_accounts(str(accounts_file), imagefx.load_options({}, environ={}))
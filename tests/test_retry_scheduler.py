@@ -0,0 +1,69 @@
+import threading
+
+
+def item(imagefx, media_key="key"):
+    return imagefx.MediaKeyInfo(media_key, "2024-05-01T00:00:00Z")
+
+
+def failed(imagefx, error="HTTP 500"):
+    return imagefx.download_result(False, error=error)
+
+
+def test_retry_delay_doubles_until_the_attempts_are_used_up(imagefx):
+    scheduler = imagefx.RetryScheduler(max_attempts=4, retry_delay=10)
+    image = item(imagefx)
+    scheduler.start()
+    assert [scheduler.schedule_retry(image) for _ in range(4)] == [10, 20, 40, None]
+    scheduler.finish(image, failed(imagefx))
+    assert [(failed_item.media_key, error, attempts) for failed_item, error, attempts in scheduler.failed_items] == [("key", "HTTP 500", 4)]
+
+
+def test_attempts_are_counted_per_image(imagefx):
+    scheduler = imagefx.RetryScheduler(max_attempts=2, retry_delay=1)
+    assert scheduler.schedule_retry(item(imagefx, "a")) == 1
+    assert scheduler.schedule_retry(item(imagefx, "b")) == 1
+    assert scheduler.schedule_retry(item(imagefx, "a")) is None
+
+
+def test_retry_is_due_after_its_delay(imagefx, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(imagefx.time, "monotonic", lambda: now[0])
+    scheduler = imagefx.RetryScheduler(max_attempts=3, retry_delay=10)
+    image = item(imagefx)
+    scheduler.schedule_retry(image)
+    assert scheduler.pop_due() is None
+    assert scheduler.seconds_until_due() == 10
+    now[0] += 10
+    assert scheduler.pop_due() is image
+    assert scheduler.seconds_until_due() is None
+
+
+def test_requeue_does_not_count_an_attempt(imagefx):
+    scheduler = imagefx.RetryScheduler(max_attempts=2, retry_delay=0)
+    image = item(imagefx)
+    scheduler.requeue(image)
+    assert scheduler.pop_due() is image
+    assert scheduler.schedule_retry(image) == 0
+    assert scheduler.schedule_retry(image) is None
+
+
+def test_success_is_recorded_and_finishes_the_run(imagefx):
+    scheduler = imagefx.RetryScheduler()
+    image = item(imagefx)
+    scheduler.start()
+    assert not scheduler.is_finished()
+    scheduler.finish(image, imagefx.download_result(True, byte_size=1))
+    assert scheduler.is_finished()
+    assert scheduler.succeeded_media_keys == {"key"}
+    assert scheduler.failed_items == []
+    assert scheduler.wait_for_retry() is None
+
+
+def test_wait_for_retry_returns_the_due_retry(imagefx):
+    scheduler = imagefx.RetryScheduler(max_attempts=3, retry_delay=0.05)
+    image = item(imagefx)
+    scheduler.start()
+    threading.Timer(0.01, scheduler.schedule_retry, [image]).start()
+    assert scheduler.wait_for_retry() is image
+    scheduler.finish(image, failed(imagefx))
+    assert scheduler.wait_for_retry() is None